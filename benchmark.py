@@ -0,0 +1,519 @@
+"""
+Offline end-to-end benchmark of the batch_ocr -> start_openai path.
+
+Runs the real code in ocr.py and extract_data.py against local stand-ins, so the effect of a change
+can be measured without cloud services or API spend:
+
+  fake S3          HTTP server serving synthetic PDFs (--pages, --size-kb), with Range support
+  fake Document AI the fake OCR provider from ocr_providers.py (OCR_PROVIDER=fake, --ocr-latency)
+  fake OpenAI      HTTP server implementing /v1/chat/completions with a latency distribution
+                   (--openai-latency) and injected 429s (--rate-limit-ratio); repeated prompt
+                   prefixes are reported as cached tokens. It also implements the Batch API
+                   (/v1/files, /v1/batches) used by --openai-backend batch (see openai_batch.py),
+                   and can be served on its own with --serve-openai PORT
+  Postgres         a local database given by --database-url (or BENCHMARK_DATABASE_URL); the files,
+                   ocr_data and runsheets tables are created if missing (runsheets without a unique
+                   key, like the production schema; migrate_runsheets.py then adds it), e.g. with
+                   docker run -e POSTGRES_PASSWORD=postgres -p 5432:5432 postgres:16
+
+Every size runs in its own subprocess and temporary working directory (downloads, OCR cache,
+no LLM cache), so runs do not share caches and peak RSS is measured per run. The report gives
+files/min, p50/p95 latency per stage (from the metrics in metrics.py) and peak RSS:
+
+    python benchmark.py --sizes 10,100,1000 --output benchmark.json
+
+Latency specs use the ocr_providers.py syntax, e.g. lognormal:median=1.5,sigma=0.5.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import email.policy
+from email.parser import BytesParser
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PyPDF2 import PdfWriter
+
+from ocr_providers import parse_latency
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS public.files (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER,
+    project_id INTEGER,
+    file_name TEXT,
+    s3_url TEXT,
+    ocr_status TEXT DEFAULT 'Processing'
+);
+CREATE TABLE IF NOT EXISTS public.ocr_data (
+    id SERIAL PRIMARY KEY,
+    file_id INTEGER,
+    project_id INTEGER,
+    ocr_json_1 JSONB,
+    ocr_text_1 TEXT,
+    UNIQUE (file_id, project_id)
+);
+CREATE TABLE IF NOT EXISTS public.runsheets (
+    id SERIAL PRIMARY KEY,
+    file_id INTEGER,
+    project_id INTEGER,
+    instrument_type TEXT,
+    document_case TEXT,
+    volume_page TEXT,
+    effective_date DATE,
+    execution_date DATE,
+    file_date DATE,
+    grantor TEXT,
+    grantee TEXT,
+    property_description TEXT,
+    remarks TEXT,
+    user_id INTEGER
+);
+"""
+
+# Answers of the fake model, including names that need normalizing (see prompt_registry.py)
+FAKE_INSTRUMENT_TYPES = ["Deed", "Lease", "Right of Way", "Assignment of Oil and Gas Lease", "Affidavit", "Release"]
+
+
+# A PDF of blank pages padded (through its metadata) to about size_bytes.
+def synthetic_pdf(file_id, pages, size_bytes):
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=612, height=792)
+    writer.add_metadata({"/Title": f"Benchmark file {file_id}"})
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    padding = size_bytes - len(buffer.getvalue()) - 32
+    if padding > 0:
+        writer.add_metadata({"/Padding": "0" * padding})
+        buffer = io.BytesIO()
+        writer.write(buffer)
+    return buffer.getvalue()
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    """GET /bucket/<file_id>.pdf?pages=3&size_kb=200"""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        file_id = os.path.splitext(os.path.basename(url.path))[0]
+        content = synthetic_pdf(file_id, int(query.get("pages", ["3"])[0]), int(query.get("size_kb", ["200"])[0]) * 1024)
+
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header and range_header.startswith("bytes="):
+            start = int(range_header[len("bytes="):].split("-")[0] or 0)
+            if start >= len(content):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+        self.wfile.write(content[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Deterministic answer of the fake model to a chat.completions request body.
+def fake_completion(body, prefix_seen, request_number):
+    messages = body.get("messages", [])
+    document_hash = int(hashlib.sha256(messages[-1]["content"].encode("utf-8")).hexdigest(), 16) if messages else 0
+    if body.get("response_format"):
+        content = {
+            "instrument_type": FAKE_INSTRUMENT_TYPES[document_hash % len(FAKE_INSTRUMENT_TYPES)],
+            "volume_page": f"{document_hash % 900 + 100}/{document_hash % 97 + 1}",
+            "document_case_number": f"#{document_hash % 100000}",
+            "execution_date": "January 1, 2023",
+            "effective_date": "January 2, 2023",
+            "recording_date": "January 3, 2023",
+            "grantee": "Jane Doe",
+            "grantor": "John Smith",
+            "property_description": "Section 12, Block 4, H&TC RR Co. Survey",
+        }
+    else:
+        content = {"instrument_type": FAKE_INSTRUMENT_TYPES[document_hash % len(FAKE_INSTRUMENT_TYPES)]}
+
+    prompt_tokens = sum(len(message.get("content", "")) for message in messages) // 4
+    prefix_tokens = len(json.dumps(messages[:-1], sort_keys=True)) // 4
+    cached_tokens = prefix_tokens // 128 * 128 if prefix_seen and prefix_tokens >= 1024 else 0
+    completion_tokens = len(json.dumps(content)) // 4
+    return {
+        "id": f"chatcmpl-benchmark-{request_number}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4o-mini"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": json.dumps(content)}, "finish_reason": "stop"}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        },
+    }
+
+
+# Fields of a multipart/form-data body: {name: (filename, bytes)}.
+def parse_multipart(content_type, data):
+    message = BytesParser(policy=email.policy.default).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + data)
+    return {
+        part.get_param("name", header="content-disposition"): (part.get_filename(), part.get_payload(decode=True))
+        for part in message.iter_parts()
+    }
+
+
+class FakeOpenAiHandler(BaseHTTPRequestHandler):
+    """POST /v1/chat/completions with configurable latency and injected 429s, plus the Batch API:
+    POST /v1/files, POST /v1/batches, GET /v1/batches/<id> and GET /v1/files/<id>/content.
+    A batch completes batch_seconds after it is created; its requests get no latency and no 429s."""
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if path.endswith("/files"):
+            self._upload_file(data)
+        elif path.endswith("/batches"):
+            self._create_batch(json.loads(data))
+        else:
+            self._chat_completion(json.loads(data))
+
+    def do_GET(self):
+        parts = urlparse(self.path).path.strip("/").split("/")
+        server = self.server
+        with server.lock:
+            if len(parts) == 3 and parts[1] == "batches" and parts[2] in server.batches:
+                self._send_json(200, dict(server.batches[parts[2]]))
+                return
+            if len(parts) == 4 and parts[1] == "files" and parts[3] == "content" and parts[2] in server.files:
+                content = server.files[parts[2]]["content"]
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+                return
+        self._send_json(404, {"error": {"message": f"No such object: {self.path}", "type": "invalid_request_error"}})
+
+    def _chat_completion(self, body):
+        server = self.server
+        messages = body.get("messages", [])
+        prefix_hash = hashlib.sha256(json.dumps(messages[:-1], sort_keys=True).encode("utf-8")).hexdigest()
+        with server.lock:
+            latency = server.sample_latency(server.rng)
+            rate_limited = server.rng.random() < server.rate_limit_ratio
+            prefix_seen = prefix_hash in server.seen_prefixes
+            server.seen_prefixes.add(prefix_hash)
+            server.requests += 1
+            server.rate_limited += rate_limited
+            request_number = server.requests
+        time.sleep(latency)
+
+        if rate_limited:
+            self._send_json(429, {"error": {"message": "Rate limit reached (benchmark)", "type": "requests", "code": "rate_limit_exceeded"}},
+                            {"retry-after-ms": "200", "x-ratelimit-reset-requests": "0.2s"})
+            return
+        self._send_json(200, fake_completion(body, prefix_seen, request_number))
+
+    def _upload_file(self, data):
+        fields = parse_multipart(self.headers.get("Content-Type", ""), data)
+        filename, content = fields.get("file", ("upload.jsonl", b""))
+        purpose = (fields.get("purpose", (None, b"batch"))[1] or b"").decode("utf-8")
+        with self.server.lock:
+            file_object = self._store_file(filename, content, purpose)
+        self._send_json(200, file_object)
+
+    def _store_file(self, filename, content, purpose):
+        server = self.server
+        file_id = f"file-benchmark-{len(server.files) + 1}"
+        server.files[file_id] = {"content": content, "object": {
+            "id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+            "filename": filename or f"{file_id}.jsonl", "purpose": purpose, "status": "processed",
+        }}
+        return server.files[file_id]["object"]
+
+    def _create_batch(self, body):
+        server = self.server
+        with server.lock:
+            input_file = server.files.get(body.get("input_file_id"))
+            if input_file is None:
+                self._send_json(404, {"error": {"message": "No such file", "type": "invalid_request_error"}})
+                return
+            batch_id = f"batch_benchmark_{len(server.batches) + 1}"
+            lines = [json.loads(line) for line in input_file["content"].decode("utf-8").splitlines() if line.strip()]
+            batch = server.batches[batch_id] = {
+                "id": batch_id, "object": "batch", "endpoint": body.get("endpoint"), "errors": None,
+                "input_file_id": body["input_file_id"], "completion_window": body.get("completion_window", "24h"),
+                "status": "in_progress", "output_file_id": None, "error_file_id": None,
+                "created_at": int(time.time()), "metadata": body.get("metadata"),
+                "request_counts": {"total": len(lines), "completed": 0, "failed": 0},
+            }
+        threading.Thread(target=self._run_batch, args=(batch, lines), daemon=True).start()
+        self._send_json(200, dict(batch))
+
+    def _run_batch(self, batch, lines):
+        server = self.server
+        time.sleep(server.batch_seconds)
+        output = []
+        with server.lock:
+            for line in lines:
+                body = line["body"]
+                prefix_hash = hashlib.sha256(json.dumps(body.get("messages", [])[:-1], sort_keys=True).encode("utf-8")).hexdigest()
+                prefix_seen = prefix_hash in server.seen_prefixes
+                server.seen_prefixes.add(prefix_hash)
+                server.batch_requests += 1
+                completion = fake_completion(body, prefix_seen, server.batch_requests)
+                output.append(json.dumps({
+                    "id": f"batch_req_{server.batch_requests}", "custom_id": line["custom_id"], "error": None,
+                    "response": {"status_code": 200, "request_id": completion["id"], "body": completion},
+                }))
+            output_file = self._store_file(f"{batch['id']}_output.jsonl", ("\n".join(output) + "\n").encode("utf-8"), "batch_output")
+            batch.update({
+                "status": "completed", "output_file_id": output_file["id"], "completed_at": int(time.time()),
+                "request_counts": {"total": len(lines), "completed": len(lines), "failed": 0},
+            })
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(handler, port=0, **attributes):
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_fake_openai(args, port=0):
+    return start_server(
+        FakeOpenAiHandler, port, sample_latency=parse_latency(args.openai_latency), rate_limit_ratio=args.rate_limit_ratio,
+        rng=random.Random(args.seed), lock=threading.Lock(), seen_prefixes=set(), requests=0, rate_limited=0,
+        files={}, batches={}, batch_seconds=args.batch_seconds, batch_requests=0)
+
+
+class SampleRecorder:
+    """Raw observations of one metrics histogram (installed as its observer), for exact quantiles.
+    The service's histograms only keep buckets."""
+
+    def __init__(self, histogram):
+        self.samples = []  # (labels, value)
+        self._lock = threading.Lock()
+        histogram.add_observer(self.record)
+
+    def record(self, value, labels):
+        with self._lock:
+            self.samples.append((labels, value))
+
+    def values(self, **labels):
+        with self._lock:
+            return [value for sample_labels, value in self.samples
+                    if all(str(sample_labels.get(name)) == str(expected) for name, expected in labels.items())]
+
+    def quantile(self, q, **labels):
+        values = sorted(self.values(**labels))
+        return values[min(len(values) - 1, int(q * len(values)))] if values else None
+
+
+def stage_report(recorder, **labels):
+    p50 = recorder.quantile(0.50, **labels)
+    p95 = recorder.quantile(0.95, **labels)
+    return {
+        "count": len(recorder.values(**labels)),
+        "p50_seconds": round(p50, 4) if p50 is not None else None,
+        "p95_seconds": round(p95, 4) if p95 is not None else None,
+    }
+
+
+# One benchmark run with file_count files, inside the current process.
+def run_once(file_count, args):
+    workdir = tempfile.mkdtemp(prefix="titlemine-benchmark-")
+    shutil.copy(os.path.join(REPO_DIR, "prompts.json"), workdir)
+    credentials_path = os.path.join(workdir, "credentials.json")
+    with open(credentials_path, "w") as file:
+        json.dump({"type": "service_account", "project_id": "benchmark"}, file)
+    os.chdir(workdir)  # download_file/, ocr_cache/ and ./.env are resolved from here
+    sys.path.insert(0, REPO_DIR)
+
+    s3_server = start_server(FakeS3Handler)
+    openai_server = start_fake_openai(args)
+
+    os.environ.update({
+        "DATABASE_URL": args.database_url,
+        "CREDENTIALS_PATH": credentials_path,
+        "PROJECT_ID": "benchmark", "LOCATION": "local", "PROCESSOR_ID": "fake",
+        "OCR_BACKEND": "online",
+        "OCR_PROVIDER": "fake",
+        "FAKE_OCR_LATENCY": args.ocr_latency,
+        "OCR_CACHE_DIR": os.path.join(workdir, "ocr_cache"),
+        "LLM_CACHE_BACKEND": "none",
+        "OPENAI_BACKEND": args.openai_backend,
+        "OPENAI_BATCH_DIR": os.path.join(workdir, "openai_batch"),
+        "OPENAI_BATCH_POLL_SECONDS": "0.2",
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{openai_server.server_port}/v1",
+    })
+
+    from db import db_connection
+    from migrate_runsheets import migrate
+    project_id = random.Random().randint(10 ** 8, 2 * 10 ** 9)
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(SCHEMA)
+            for index in range(file_count):
+                s3_url = (f"http://127.0.0.1:{s3_server.server_port}/bucket/{project_id}-{index}.pdf"
+                          f"?pages={args.pages}&size_kb={args.size_kb}")
+                cur.execute("""
+                    INSERT INTO public.files (user_id, project_id, file_name, s3_url, ocr_status)
+                    VALUES (%s, %s, %s, %s, 'Processing')
+                """, (1, project_id, f"benchmark_{index}.pdf", s3_url))
+    migrate(apply=True)
+
+    import ocr
+    import metrics
+    recorders = {name: SampleRecorder(getattr(metrics, name))
+                 for name in ("download_seconds", "ocr_request_seconds", "openai_request_seconds", "db_write_seconds")}
+
+    started = time.monotonic()
+    response = ocr.app.test_client().post(f"/api/v1/batch_ocr/{project_id}")
+    ocr_done = time.monotonic()
+    while True:
+        try:
+            ocr.start_openai(project_id)
+            break
+        except ocr.JobWaiting as e:  # OpenAI batches still running, run again like the job worker would
+            time.sleep(e.retry_seconds)
+    finished = time.monotonic()
+
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM public.runsheets WHERE project_id = %s", (project_id,))
+            runsheets = cur.fetchone()[0]
+            if not args.keep_data:
+                cur.execute("DELETE FROM public.runsheets WHERE project_id = %s", (project_id,))
+                cur.execute("DELETE FROM public.ocr_data WHERE project_id = %s", (project_id,))
+                cur.execute("DELETE FROM public.files WHERE project_id = %s", (project_id,))
+
+    os.chdir(REPO_DIR)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    elapsed = finished - started
+    return {
+        "files": file_count,
+        "batch_ocr_status": response.status_code,
+        "runsheets_written": runsheets,
+        "seconds": round(elapsed, 3),
+        "files_per_minute": round(file_count / elapsed * 60, 2) if elapsed > 0 else None,
+        "ocr_phase_seconds": round(ocr_done - started, 3),
+        "extraction_phase_seconds": round(finished - ocr_done, 3),
+        "stages": {
+            "download": stage_report(recorders["download_seconds"]),
+            "ocr": stage_report(recorders["ocr_request_seconds"]),
+            "openai_instrument_type": stage_report(recorders["openai_request_seconds"], stage="instrument_type"),
+            "openai_extraction": stage_report(recorders["openai_request_seconds"], stage="extraction"),
+            "db_write": stage_report(recorders["db_write_seconds"]),
+        },
+        "openai_requests": openai_server.requests,
+        "openai_rate_limited": openai_server.rate_limited,
+        "openai_batch_requests": openai_server.batch_requests,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),  # ru_maxrss is in KiB on Linux
+    }
+
+
+def child_command(file_count, args, output_path):
+    return [
+        sys.executable, os.path.abspath(__file__), "--files", str(file_count), "--child-output", output_path,
+        "--database-url", args.database_url, "--pages", str(args.pages), "--size-kb", str(args.size_kb),
+        "--ocr-latency", args.ocr_latency, "--openai-latency", args.openai_latency,
+        "--rate-limit-ratio", str(args.rate_limit_ratio), "--seed", str(args.seed),
+        "--openai-backend", args.openai_backend, "--batch-seconds", str(args.batch_seconds),
+    ] + (["--keep-data"] if args.keep_data else [])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of batch_ocr -> start_openai")
+    parser.add_argument("--sizes", default="10,100,1000", help="comma separated file counts, one subprocess each")
+    parser.add_argument("--files", type=int, help="run a single size in this process")
+    parser.add_argument("--database-url", default=os.getenv("BENCHMARK_DATABASE_URL"))
+    parser.add_argument("--pages", type=int, default=3)
+    parser.add_argument("--size-kb", type=int, default=200)
+    parser.add_argument("--ocr-latency", default="lognormal:median=0.8,sigma=0.4")
+    parser.add_argument("--openai-latency", default="lognormal:median=0.6,sigma=0.4")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--openai-backend", choices=("online", "batch"), default="online", help="extraction path, see openai_batch.py")
+    parser.add_argument("--batch-seconds", type=float, default=2.0, help="time for a fake OpenAI batch to complete")
+    parser.add_argument("--serve-openai", type=int, metavar="PORT", help="only serve the fake OpenAI API (chat and batch) on this port")
+    parser.add_argument("--keep-data", action="store_true", help="keep the benchmark rows in the database")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--child-output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve_openai is not None:
+        server = start_fake_openai(args, args.serve_openai)
+        print(f"Fake OpenAI API on http://127.0.0.1:{server.server_port}/v1", file=sys.stderr)
+        threading.Event().wait()
+    if not args.database_url:
+        parser.error("--database-url or BENCHMARK_DATABASE_URL is required")
+
+    if args.files is not None:
+        report = run_once(args.files, args)
+        if args.child_output:
+            with open(args.child_output, "w") as file:
+                json.dump(report, file)
+        else:
+            print(json.dumps(report, indent=4))
+        return
+
+    reports = []
+    for file_count in [int(size) for size in args.sizes.split(",") if size]:
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as output:
+            output_path = output.name
+        subprocess.run(child_command(file_count, args, output_path), check=True)
+        with open(output_path) as file:
+            reports.append(json.load(file))
+        os.remove(output_path)
+        report = reports[-1]
+        print(f"{file_count:>5} files: {report['files_per_minute']} files/min, "
+              f"ocr p95 {report['stages']['ocr']['p95_seconds']}s, "
+              f"openai p95 {report['stages']['openai_extraction']['p95_seconds']}s, "
+              f"peak RSS {report['peak_rss_mb']} MB", file=sys.stderr)
+
+    print(json.dumps(reports, indent=4))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(reports, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
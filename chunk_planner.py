@@ -0,0 +1,148 @@
+"""
+Chunk planning for PDFs that are over the Document AI synchronous limits (20 MB / 15 pages).
+
+The original heuristic assumed every page weighs total_size / total_pages. That breaks on
+title files with one huge scanned plat page next to many light text pages: a chunk either
+goes over 20 MB and fails, or we split far more than needed.
+
+The probe stage parses the PDF once and measures the serialized size of every page on its own.
+The planner then packs consecutive pages greedily into chunks that meet both limits. For
+contiguous chunks with additive sizes, greedy packing gives the fewest possible chunks.
+A single page's size counts its shared resources (fonts, images) every time, so the sum over a
+chunk is an upper bound on the real chunk size.
+
+Benchmark the planner against the heuristic with:
+
+    python chunk_planner.py <file.pdf> [<file.pdf> ...]
+"""
+
+import io
+import sys
+import time
+import json
+
+from PyPDF2 import PdfReader, PdfWriter
+
+
+MB = 1024 * 1024
+
+
+class PdfProbe:
+    """A PDF parsed once, with lazily measured per-page serialized sizes."""
+
+    def __init__(self, reader, total_size):
+        self.reader = reader
+        self.total_size = total_size
+        self.page_count = len(reader.pages)
+        self._page_sizes = {}
+
+    @classmethod
+    def from_bytes(cls, content):
+        return cls(PdfReader(io.BytesIO(content)), len(content))
+
+    def page_size(self, page_num):
+        if page_num not in self._page_sizes:
+            self._page_sizes[page_num] = len(write_pages(self.reader, page_num, page_num + 1))
+        return self._page_sizes[page_num]
+
+    @property
+    def page_sizes(self):
+        return [self.page_size(page_num) for page_num in range(self.page_count)]
+
+    # plan_chunks over each (start_page, end_page) run of pages; only the pages in the runs are measured.
+    def plan_runs(self, page_runs, max_bytes=20 * MB, max_pages=15):
+        page_ranges = []
+        for run_start, run_end in page_runs:
+            page_sizes = [self.page_size(page_num) for page_num in range(run_start, run_end)]
+            page_ranges.extend((run_start + start, run_start + end, size)
+                               for start, end, size in plan_chunks(page_sizes, max_bytes, max_pages))
+        return page_ranges
+
+
+# Serialize pages [start_page, end_page) of an already parsed PDF into a new PDF in memory.
+def write_pages(reader, start_page, end_page):
+    writer = PdfWriter()
+    for page_num in range(start_page, end_page):
+        writer.add_page(reader.pages[page_num])
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+# Pack consecutive pages into the fewest chunks within max_bytes and max_pages.
+# Returns (start_page, end_page, estimated_bytes) tuples; a page over max_bytes by itself gets its own chunk.
+def plan_chunks(page_sizes, max_bytes=20 * MB, max_pages=15):
+    plan = []
+    start_page = 0
+    current_size = 0
+    for page_num, page_size in enumerate(page_sizes):
+        pages_in_chunk = page_num - start_page
+        if pages_in_chunk and (pages_in_chunk >= max_pages or current_size + page_size > max_bytes):
+            plan.append((start_page, page_num, current_size))
+            start_page = page_num
+            current_size = 0
+        current_size += page_size
+    if page_sizes:
+        plan.append((start_page, len(page_sizes), current_size))
+    return plan
+
+
+# The original size-per-page heuristic, kept for comparison with plan_chunks.
+# Returns (start_page, end_page) tuples.
+def heuristic_plan(total_size_bytes, total_pages, max_bytes=20 * MB, max_pages=15):
+    size_per_page = total_size_bytes / total_pages
+    page_ranges = []
+    start_page = 0
+    while start_page < total_pages:
+        end_page = start_page
+        current_size = 0
+        while end_page < total_pages and (end_page == start_page or current_size + size_per_page <= max_bytes) and (end_page - start_page) < max_pages:
+            current_size += size_per_page
+            end_page += 1
+        page_ranges.append((start_page, end_page))
+        start_page = end_page
+    return page_ranges
+
+
+# Build the chunk PDFs in memory from a plan. A chunk that still comes out over max_bytes is halved until it fits
+# (or is a single page). Returns (start_page, end_page, pdf_bytes) tuples in page order.
+def build_chunks(reader, page_ranges, max_bytes=20 * MB):
+    chunks = []
+    pending = [page_range[:2] for page_range in page_ranges]
+    while pending:
+        start_page, end_page = pending.pop(0)
+        chunk_content = write_pages(reader, start_page, end_page)
+        if len(chunk_content) > max_bytes and end_page - start_page > 1:
+            middle = (start_page + end_page) // 2
+            pending[:0] = [(start_page, middle), (middle, end_page)]
+            continue
+        chunks.append((start_page, end_page, chunk_content))
+    return chunks
+
+
+# Compare both planners on one PDF: chunk counts, real chunk sizes and chunks that break the size limit.
+def compare_plans(content, max_bytes=20 * MB, max_pages=15):
+    started = time.perf_counter()
+    probe = PdfProbe.from_bytes(content)
+    page_sizes = probe.page_sizes
+    probe_seconds = time.perf_counter() - started
+
+    report = {"pages": probe.page_count, "size_bytes": probe.total_size, "probe_seconds": round(probe_seconds, 4)}
+    for name, page_ranges in (
+        ("heuristic", heuristic_plan(probe.total_size, probe.page_count, max_bytes, max_pages)),
+        ("planner", plan_chunks(page_sizes, max_bytes, max_pages)),
+    ):
+        real_sizes = [len(write_pages(probe.reader, start_page, end_page)) for start_page, end_page, *_ in page_ranges]
+        report[name] = {
+            "chunks": len(page_ranges),
+            "ranges": [list(page_range[:2]) for page_range in page_ranges],
+            "max_chunk_bytes": max(real_sizes) if real_sizes else 0,
+            "chunks_over_limit": sum(1 for size in real_sizes if size > max_bytes),
+        }
+    return report
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        with open(path, "rb") as file:
+            print(json.dumps({"file": path, **compare_plans(file.read())}, indent=4))
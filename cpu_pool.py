@@ -0,0 +1,247 @@
+"""
+Process pool for the CPU-bound steps of OCR processing.
+
+PyPDF2 parsing, text-layer extraction and chunk splitting are pure Python, and so is
+json.dump(..., indent=4) (the C encoder is only used without indent). In the ocr and docai threads
+they held the GIL against the network I/O of every other file in flight. They now run in one
+sized ProcessPoolExecutor:
+
+  plan_pdf, write_json_file    see cpu_worker.py
+  ocr_column_values the ocr_json_1 / ocr_text_1 values (ocr_format.py), zlib and JSON included
+
+The PDF is not copied to the workers: it is already in download_file/, so a worker gets its path
+and reads it through a read-only mmap (PdfReader seeks straight in the page cache). The chunk PDFs a
+worker builds come back as the task result, through the pool's pipe like any other result, so
+nothing is left behind when a task fails or its future is cancelled.
+
+Inputs smaller than CPU_POOL_MIN_BYTES run inline in the calling thread, where the process hop
+would cost more than it saves. CPU_POOL_WORKERS=0 runs everything inline.
+
+Workers are started with spawn (the parent runs many threads, which fork does not mix well with).
+Like any spawned child, a worker first imports the parent's main module as __mp_main__: for ocr.py
+that builds the Flask app and OCR client objects once per worker, at pool start-up, but starts
+nothing (no server, no job workers, and the database pool only connects on first use). The tasks
+themselves are in cpu_worker.py, whose init_worker initializer names the process cpu-pool-worker-<pid>.
+
+Benchmark per-core scaling on multi-hundred-page documents (synthetic text PDFs, or given files):
+
+    python cpu_pool.py --pages 300 --documents 8 --workers 0,1,2,4
+    python cpu_pool.py <file.pdf> [<file.pdf> ...]
+
+Configuration (.env):
+
+CPU_POOL_WORKERS=         # default: one per CPU core
+CPU_POOL_MIN_BYTES=
+CPU_POOL_START_METHOD=    # spawn (default), forkserver or fork
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from cpu_worker import init_worker, plan_pdf, write_json_file
+from text_layer import PageRoute, text_layer_result
+from ocr_format import ocr_column_values
+import metrics
+
+
+MB = 1024 * 1024
+
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", str(os.cpu_count() or 1)))
+CPU_POOL_MIN_BYTES = int(os.getenv("CPU_POOL_MIN_BYTES", str(256 * 1024)))
+CPU_POOL_START_METHOD = os.getenv("CPU_POOL_START_METHOD", "spawn")
+
+
+class CpuPool:
+    """Runs module-level functions in worker processes, or inline for small inputs."""
+
+    def __init__(self, workers, min_bytes=0, start_method="spawn"):
+        self.workers = workers
+        self.min_bytes = min_bytes
+        self.start_method = start_method
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(self.start_method),
+                    initializer=init_worker,
+                )
+            return self._executor
+
+    def _offload(self, size):
+        return self.workers > 0 and (size is None or size >= self.min_bytes)
+
+    # Run task(*args) and return its result. size (bytes of input) decides between a worker process and inline.
+    def run(self, task, *args, size=None):
+        return self._result(task, self._submit(task, *args, size=size))
+
+    # Start task(*args) in a worker process. The future is None when the task is to run inline.
+    def _submit(self, task, *args, size=None):
+        if not self._offload(size):
+            return (time.monotonic(), None, args)
+        try:
+            return (time.monotonic(), self._get_executor().submit(task, *args), args)
+        except BrokenProcessPool:
+            self._reset()
+            return (time.monotonic(), None, args)
+
+    # task over items (one argument each), offloaded items running in parallel; results in item order.
+    def map(self, task, items, size=None):
+        submitted = [self._submit(task, item, size=size(item) if size else None) for item in items]
+        return [self._result(task, entry) for entry in submitted]
+
+    def _result(self, task, entry):
+        started, future, args = entry
+        where = "process"
+        if future is not None:
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:
+                logging.error(f"CPU pool broken while running {task.__name__}, running it inline: {e}")
+                self._reset()
+                future = None
+        if future is None:
+            where = "inline"
+            started = time.monotonic()
+            result = task(*args)
+        metrics.cpu_task_seconds.observe(time.monotonic() - started, task=task.__name__, where=where)
+        return result
+
+    def _reset(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    # Start every worker process now instead of on the first tasks.
+    def warm_up(self):
+        if self.workers > 0:
+            executor = self._get_executor()
+            for future in [executor.submit(time.sleep, 0.1) for _ in range(self.workers)]:
+                future.result()
+
+    def shutdown(self):
+        self._reset()
+
+
+cpu_pool = CpuPool(CPU_POOL_WORKERS, CPU_POOL_MIN_BYTES, CPU_POOL_START_METHOD)
+
+
+def ocr_data_size(ocr_data):
+    return len((ocr_data or {}).get("text") or "") if isinstance(ocr_data, dict) else 0
+
+
+SAMPLE_LINE = ("KNOW ALL MEN BY THESE PRESENTS that the Grantor does hereby grant bargain sell and convey unto the "
+               "Grantee all of the oil gas and other minerals in and under Section 12 Block 4")
+
+
+# A text PDF of pages pages (Helvetica, lines_per_page lines each) with a real text layer to extract.
+def synthetic_text_pdf(pages, lines_per_page=45):
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page_num in range(pages):
+        lines = " ".join(f"({SAMPLE_LINE} page {page_num + 1} line {line_num + 1}) Tj T*" for line_num in range(lines_per_page))
+        stream = f"BT /F1 7 Tf 9 TL 30 770 Td {lines} ET".encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> "
+                       f"/Contents {len(objects)} 0 R >>".encode("latin-1"))
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>".encode("latin-1")
+
+    content = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(content))
+        content += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref_offset = len(content)
+    content += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        content += b"%010d 00000 n \n" % offset
+    content += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset)
+    return bytes(content)
+
+
+# An OCR result of page_count pages of SAMPLE_LINE text, the size of what Document AI returns for them.
+def synthetic_ocr_result(page_count, lines_per_page=45):
+    return text_layer_result([PageRoute(page_num, "\n".join([SAMPLE_LINE] * lines_per_page), 1.0, False)
+                              for page_num in range(page_count)])
+
+
+# The CPU side of OCR'ing one document with the text layer fast path off (the default): one parse for
+# the chunk plan and chunk PDFs of every page, then both JSON serializations of its OCR result.
+def benchmark_document(pool, file_path, output_folder):
+    pdf = pool.run(plan_pdf, file_path, None, False, 20 * MB, 15, size=os.path.getsize(file_path))
+    extracted_data = synthetic_ocr_result(pdf.page_count)
+    pool.run(ocr_column_values, extracted_data, size=ocr_data_size(extracted_data))
+    json_path = os.path.join(output_folder, os.path.basename(file_path) + ".json")
+    pool.run(write_json_file, json_path, extracted_data, size=ocr_data_size(extracted_data))
+    return pdf.page_count, len(pdf.chunks)
+
+
+# Process every document at once (one thread each, like the ocr pool) with each worker count.
+# workers=0 is the old behavior: everything inline in the threads, serialized by the GIL.
+def run_benchmark(file_paths, worker_counts):
+    reports = []
+    output_folder = tempfile.mkdtemp(prefix="cpu_pool_benchmark_")
+    try:
+        for workers in worker_counts:
+            pool = CpuPool(workers, min_bytes=0)
+            pool.warm_up()
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=len(file_paths)) as threads:
+                results = list(threads.map(lambda path: benchmark_document(pool, path, output_folder), file_paths))
+            seconds = time.perf_counter() - started
+            pool.shutdown()
+            pages = sum(page_count for page_count, _ in results)
+            reports.append({"workers": workers, "documents": len(file_paths), "pages": pages,
+                            "chunks": sum(chunk_count for _, chunk_count in results),
+                            "seconds": round(seconds, 3), "pages_per_second": round(pages / seconds, 1)})
+    finally:
+        shutil.rmtree(output_folder, ignore_errors=True)
+
+    baseline = reports[0]["seconds"] if reports and reports[0]["workers"] == 0 else None
+    for report in reports:
+        if baseline:
+            report["speedup"] = round(baseline / report["seconds"], 2)
+            report["efficiency_per_core"] = round(report["speedup"] / max(1, report["workers"]), 2)
+    return reports
+
+
+def default_worker_counts():
+    cores = os.cpu_count() or 1
+    counts = [0] + [2 ** power for power in range(cores.bit_length()) if 2 ** power <= cores]
+    return counts if cores in counts else counts + [cores]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark per-core scaling of the CPU-bound OCR steps")
+    parser.add_argument("files", nargs="*", help="PDFs to use instead of synthetic documents")
+    parser.add_argument("--pages", type=int, default=300, help="pages per synthetic document")
+    parser.add_argument("--documents", type=int, default=8, help="synthetic documents processed at once")
+    parser.add_argument("--workers", help="comma separated worker counts, 0 = inline (default: 0, 1, 2, 4, ... cores)")
+    args = parser.parse_args()
+
+    worker_counts = [int(count) for count in args.workers.split(",")] if args.workers else default_worker_counts()
+    with tempfile.TemporaryDirectory(prefix="cpu_pool_documents_") as folder:
+        file_paths = list(args.files)
+        if not file_paths:
+            content = synthetic_text_pdf(args.pages)
+            for index in range(args.documents):
+                file_paths.append(os.path.join(folder, f"document_{index}.pdf"))
+                with open(file_paths[-1], "wb") as file:
+                    file.write(content)
+        json.dump({"cpu_count": os.cpu_count(), "runs": run_benchmark(file_paths, worker_counts)}, sys.stdout, indent=4)
+        print()
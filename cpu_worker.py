@@ -0,0 +1,94 @@
+"""
+Entry module of the CPU pool worker processes (see cpu_pool.py).
+
+Everything a worker runs lives here or in the small modules imported below, which need nothing of
+ocr.py's state (database pool, OCR clients, metrics, scheduler). cpu_pool.py starts the workers with
+init_worker as their initializer.
+
+  plan_pdf          everything the OCR of a PDF needs from it, on one parse: page count, text layer
+                    of every page and its routing score, and the chunk PDFs of the pages that need
+                    OCR (measured and packed by chunk_planner.py)
+  split_for_batch   text layer routing for the batch OCR backend, with the pages that need OCR
+                    written to one PDF per contiguous run (no size limits in batch mode)
+  write_json_file   the download_json_*.json OCR output files
+"""
+
+import os
+import json
+import mmap
+import multiprocessing
+from contextlib import contextmanager
+
+from PyPDF2 import PdfReader
+
+from chunk_planner import PdfProbe, build_chunks, write_pages
+from text_layer import route_pages, ocr_page_runs
+
+
+# Initializer of every worker process.
+def init_worker():
+    multiprocessing.current_process().name = f"cpu-pool-worker-{os.getpid()}"
+
+
+class PdfPlan:
+    """How a PDF is OCR'd, see plan_pdf. kind is "text_layer" (every page read locally), "file" (one
+    request for the whole file), "chunks" or "too_large" (a single page over the size limit)."""
+
+    def __init__(self, kind, page_count, size_bytes, routes, chunks=()):
+        self.kind = kind
+        self.page_count = page_count
+        self.size_bytes = size_bytes
+        self.routes = routes
+        self.chunks = chunks  # (start_page, end_page, pdf_bytes)
+
+
+# Parse a PDF through a read-only mmap of the file; pages must be read inside the with block.
+@contextmanager
+def open_pdf(file_path):
+    with open(file_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        yield PdfReader(view)
+
+
+# Parse the PDF once and decide how it is OCR'd. When text_layer is set, pages with a good text layer
+# (text_layer.py) are left out of the chunks; the rest is sent whole when it fits one request of
+# max_bytes / max_pages, otherwise packed into chunks that do (chunk_planner.py), built here.
+def plan_pdf(file_path, file_id=None, text_layer=True, max_bytes=20 * 1024 * 1024, max_pages=15):
+    size_bytes = os.path.getsize(file_path)
+    with open_pdf(file_path) as reader:
+        probe = PdfProbe(reader, size_bytes)
+        page_count = probe.page_count
+        routes = route_pages(reader, file_id) if text_layer else []
+        text_layer_pages = {route.page_num for route in routes if route.use_text_layer}
+        if text_layer_pages and len(text_layer_pages) == page_count:
+            return PdfPlan("text_layer", page_count, size_bytes, routes)
+        if not text_layer_pages:
+            if size_bytes > max_bytes and page_count == 1:
+                return PdfPlan("too_large", page_count, size_bytes, routes)
+            if size_bytes <= max_bytes and page_count <= max_pages:
+                return PdfPlan("file", page_count, size_bytes, routes)
+        page_ranges = probe.plan_runs(ocr_page_runs(page_count, text_layer_pages), max_bytes, max_pages)
+        return PdfPlan("chunks", page_count, size_bytes, routes, build_chunks(reader, page_ranges, max_bytes))
+
+
+# Route the pages of a PDF for the batch OCR backend (docai_batch.py). Returns (routes, runs): runs are
+# (start_page, end_page, path) of the pages that still need OCR, the whole file when no page has a good
+# text layer and none when every page has one. Partial runs are written next to file_path.
+def split_for_batch(file_path, file_id=None):
+    with open_pdf(file_path) as reader:
+        routes = route_pages(reader, file_id)
+        text_layer_pages = {route.page_num for route in routes if route.use_text_layer}
+        if not text_layer_pages:
+            return routes, [(0, len(routes), file_path)]
+        root, extension = os.path.splitext(file_path)
+        runs = []
+        for start_page, end_page in ocr_page_runs(len(routes), text_layer_pages):
+            run_path = f"{root}_pages_{start_page + 1}_{end_page}{extension}"
+            with open(run_path, "wb") as file:
+                file.write(write_pages(reader, start_page, end_page))
+            runs.append((start_page, end_page, run_path))
+        return routes, runs
+
+
+def write_json_file(file_path, data):
+    with open(file_path, "w", encoding="utf-8") as json_file:
+        json.dump(data, json_file, indent=4, ensure_ascii=False)
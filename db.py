@@ -0,0 +1,204 @@
+"""
+Shared PostgreSQL connection pool used by ocr.py and extract_data.py.
+
+Both modules used to open and close their own connection in every helper, and they read
+two different configurations. Everything now goes through one thread-safe pool:
+
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            ...
+
+The transaction is committed when the block exits normally and rolled back on an exception,
+then the connection goes back to the pool. Connections that sat idle for longer than
+DB_POOL_HEALTH_CHECK_SECONDS are checked with SELECT 1 before being handed out, and broken
+ones are replaced. When every connection is busy, callers wait up to DB_POOL_TIMEOUT seconds.
+
+Configuration (.env):
+
+DATABASE_URL=               # preferred, used by extract_data.py so far
+DB_NAME= DB_HOST= DB_PORT= DB_USER= DB_PASSWORD=    # used when DATABASE_URL is not set
+
+DB_POOL_MIN=
+DB_POOL_MAX=
+DB_POOL_TIMEOUT=
+DB_POOL_HEALTH_CHECK_SECONDS=
+ASYNC_DB_POOL_MAX=          # asyncpg pool of the async execution mode, see create_async_pool
+"""
+
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.pool
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+DB_CONFIG = {
+    "dbname": os.getenv("DB_NAME"),
+    "host": os.getenv("DB_HOST"),
+    "port": os.getenv("DB_PORT"),
+    "user": os.getenv("DB_USER"),
+    "password": os.getenv("DB_PASSWORD"),
+}
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no pooled connection became free within the checkout timeout."""
+
+
+class ConnectionPool:
+    """Thread-safe psycopg2 pool with bounded waiting, health checks and checkout timings."""
+
+    def __init__(self, minconn, maxconn, timeout, health_check_seconds, dsn=None, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_seconds = health_check_seconds
+        self.dsn = dsn
+        self.connect_kwargs = connect_kwargs
+
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.replaced_connections = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.total_hold_seconds = 0.0
+
+    def _get_pool(self):
+        # Created on first use so importing a module never opens a connection
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = psycopg2.pool.ThreadedConnectionPool(self.minconn, self.maxconn, dsn=self.dsn, **self.connect_kwargs)
+            return self._pool
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(id(conn), 0) < self.health_check_seconds:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._stats_lock:
+                self.timeouts += 1
+            raise PoolTimeoutError(f"No database connection available after {self.timeout} seconds")
+        try:
+            pool = self._get_pool()
+            conn = pool.getconn()
+            if not self._is_healthy(conn):
+                logging.warning("Replacing broken pooled database connection")
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+                with self._stats_lock:
+                    self.replaced_connections += 1
+        except Exception:
+            self._slots.release()
+            raise
+
+        waited = time.monotonic() - started
+        with self._stats_lock:
+            self.checkouts += 1
+            self.total_wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        return conn
+
+    def putconn(self, conn, held_seconds=0.0):
+        try:
+            if not conn.closed:
+                conn.autocommit = False  # Reset anything a caller changed
+            self._last_used[id(conn)] = time.monotonic()
+            self._get_pool().putconn(conn, close=bool(conn.closed))
+        finally:
+            self._slots.release()
+            with self._stats_lock:
+                self.total_hold_seconds += held_seconds
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        checked_out = time.monotonic()
+        try:
+            yield conn
+            if not conn.closed and not conn.autocommit:
+                conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            held = time.monotonic() - checked_out
+            logging.debug(f"DB connection held for {held * 1000:.1f} ms")
+            self.putconn(conn, held)
+
+    def stats(self):
+        with self._stats_lock:
+            checkouts = self.checkouts or 1
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "replaced_connections": self.replaced_connections,
+                "avg_wait_ms": round(self.total_wait_seconds / checkouts * 1000, 3),
+                "max_wait_ms": round(self.max_wait_seconds * 1000, 3),
+                "avg_hold_ms": round(self.total_hold_seconds / checkouts * 1000, 3),
+                "min_size": self.minconn,
+                "max_size": self.maxconn,
+            }
+
+    def closeall(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+
+if DATABASE_URL:
+    _connect_args = {"dsn": DATABASE_URL}
+else:
+    _connect_args = {key: value for key, value in DB_CONFIG.items() if value}
+
+pool = ConnectionPool(
+    minconn=int(os.getenv("DB_POOL_MIN", "1")),
+    maxconn=int(os.getenv("DB_POOL_MAX", "20")),
+    timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+    health_check_seconds=float(os.getenv("DB_POOL_HEALTH_CHECK_SECONDS", "30")),
+    **_connect_args,
+)
+
+
+# Check out a pooled connection for the duration of a with block.
+def db_connection():
+    return pool.connection()
+
+
+# asyncpg pool with the same connection settings, for the async execution mode (ocr.py).
+# asyncpg pools belong to the event loop that created them, so every async run creates and closes its own.
+async def create_async_pool():
+    import asyncpg  # Only needed for the async execution mode
+    max_size = int(os.getenv("ASYNC_DB_POOL_MAX", "10"))
+    if DATABASE_URL:
+        return await asyncpg.create_pool(dsn=DATABASE_URL, min_size=1, max_size=max_size)
+    return await asyncpg.create_pool(
+        database=DB_CONFIG["dbname"], host=DB_CONFIG["host"], port=DB_CONFIG["port"],
+        user=DB_CONFIG["user"], password=DB_CONFIG["password"], min_size=1, max_size=max_size,
+    )
@@ -0,0 +1,345 @@
+"""
+Document AI asynchronous batch processing backend.
+
+Instead of one synchronous process_document call per file (or per 15 page chunk), a whole
+project is submitted as a single batch_process_documents long-running operation:
+
+  1. every PDF is uploaded to a storage bucket under <prefix>/input/<run_id>/
+  2. one BatchProcessRequest is sent for all of them, with output under <prefix>/output/<run_id>/
+  3. the operation is polled until it is done
+  4. the (possibly sharded) JSON outputs of each document are downloaded and merged into the
+     same {"text", "confidence_scores"} structure as the synchronous path
+  5. the input files and output shards are deleted, also when the run fails
+     (an operation still running after a timeout may write outputs after that; a bucket lifecycle
+     rule on <prefix>/ is the backstop for those)
+
+Confidences are taken at OCR_CONFIDENCE_GRANULARITY (ocr_providers.py), like the online path, so batch
+results fit the OCR cache namespace they are stored under.
+
+Batch mode has no 20 MB / 15 page limit, so no splitting is needed.
+
+Two implementations are provided for both the bucket and the operation API:
+  GcsStorage + DocumentProcessorServiceClient     the real services (needs google-cloud-storage)
+  LocalStorage + LocalBatchProcessClient          a filesystem stand-in for offline testing;
+                                                  it "processes" PDFs with a local function
+                                                  (the PyPDF2 text layer by default) and writes
+                                                  sharded outputs laid out like Document AI's.
+
+Configuration (.env):
+
+DOCAI_BATCH_BUCKET=          # GCS bucket used for input and output
+DOCAI_BATCH_PREFIX=          # object name prefix inside the bucket
+DOCAI_BATCH_LOCAL_DIR=       # when set, use the local stand-in rooted at this folder instead of GCS
+DOCAI_BATCH_POLL_SECONDS=
+DOCAI_BATCH_TIMEOUT_SECONDS=
+"""
+
+import io
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from types import SimpleNamespace
+
+from google.cloud import documentai_v1 as documentai
+from PyPDF2 import PdfReader
+
+from ocr_providers import LAYOUT_ELEMENTS, OCR_CONFIDENCE_GRANULARITY
+
+
+DOCAI_BATCH_BUCKET = os.getenv("DOCAI_BATCH_BUCKET")
+DOCAI_BATCH_PREFIX = os.getenv("DOCAI_BATCH_PREFIX", "titlemine-batch-ocr")
+DOCAI_BATCH_LOCAL_DIR = os.getenv("DOCAI_BATCH_LOCAL_DIR")
+DOCAI_BATCH_POLL_SECONDS = float(os.getenv("DOCAI_BATCH_POLL_SECONDS", "10"))
+DOCAI_BATCH_TIMEOUT_SECONDS = float(os.getenv("DOCAI_BATCH_TIMEOUT_SECONDS", "3600"))
+
+
+# Split "gs://bucket/some/name" into ("bucket", "some/name").
+def split_uri(uri):
+    _, _, rest = uri.partition("://")
+    bucket, _, name = rest.partition("/")
+    return bucket, name
+
+
+class GcsStorage:
+    """Google Cloud Storage bucket used for batch input and output."""
+
+    def __init__(self, bucket_name):
+        from google.cloud import storage  # Only needed for the real batch backend
+        self.bucket_name = bucket_name
+        self.bucket = storage.Client().bucket(bucket_name)
+
+    def uri(self, name):
+        return f"gs://{self.bucket_name}/{name}"
+
+    def upload_file(self, name, file_path):
+        self.bucket.blob(name).upload_from_filename(file_path, content_type="application/pdf")
+        return self.uri(name)
+
+    def list(self, prefix):
+        return [blob.name for blob in self.bucket.list_blobs(prefix=prefix)]
+
+    def download(self, name):
+        return self.bucket.blob(name).download_as_bytes()
+
+    def delete_prefix(self, prefix):
+        for name in self.list(prefix):
+            self.bucket.blob(name).delete()
+
+
+class LocalStorage:
+    """Filesystem stand-in for a bucket: object names are paths under root_dir."""
+
+    def __init__(self, root_dir, bucket_name="local-bucket"):
+        self.root_dir = root_dir
+        self.bucket_name = bucket_name
+        os.makedirs(root_dir, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.root_dir, *name.split("/"))
+
+    def uri(self, name):
+        return f"gs://{self.bucket_name}/{name}"
+
+    def upload_file(self, name, file_path):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(file_path, "rb") as source, open(path, "wb") as target:
+            target.write(source.read())
+        return self.uri(name)
+
+    def write(self, name, data):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(data)
+
+    def list(self, prefix):
+        names = []
+        for root, _, files in os.walk(self.root_dir):
+            for file_name in files:
+                name = os.path.relpath(os.path.join(root, file_name), self.root_dir).replace(os.sep, "/")
+                if name.startswith(prefix):
+                    names.append(name)
+        return sorted(names)
+
+    def download(self, name):
+        with open(self._path(name), "rb") as file:
+            return file.read()
+
+    def delete_prefix(self, prefix):
+        for name in self.list(prefix):
+            os.remove(self._path(name))
+
+
+# Default "processor" of the local stand-in: the embedded PDF text layer, one element per page at every
+# layout level. A process_content function returns {"text", "pages"} where every page has Document AI
+# style "blocks" (and "paragraphs", "lines", "tokens") and a "span" [start, end) of its text, used to cut
+# the output into shards.
+def text_layer_document(content):
+    reader = PdfReader(io.BytesIO(content))
+    pages = []
+    text = ""
+    for page in reader.pages:
+        page_text = (page.extract_text() or "") + "\n"
+        start = len(text)
+        text += page_text
+        element = {"layout": {
+            "textAnchor": {"textSegments": [{"startIndex": str(start), "endIndex": str(len(text))}]},
+            "confidence": 1.0,
+        }}
+        pages.append({"span": [start, len(text)], **{elements: [element] for elements in LAYOUT_ELEMENTS.values()}})
+    return {"text": text, "pages": pages}
+
+
+class LocalOperation:
+    """Minimal stand-in for google.api_core.operation.Operation."""
+
+    def __init__(self, name, target):
+        self.operation = SimpleNamespace(name=name)
+        self.metadata = SimpleNamespace(individual_process_statuses=[])
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(target,), daemon=True)
+        self._thread.start()
+
+    def _run(self, target):
+        try:
+            target(self.metadata)
+        except Exception as e:
+            self._error = e
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def result(self, timeout=None):
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            raise TimeoutError(f"Operation {self.operation.name} did not finish in {timeout} seconds")
+        if self._error is not None:
+            raise self._error
+        return SimpleNamespace()
+
+
+class LocalBatchProcessClient:
+    """Filesystem stand-in for DocumentProcessorServiceClient.batch_process_documents.
+
+    Reads the input PDFs from a LocalStorage, runs process_content on each one after an optional
+    delay, and writes <output>/<operation_id>/<input_index>/<name>-<shard>.json shards of
+    pages_per_shard pages with shardInfo, like the real service.
+    """
+
+    def __init__(self, storage, process_content=text_layer_document, pages_per_shard=10, delay_seconds=0.0):
+        self.storage = storage
+        self.process_content = process_content
+        self.pages_per_shard = pages_per_shard
+        self.delay_seconds = delay_seconds
+
+    def batch_process_documents(self, request):
+        operation_id = uuid.uuid4().hex[:16]
+        input_uris = [document.gcs_uri for document in request.input_documents.gcs_documents.documents]
+        output_uri = request.document_output_config.gcs_output_config.gcs_uri.rstrip("/")
+
+        def run(metadata):
+            time.sleep(self.delay_seconds)
+            for index, input_uri in enumerate(input_uris):
+                destination = f"{output_uri}/{operation_id}/{index}"
+                status = SimpleNamespace(input_gcs_source=input_uri, output_gcs_destination=destination,
+                                         status=SimpleNamespace(code=0, message=""))
+                try:
+                    self._write_shards(input_uri, destination)
+                except Exception as e:
+                    status.status = SimpleNamespace(code=13, message=str(e))
+                metadata.individual_process_statuses.append(status)
+
+        return LocalOperation(f"operations/{operation_id}", run)
+
+    def _write_shards(self, input_uri, destination):
+        document = self.process_content(self.storage.download(split_uri(input_uri)[1]))
+        base_name = os.path.splitext(os.path.basename(input_uri))[0]
+        _, destination_name = split_uri(destination)
+
+        pages = document["pages"] or [{"span": [0, len(document["text"])], "blocks": []}]
+        shards = [pages[i:i + self.pages_per_shard] for i in range(0, len(pages), self.pages_per_shard)]
+        for shard_index, shard_pages in enumerate(shards):
+            # Shard text holds only its own pages; anchors are relative to the shard text
+            text_offset = shard_pages[0]["span"][0]
+            text_end = shard_pages[-1]["span"][1]
+            shard_document = {
+                "text": document["text"][text_offset:text_end],
+                "pages": [shift_page_anchors({elements: page[elements] for elements in LAYOUT_ELEMENTS.values() if elements in page},
+                                             -text_offset) for page in shard_pages],
+                "shardInfo": {"shardIndex": str(shard_index), "shardCount": str(len(shards)), "textOffset": str(text_offset)},
+            }
+            self.storage.write(f"{destination_name}/{base_name}-{shard_index}.json", json.dumps(shard_document).encode("utf-8"))
+
+
+def shift_page_anchors(page, offset):
+    page = json.loads(json.dumps(page))
+    for elements in LAYOUT_ELEMENTS.values():
+        for element in page.get(elements, []):
+            for segment in element["layout"]["textAnchor"]["textSegments"]:
+                segment["startIndex"] = str(int(segment.get("startIndex", 0)) + offset)
+                segment["endIndex"] = str(int(segment.get("endIndex", 0)) + offset)
+    return page
+
+
+# Merge the JSON shards of one document into {"text", "confidence_scores"} with global offsets, with the
+# confidences of the layout elements at granularity (OCR_CONFIDENCE_GRANULARITY by default), like the online path.
+def merge_shards(shard_documents, granularity=None):
+    elements = LAYOUT_ELEMENTS[granularity or OCR_CONFIDENCE_GRANULARITY]
+    shard_documents = sorted(shard_documents, key=lambda doc: int(doc.get("shardInfo", {}).get("shardIndex", 0)))
+    extracted_data = {"text": "", "confidence_scores": []}
+    text_parts = []
+    text_length = 0
+    for shard in shard_documents:
+        shard_text = shard.get("text", "")
+        text_offset = int(shard.get("shardInfo", {}).get("textOffset", text_length))
+        for page in shard.get("pages", []):
+            for element in page.get(elements, []):
+                layout = element.get("layout", {})
+                for segment in layout.get("textAnchor", {}).get("textSegments", []):
+                    start_index = int(segment.get("startIndex", 0))
+                    end_index = int(segment.get("endIndex", 0))
+                    extracted_data["confidence_scores"].append({
+                        "text": shard_text[start_index:end_index],
+                        "confidence": layout.get("confidence", 0.0),
+                        "start_index": text_offset + start_index,
+                        "end_index": text_offset + end_index,
+                    })
+        text_parts.append(shard_text)
+        text_length = text_offset + len(shard_text)
+    extracted_data["text"] = "".join(text_parts)
+    return extracted_data
+
+
+def build_batch_request(processor_name, input_uris, output_uri):
+    documents = [documentai.GcsDocument(gcs_uri=uri, mime_type="application/pdf") for uri in input_uris]
+    return documentai.BatchProcessRequest(
+        name=processor_name,
+        input_documents=documentai.BatchDocumentsInputConfig(gcs_documents=documentai.GcsDocuments(documents=documents)),
+        document_output_config=documentai.DocumentOutputConfig(
+            gcs_output_config=documentai.DocumentOutputConfig.GcsOutputConfig(gcs_uri=output_uri)
+        ),
+    )
+
+
+# Storage and client for the configured backend: the local stand-in when DOCAI_BATCH_LOCAL_DIR is set.
+def create_batch_backend():
+    if DOCAI_BATCH_LOCAL_DIR:
+        storage = LocalStorage(DOCAI_BATCH_LOCAL_DIR)
+        return storage, LocalBatchProcessClient(storage)
+    if not DOCAI_BATCH_BUCKET:
+        raise ValueError("DOCAI_BATCH_BUCKET or DOCAI_BATCH_LOCAL_DIR must be set for batch OCR mode.")
+    return GcsStorage(DOCAI_BATCH_BUCKET), documentai.DocumentProcessorServiceClient()
+
+
+# OCR many local PDFs with one batch operation. Returns {file_path: extracted_data}; failed documents are left out.
+def run_batch_ocr(file_paths, processor_name, storage=None, client=None,
+                  poll_seconds=None, timeout_seconds=None):
+    if not file_paths:
+        return {}
+    if storage is None or client is None:
+        storage, client = create_batch_backend()
+    poll_seconds = DOCAI_BATCH_POLL_SECONDS if poll_seconds is None else poll_seconds
+    timeout_seconds = DOCAI_BATCH_TIMEOUT_SECONDS if timeout_seconds is None else timeout_seconds
+
+    run_id = uuid.uuid4().hex[:12]
+    input_prefix = f"{DOCAI_BATCH_PREFIX}/input/{run_id}"
+    output_prefix = f"{DOCAI_BATCH_PREFIX}/output/{run_id}"
+
+    # Inputs and outputs are deleted whatever happens, so a failed run leaves nothing in the bucket
+    try:
+        uri_to_path = {}
+        for file_path in file_paths:
+            uri = storage.upload_file(f"{input_prefix}/{os.path.basename(file_path)}", file_path)
+            uri_to_path[uri] = file_path
+        logging.info(f"Uploaded {len(file_paths)} files for batch OCR run {run_id}")
+
+        request = build_batch_request(processor_name, list(uri_to_path), storage.uri(output_prefix))
+        operation = client.batch_process_documents(request=request)
+        logging.info(f"Batch OCR operation started: {operation.operation.name}")
+
+        started = time.monotonic()
+        while not operation.done():
+            if time.monotonic() - started > timeout_seconds:
+                raise TimeoutError(f"Batch OCR run {run_id} did not finish in {timeout_seconds} seconds")
+            time.sleep(poll_seconds)
+        operation.result(timeout=0)
+        logging.info(f"Batch OCR run {run_id} finished in {time.monotonic() - started:.1f}s")
+
+        results = {}
+        for status in operation.metadata.individual_process_statuses:
+            file_path = uri_to_path.get(status.input_gcs_source)
+            if status.status.code != 0:
+                logging.error(f"Batch OCR failed for {file_path}: {status.status.message}")
+                continue
+            _, output_name = split_uri(status.output_gcs_destination)
+            shard_names = [name for name in storage.list(output_name + "/") if name.endswith(".json")]
+            shards = [json.loads(storage.download(name)) for name in shard_names]
+            results[file_path] = merge_shards(shards)
+        return results
+    finally:
+        storage.delete_prefix(input_prefix + "/")
+        storage.delete_prefix(output_prefix + "/")
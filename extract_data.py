@@ -1,224 +1,557 @@
 import os
 import json
 import psycopg2
+import psycopg2.extras
 from dotenv import load_dotenv
 import openai
 from datetime import datetime
 import concurrent.futures
 import logging
+import threading
+import time
+import asyncio
+import weakref
 from flask import Flask, jsonify
+from rate_limiter import openai_limiter
+from llm_cache import create_llm_cache, make_cache_key
+from db import db_connection
+from scheduler import scheduler
+from jobs import report_progress
+import metrics
+from ocr_format import FORMAT_VERSION as OCR_FORMAT_VERSION, migrate_ocr_row
+from prompt_registry import prompt_registry, DOCUMENT_MESSAGE, WINDOW_NOTE
+from long_document import TokenBudget, estimate_text_tokens, instrument_prefix, is_long_document, resolve_fields, split_windows
+from migrate_runsheets import RUNSHEETS_UNIQUE_INDEX, runsheets_unique_index_exists
+from instrument_classifier import INSTRUMENT_CLASSIFIER, INSTRUMENT_CLASSIFIER_MIN_CONFIDENCE, instrument_classifier
 
 # Load environment variables
 load_dotenv()
 
-# Configuration class
-class Config:
-    DATABASE_URL = os.getenv("DATABASE_URL")
-    if not DATABASE_URL:
-        raise ValueError("DATABASE_URL environment variable is missing.")
-
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Function to get a database connection
-def get_db_connection():
-    try:
-        return psycopg2.connect(Config.DATABASE_URL)
-    except Exception as e:
-        logging.error(f"Error getting DB connection: {e}")
+# OpenAI configuration
+OPENAI_MODEL = "gpt-4o-mini"
+# Retries are handled by create_chat_completion, so the SDK itself should not sleep on 429s: they go to the
+# adaptive limiter. Other transient errors (connection errors, timeouts, 408/409/5xx, which the SDK retried
+# twice by default) are retried OPENAI_ERROR_RETRIES times with exponential back-off.
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "0"))
+OPENAI_RATE_LIMIT_RETRIES = int(os.getenv("OPENAI_RATE_LIMIT_RETRIES", "6"))
+OPENAI_ERROR_RETRIES = int(os.getenv("OPENAI_ERROR_RETRIES", "2"))
+OPENAI_RETRY_BASE_SECONDS = float(os.getenv("OPENAI_RETRY_BASE_SECONDS", "0.5"))
+OPENAI_RETRY_MAX_SECONDS = float(os.getenv("OPENAI_RETRY_MAX_SECONDS", "8"))
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+_async_openai_clients = weakref.WeakKeyDictionary()  # AsyncOpenAI connection pools belong to one event loop
+
+# Function to get the shared OpenAI client
+def get_openai_client():
+    global _openai_client
+    with _openai_client_lock:
+        if _openai_client is None:
+            _openai_client = openai.OpenAI(max_retries=OPENAI_MAX_RETRIES)
+        return _openai_client
+
+# Function to get the AsyncOpenAI client of the running event loop (async execution mode)
+def get_async_openai_client():
+    loop = asyncio.get_running_loop()
+    with _openai_client_lock:
+        client = _async_openai_clients.get(loop)
+        if client is None:
+            client = _async_openai_clients[loop] = openai.AsyncOpenAI(max_retries=OPENAI_MAX_RETRIES)
+        return client
+
+# Rough token estimate for a chat request: ~4 characters per token plus room for the answer
+def estimate_tokens(messages, completion_tokens=500):
+    return sum(len(message["content"]) for message in messages) // 4 + completion_tokens
+
+# Function to call chat.completions through the adaptive rate limiter.
+# 429s shrink the limiter's budgets and the call is retried once the limiter lets it through again;
+# other transient errors are retried after a back-off (see on_openai_error).
+def create_chat_completion(prompt_name=None, **kwargs):
+    client = get_openai_client()
+    estimated_tokens = estimate_tokens(kwargs["messages"])
+    rate_limited = errors = 0
+    while rate_limited <= OPENAI_RATE_LIMIT_RETRIES:
+        scheduler.throttle("openai")
+        openai_limiter.acquire(estimated_tokens)
+        started = time.monotonic()
+        try:
+            raw_response = client.chat.completions.with_raw_response.create(**kwargs)
+        except openai.RateLimitError as e:
+            on_openai_rate_limited(e, estimated_tokens, rate_limited)
+            rate_limited += 1
+            continue
+        except Exception as e:
+            delay = on_openai_error(e, estimated_tokens, errors)
+            if delay is None:
+                raise
+            errors += 1
+            time.sleep(delay)
+            continue
+        return on_openai_completion(raw_response, estimated_tokens, prompt_name, kwargs["model"], started)
+    raise RuntimeError(f"OpenAI rate limit retries exhausted after {OPENAI_RATE_LIMIT_RETRIES + 1} attempts")
+
+# create_chat_completion for the async execution mode: AsyncOpenAI behind the same limiter and quotas.
+async def create_chat_completion_async(prompt_name=None, **kwargs):
+    client = get_async_openai_client()
+    estimated_tokens = estimate_tokens(kwargs["messages"])
+    rate_limited = errors = 0
+    while rate_limited <= OPENAI_RATE_LIMIT_RETRIES:
+        await scheduler.throttle_async("openai")
+        await openai_limiter.acquire_async(estimated_tokens)
+        started = time.monotonic()
+        try:
+            raw_response = await client.chat.completions.with_raw_response.create(**kwargs)
+        except openai.RateLimitError as e:
+            on_openai_rate_limited(e, estimated_tokens, rate_limited)
+            rate_limited += 1
+            continue
+        except Exception as e:
+            delay = on_openai_error(e, estimated_tokens, errors)
+            if delay is None:
+                raise
+            errors += 1
+            await asyncio.sleep(delay)
+            continue
+        return on_openai_completion(raw_response, estimated_tokens, prompt_name, kwargs["model"], started)
+    raise RuntimeError(f"OpenAI rate limit retries exhausted after {OPENAI_RATE_LIMIT_RETRIES + 1} attempts")
+
+def on_openai_rate_limited(error, estimated_tokens, attempt):
+    headers = error.response.headers if getattr(error, "response", None) is not None else None
+    openai_limiter.on_rate_limited(estimated_tokens, headers)
+    metrics.rate_limited_total.inc(provider="openai")
+    logging.warning(f"OpenAI rate limit hit (attempt {attempt + 1}): {error}")
+
+# Record a failed call. Returns the back-off before retrying it, or None when the error is not
+# transient or its OPENAI_ERROR_RETRIES retries are used up.
+def on_openai_error(error, estimated_tokens, retries):
+    openai_limiter.on_error(estimated_tokens)
+    metrics.errors_total.inc(stage="openai")
+    transient = isinstance(error, (openai.APIConnectionError, openai.InternalServerError)) or (
+        isinstance(error, openai.APIStatusError) and error.status_code in (408, 409))
+    if not transient or retries >= OPENAI_ERROR_RETRIES:
         return None
+    delay = min(OPENAI_RETRY_MAX_SECONDS, OPENAI_RETRY_BASE_SECONDS * 2 ** retries)
+    logging.warning(f"OpenAI call failed (retry {retries + 1}/{OPENAI_ERROR_RETRIES} in {delay:.1f}s): {error}")
+    return delay
+
+def on_openai_completion(raw_response, estimated_tokens, prompt_name, model, started):
+    completion = raw_response.parse()
+    used_tokens = completion.usage.total_tokens if completion.usage else None
+    openai_limiter.on_success(estimated_tokens, used_tokens, raw_response.headers)
+    prompt_registry.record_usage(prompt_name or model, completion.usage)
+    record_openai_metrics(prompt_name, time.monotonic() - started, completion.usage)
+    return completion
+
+# Latency and token histograms of one call, labeled by stage ("instrument_type", "extraction") and instrument type.
+def record_openai_metrics(prompt_name, seconds, usage):
+    stage, _, instrument_type = (prompt_name or "other").partition(":")
+    metrics.openai_request_seconds.observe(seconds, stage=stage, instrument_type=instrument_type)
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    token_counts = {
+        "prompt": usage.prompt_tokens,
+        "completion": usage.completion_tokens,
+        "cached": (getattr(details, "cached_tokens", 0) or 0) if details is not None else 0,
+    }
+    for kind, tokens in token_counts.items():
+        metrics.openai_tokens.observe(tokens or 0, stage=stage, instrument_type=instrument_type, kind=kind)
+
+# Function to check out a connection from the shared pool (see db.py).
+# Use it as a context manager: the connection is committed and returned to the pool on exit.
+def get_db_connection():
+    return db_connection()
 
+# Cache of OpenAI responses, see llm_cache.py for the backends
+llm_cache = create_llm_cache(get_db_connection)
+
+# Fetch the OCR text of a file. Only the text is read (ocr_json_1->>'text'), never the confidence data;
+# rows still in the legacy ocr_json_1 format are migrated to the compact format on the way (see ocr_format.py).
+# Returns (id, file_id, project_id, {"text": ...}, error).
 def fetch_ocr_text(file_id):
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return None, None, None, None, "Database connection error"
-
-        with conn:
+        with get_db_connection() as conn:
             with conn.cursor() as cur:
-                query = "SELECT id, file_id, project_id, ocr_json_1 FROM ocr_data WHERE file_id = %s"
+                query = "SELECT id, file_id, project_id, ocr_json_1::jsonb->>'format', ocr_json_1::jsonb->>'text' FROM ocr_data WHERE file_id = %s"
                 cur.execute(query, (file_id,))
                 response = cur.fetchone()
 
                 if not response:
                     return None, None, None, None, "file_id not found in ocr_data table"
 
-                id_db, file_id_from_db, project_id, ocr_json_1 = response
+                id_db, file_id_from_db, project_id, ocr_format_version, ocr_text = response
 
-                try:
-                    ocr_data = json.loads(ocr_json_1) if isinstance(ocr_json_1, str) else ocr_json_1
-                    return id_db, file_id_from_db, project_id, ocr_data, None
-                except json.JSONDecodeError:
-                    return id_db, file_id_from_db, project_id, None, "Invalid JSON format"
+        try:
+            ocr_text = ocr_text_for_row(id_db, ocr_format_version, ocr_text)
+        except (json.JSONDecodeError, TypeError):
+            return id_db, file_id_from_db, project_id, None, "Invalid JSON format"
+        if ocr_text is None:
+            return id_db, file_id_from_db, project_id, None, None
+        return id_db, file_id_from_db, project_id, {"text": ocr_text}, None
 
     except Exception as e:
         logging.error(f"Error fetching OCR text: {e}")
         return None, None, None, None, f"Error: {e}"
 
-def extract_instrument_type(ocr_text):
+# Text of an ocr_data row given its ocr_json_1->>'format' and ocr_json_1->>'text' values.
+# Legacy rows are rewritten to the compact format and their (possibly merged) text is returned.
+def ocr_text_for_row(ocr_row_id, ocr_format_version, ocr_text):
+    if ocr_format_version == str(OCR_FORMAT_VERSION):
+        return ocr_text
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            ocr_text = migrate_ocr_row(cur, ocr_row_id)
+    logging.info(f"Migrated ocr_data row {ocr_row_id} to the compact ocr_json_1 format")
+    return ocr_text
+
+# Prompt, document message and cache key of the instrument type request of a document.
+def instrument_type_request(ocr_text):
+    compiled = prompt_registry.instrument_type_prompt
+    document_message = DOCUMENT_MESSAGE.format(ocr_text=instrument_prefix(ocr_text))
+    return compiled, document_message, make_cache_key(OPENAI_MODEL, compiled.system, compiled.instructions, document_message)
+
+# Answer of the local classifier (instrument_classifier.py), or None when the LLM has to decide.
+def local_instrument_type(ocr_text):
+    if INSTRUMENT_CLASSIFIER == "llm":
+        return None
+    label, confidence, _ = instrument_classifier.classify(ocr_text)
+    if INSTRUMENT_CLASSIFIER == "local" or confidence >= INSTRUMENT_CLASSIFIER_MIN_CONFIDENCE:
+        logging.info(f"Local classifier instrument_type: {label} (confidence {confidence})")
+        metrics.instrument_classifications_total.inc(source="local")
+        return {"instrument_type": label, "confidence": confidence}
+    logging.info(f"Local classifier not confident ({label}, {confidence}), asking the LLM")
+    return None
+
+class LlmRequest:
+    """A chat completion to send, or the answer that makes it unnecessary (cache hit, local
+    classifier, exhausted token budget). Built by the shared steps of the sync and async paths."""
+
+    def __init__(self, answer=None, cache_key=None, kwargs=None, estimated_tokens=0):
+        self.answer = answer
+        self.cache_key = cache_key
+        self.kwargs = kwargs
+        self.estimated_tokens = estimated_tokens
+
+# Cached answer of a request, or None.
+def cached_answer(cache_key, label):
+    cached_response = llm_cache.get(cache_key)
+    if cached_response is not None:
+        logging.info(f"LLM cache hit for {label}: {cached_response}")
+    return cached_response
+
+# The instrument type request of a document: the local classifier answers first, then the LLM cache.
+def instrument_type_llm_request(ocr_text):
+    local_answer = local_instrument_type(ocr_text)
+    if local_answer is not None:
+        return LlmRequest(answer=local_answer)
+    metrics.instrument_classifications_total.inc(source="llm")
+
+    compiled, document_message, cache_key = instrument_type_request(ocr_text)
+    kwargs = {"model": OPENAI_MODEL, "messages": compiled.messages(document_message), "prompt_name": compiled.name}
+    return LlmRequest(cached_answer(cache_key, "instrument_type"), cache_key, kwargs)
+
+def extract_instrument_type(ocr_text, budget=None):
     """
     Extracts the instrument type from the provided OCR text using OpenAI's GPT-4o-mini.
+    Only the first INSTRUMENT_PREFIX_CHARS characters of the document are sent.
+    The local classifier answers first; the LLM is only asked when it is not confident enough.
     """
-    client = openai.OpenAI()
+    request = instrument_type_llm_request(ocr_text)
+    if request.answer is not None:
+        return request.answer
 
-    system_prompt = """
-    You are a legal expert extraction algorithm specializing in property law and land transactions.
-    Extract the following details from the provided legal land document and provide output in valid JSON format.
-    """
+    try:
+        completion = create_chat_completion(**request.kwargs)
+        return instrument_type_answer(completion, request.cache_key, budget)
 
-    user_prompt_doc_type = f"""
-    Extract legal information from the following document:\n\n{ocr_text}. 
-    Carefully analyze the first few lines of the document to determine the instrument type.
-    Instrument Type can be one of following: Deed, Lease, Release, Waiver, Quitclaim, Option, Easement or Right of Way, Ratification, Affidavit, Probate, Will and Testament, Death Certificate, Obituary, Divorce, Adoption, Court Case, Assignment or Other. 
-    If the type is an amendment, return what kind of instrument it is amending.
-    If the instrument type is not explicitly stated, return "Other".
-    Please return the result as a JSON object with a key named "instrument_type".
-    """
+    except Exception as e:
+        logging.error(f"Error communicating with OpenAI: {e}")
+        return {"error": f"OpenAI API error: {e}"}
 
+# Parse and cache the answer of an instrument type completion, charging its tokens to the budget.
+def instrument_type_answer(completion, cache_key, budget):
+    resp = completion_content(completion)
+    total_tokens = completion.usage.total_tokens
+    logging.info(f"Total Token used for instrument_type: {total_tokens}")
+    if budget is not None:
+        budget.charge(total_tokens)
+    try:
+        json_resp = json.loads(resp)
+        logging.info(json_resp)
+        llm_cache.put(cache_key, json_resp)
+        return json_resp
+    except json.JSONDecodeError as e:
+        logging.error(f"Error parsing JSON: {e}")
+        return {"error": "Invalid JSON response from OpenAI", "raw_response": resp}
+
+EXTRACTION_FIELDS = [
+    "instrument_type",
+    "volume_page",
+    "document_case_number",
+    "execution_date",
+    "effective_date",
+    "recording_date",
+    "grantee",
+    "grantor",
+    "property_description"
+]
+
+EXTRACTION_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "document_extraction",
+        "schema": {
+            "type": "object",
+            "properties": {field: {"type": "string"} for field in EXTRACTION_FIELDS},
+            "required": EXTRACTION_FIELDS,
+            "additionalProperties": False
+        },
+        "strict": True
+    }
+}
+
+# The request of one field extraction prompt: a cache hit, or the completion to send with its estimated
+# size reserved against the document's token budget (an error answer when the budget is exhausted).
+def extraction_request(compiled, document_message, budget, label):
+    cache_key = make_cache_key(OPENAI_MODEL, compiled.system, compiled.instructions, document_message)
+    cached_response = cached_answer(cache_key, label)
+    if cached_response is not None:
+        return LlmRequest(answer=cached_response)
+
+    messages = compiled.messages(document_message)
+    estimated_tokens = estimate_tokens(messages)
+    if not budget.reserve(estimated_tokens):
+        logging.warning(f"Token budget exhausted, skipping {label} (~{estimated_tokens} tokens, {budget.report()})")
+        return LlmRequest(answer={"error": "Token budget exceeded"})
+    kwargs = {"model": OPENAI_MODEL, "messages": messages, "response_format": EXTRACTION_RESPONSE_FORMAT,
+              "prompt_name": compiled.name}
+    return LlmRequest(cache_key=cache_key, kwargs=kwargs, estimated_tokens=estimated_tokens)
+
+# Sends one field extraction prompt, reserving its estimated size against the document's token budget.
+def extract_fields(compiled, document_message, budget, label="data extraction"):
+    request = extraction_request(compiled, document_message, budget, label)
+    if request.answer is not None:
+        return request.answer
+
+    used_tokens = None
     try:
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "system", "content": system_prompt},
-                      {"role": "user", "content": user_prompt_doc_type}]
-        )
-
-        resp = completion.choices[0].message.content.strip("```").lstrip("json\n").strip()
-        total_tokens = completion.usage.total_tokens
-        logging.info(f"Total Token used for instrument_type: {total_tokens}")
+        completion = create_chat_completion(**request.kwargs)
+        used_tokens = completion.usage.total_tokens
+    finally:
+        budget.settle(request.estimated_tokens, used_tokens)
+    return extraction_answer(completion, request.cache_key, label)
+
+# Parse and cache the answer of a field extraction completion.
+def extraction_answer(completion, cache_key, label):
+    result = completion.choices[0].message.content
+    logging.info(result)
+    logging.info(f"Total Token used for {label}: {completion.usage.total_tokens}")
+    try:
+        result_json = json.loads(result)
+        llm_cache.put(cache_key, result_json)
+        return result_json
+    except json.JSONDecodeError as e:
+        logging.error(f"Error parsing json from LLM: {e}")
+        return {"error": "Invalid JSON response from OpenAI", "raw_response": result}
+
+# Answer text of a completion without the markdown code fence the model sometimes adds.
+def completion_content(completion):
+    return completion.choices[0].message.content.strip("```").lstrip("json\n").strip()
+
+def window_message(window_number, window_count, window_text):
+    return (WINDOW_NOTE.format(window_number=window_number, window_count=window_count)
+            + DOCUMENT_MESSAGE.format(ocr_text=window_text))
+
+# Resolve one value per field from the answers of the windows of a long document. Every window must
+# have an answer: a runsheet resolved from part of the pages would look complete, so a document with a
+# missing window (token budget exhausted, failed call) is an error and stays 'Extracting'. The answers
+# that did arrive are in the LLM cache, so the next run only sends the missing windows.
+def merge_windows(window_results, instrument_type, window_count):
+    extracted = [result for result in window_results if isinstance(result, dict) and "error" not in result]
+    if len(extracted) < window_count:
+        errors = sorted({str(result["error"]) for result in window_results if isinstance(result, dict) and "error" in result})
+        return {"error": f"{window_count - len(extracted)} of {window_count} windows of the document could not be extracted"
+                         + (f": {'; '.join(errors)}" if errors else "")}
+
+    resolved, candidates = resolve_fields(extracted, EXTRACTION_FIELDS)
+    resolved["instrument_type"] = instrument_type
+    logging.info(f"Merged {len(extracted)}/{window_count} windows, candidates per field: {candidates}")
+    return resolved
+
+# Split a long document into page windows. Returns (label, document message) pairs in window order.
+def document_windows(ocr_text):
+    windows = split_windows(ocr_text)
+    logging.info(f"Long document ({estimate_text_tokens(ocr_text)} estimated tokens) split into {len(windows)} windows")
+    return [(f"window {window_number}/{len(windows)}", window_message(window_number, len(windows), window_text))
+            for window_number, window_text in enumerate(windows, start=1)]
+
+# Long documents: extract every page window in parallel, then resolve one value per field.
+def extract_long_document(ocr_text, instrument_type, compiled, budget):
+    windows = document_windows(ocr_text)
+
+    def extract_window(window):
+        label, document_message = window
         try:
-            json_resp = json.loads(resp)
-            logging.info(json_resp)
-            return json_resp
-        except json.JSONDecodeError as e:
-            logging.error(f"Error parsing JSON: {e}")
-            return {"error": "Invalid JSON response from OpenAI", "raw_response": resp}
+            return extract_fields(compiled, document_message, budget, label)
+        except Exception as e:
+            logging.error(f"Error extracting {label}: {e}")
+            return {"error": str(e)}
+
+    window_results = scheduler.map("llm_windows", extract_window, windows)
+    return merge_windows(window_results, instrument_type, len(windows))
+
+# Instrument type and compiled extraction prompt for an instrument type answer.
+def extraction_prompt(instrument_type_data):
+    instrument_type = instrument_type_data.get("instrument_type", "")
+    if not instrument_type:
+        raise ValueError("Instrument type could not be extracted.")
+    instrument_type = prompt_registry.resolve_instrument_type(instrument_type)
+    return instrument_type, prompt_registry.extraction_prompts[instrument_type]
+
+# Final answer of a document: the extraction result with the document's token usage. A document that
+# ran out of token budget is an error even if an answer came back, since requests were skipped.
+def with_token_usage(result, budget):
+    token_usage = budget.report()
+    logging.info(f"Token budget for document: {token_usage}")
+    if "error" in result:
+        return result
+    if token_usage["exceeded"]:
+        return {"error": f"Token budget exceeded, {token_usage['skipped_calls']} requests skipped", "token_usage": token_usage}
+    return {**result, "token_usage": token_usage}
+
+def extract_and_process_document(ocr_text):
+    budget = TokenBudget()
+    try:
+        instrument_type, compiled = extraction_prompt(extract_instrument_type(ocr_text, budget))
+        if is_long_document(ocr_text):
+            result = extract_long_document(ocr_text, instrument_type, compiled, budget)
+        else:
+            result = extract_fields(compiled, DOCUMENT_MESSAGE.format(ocr_text=ocr_text), budget)
+        return with_token_usage(result, budget)
+
+    except Exception as e:
+        logging.error(f"Error processing document: {e}")
+        return str(e)
+
+# Async execution mode
+# --------------------
+# The same extraction steps as above on coroutines. Only the OpenAI calls differ (AsyncOpenAI through
+# create_chat_completion_async, the windows of a long document gathered on the event loop); the request
+# building, LLM cache and answer parsing are the shared functions above, run in worker threads as the cache blocks.
+
+async def extract_instrument_type_async(ocr_text, budget=None):
+    request = await asyncio.to_thread(instrument_type_llm_request, ocr_text)
+    if request.answer is not None:
+        return request.answer
 
+    try:
+        completion = await create_chat_completion_async(**request.kwargs)
+        return await asyncio.to_thread(instrument_type_answer, completion, request.cache_key, budget)
     except Exception as e:
         logging.error(f"Error communicating with OpenAI: {e}")
         return {"error": f"OpenAI API error: {e}"}
 
-# Load Prompts
-def load_prompts(filepath="prompts.json"):
-    with open(filepath, "r") as f:
-        prompts = json.load(f)
-    return prompts
+async def extract_fields_async(compiled, document_message, budget, label="data extraction"):
+    request = await asyncio.to_thread(extraction_request, compiled, document_message, budget, label)
+    if request.answer is not None:
+        return request.answer
 
-prompts = load_prompts()
+    used_tokens = None
+    try:
+        completion = await create_chat_completion_async(**request.kwargs)
+        used_tokens = completion.usage.total_tokens
+    finally:
+        budget.settle(request.estimated_tokens, used_tokens)
+    return await asyncio.to_thread(extraction_answer, completion, request.cache_key, label)
 
-def prompts_by_instrument_type(instrument_type):
-    fields = prompts.get(instrument_type, {}).get("fields", {})
-    return json.dumps(fields, indent=4)
+async def extract_long_document_async(ocr_text, instrument_type, compiled, budget):
+    windows = document_windows(ocr_text)
 
-def extract_and_process_document(ocr_text):
-    try:
-        client = openai.OpenAI()
-        instrument_type_data = extract_instrument_type(ocr_text)
-        instrument_type = instrument_type_data.get("instrument_type", "")
-
-        if not instrument_type:
-            raise ValueError("Instrument type could not be extracted.")
-        prompt_output = prompts_by_instrument_type(instrument_type)
-        user_prompt_doc_type = f"""
-        Find the following parameters in the text data added at the end of this prompt. 
-        Parameters: 
-        {prompt_output}
-        Search in this text data: 
-        {ocr_text} 
-        """
-        
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "system", "content": "You are a legal expert extraction algorithm specializing in property law and land transactions. Extract the following details from the provided legal land document and provide output in valid JSON format. The Text that you have to search this information from is at the end of the prompt."},
-                      {"role": "user", "content": user_prompt_doc_type}],
-            response_format={
-                "type": "json_schema",
-                "json_schema": {
-                    "name": "document_extraction",
-                    "schema": {
-                        "type": "object",
-                        "properties": {
-                            "instrument_type": {"type": "string"},
-                            "volume_page": {"type": "string"},
-                            "document_case_number": {"type": "string"},
-                            "execution_date": {"type": "string"},
-                            "effective_date": {"type": "string"},
-                            "recording_date": {"type": "string"},
-                            "grantee": {"type": "string"},
-                            "grantor": {"type": "string"},
-                            "property_description": {"type": "string"}
-                        },
-                        "required": [
-                            "instrument_type",
-                            "volume_page",
-                            "document_case_number",
-                            "execution_date",
-                            "effective_date",
-                            "recording_date",
-                            "grantee",
-                            "grantor",
-                            "property_description"
-                        ],
-                        "additionalProperties": False
-                    },
-                    "strict": True
-                }
-            }
-        )
-        result = completion.choices[0].message.content
-        logging.info(result)
-        total_tokens = completion.usage.total_tokens
-        logging.info(f"Total Token used for data extraction: {total_tokens}")
+    async def extract_window(label, document_message):
         try:
-            result_json = json.loads(result)
-            return result_json
-        except json.JSONDecodeError as e:
-            logging.error(f"Error parsing json from LLM: {e}")
-            return {"error": "Invalid JSON response from OpenAI", "raw_response": result}
+            return await extract_fields_async(compiled, document_message, budget, label)
+        except Exception as e:
+            logging.error(f"Error extracting {label}: {e}")
+            return {"error": str(e)}
+
+    window_results = await asyncio.gather(*(extract_window(label, message) for label, message in windows))
+    return merge_windows(window_results, instrument_type, len(windows))
+
+async def extract_and_process_document_async(ocr_text):
+    budget = TokenBudget()
+    try:
+        instrument_type, compiled = extraction_prompt(await extract_instrument_type_async(ocr_text, budget))
+        if is_long_document(ocr_text):
+            result = await extract_long_document_async(ocr_text, instrument_type, compiled, budget)
+        else:
+            result = await extract_fields_async(compiled, DOCUMENT_MESSAGE.format(ocr_text=ocr_text), budget)
+        return with_token_usage(result, budget)
 
     except Exception as e:
         logging.error(f"Error processing document: {e}")
         return str(e)
 
+# Convert date strings to proper formats
+def convert_date(date_str):
+    if date_str and date_str.lower() not in ["none found", "n/a"]:
+        try:
+            return datetime.strptime(date_str, "%B %d, %Y").date()
+        except ValueError:
+            return None
+    return None
+
+# Build the runsheets column values from the LLM output, in RUNSHEET_COLUMNS order.
+# Returns None when extracted_data is a string that is not valid JSON.
+def build_runsheet_record(user_id, file_id, project_id, extracted_data):
+    # Ensure extracted_data is in dict format
+    if isinstance(extracted_data, str):
+        try:
+            extracted_data = json.loads(extracted_data)
+        except json.JSONDecodeError:
+            return None
+
+    # Extract necessary fields
+    execution_date = convert_date(extracted_data.get("execution_date"))
+    effective_date = convert_date(extracted_data.get("effective_date"))
+    recording_date = convert_date(extracted_data.get("recording_date"))
+
+    instrument_type = extracted_data.get("instrument_type", "N/A")
+    volume_page = extracted_data.get("volume_page", "N/A")
+    document_case = extracted_data.get("document_case_number", "N/A")
+    grantor = extracted_data.get("grantor", "N/A")
+    grantee = json.dumps(extracted_data.get("grantee", []))
+    property_description = json.dumps(extracted_data.get("property_description", []))
+    remarks = "N/A"
+    file_date = recording_date
+
+    return (
+        file_id, project_id, instrument_type, document_case, volume_page,
+        effective_date, execution_date, file_date, grantor, grantee, property_description,
+        remarks, user_id
+    )
+
+RUNSHEET_COLUMNS = (
+    "file_id", "project_id", "instrument_type", "document_case", "volume_page",
+    "effective_date", "execution_date", "file_date", "grantor", "grantee", "property_description",
+    "remarks", "user_id"
+)
+
 def store_extracted_data(user_id, file_id, project_id, extracted_data):
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "Database connection error"
-
-        with conn:
+        with metrics.db_write_seconds.time(stage="extraction"), get_db_connection() as conn:
             with conn.cursor() as cur:
                 try:
                     conn.autocommit = False  # Disable autocommit for transactions
 
-                    # Convert date strings to proper formats
-                    def convert_date(date_str):
-                        if date_str and date_str.lower() not in ["none found", "n/a"]:
-                            try:
-                                return datetime.strptime(date_str, "%B %d, %Y").date()
-                            except ValueError:
-                                return None
-                        return None
-
-                    # Ensure extracted_data is in dict format
-                    if isinstance(extracted_data, str):
-                        try:
-                            extracted_data = json.loads(extracted_data)
-                        except json.JSONDecodeError:
-                            return "Invalid JSON data"
-
-                    # Extract necessary fields
-                    execution_date = convert_date(extracted_data.get("execution_date"))
-                    effective_date = convert_date(extracted_data.get("effective_date"))
-                    recording_date = convert_date(extracted_data.get("recording_date"))
-
-                    instrument_type = extracted_data.get("instrument_type", "N/A")
-                    volume_page = extracted_data.get("volume_page", "N/A")
-                    document_case = extracted_data.get("document_case_number", "N/A")
-                    grantor = extracted_data.get("grantor", "N/A")
-                    grantee = json.dumps(extracted_data.get("grantee", []))
-                    property_description = json.dumps(extracted_data.get("property_description", []))
-                    remarks = "N/A"
-                    file_date = recording_date
+                    record = build_runsheet_record(user_id, file_id, project_id, extracted_data)
+                    if record is None:
+                        return "Invalid JSON data"
+                    (file_id, project_id, instrument_type, document_case, volume_page,
+                     effective_date, execution_date, file_date, grantor, grantee, property_description,
+                     remarks, user_id) = record
 
                     # Check if the entry exists
                     check_query = "SELECT id FROM public.runsheets WHERE file_id = %s AND project_id = %s"
@@ -269,11 +602,14 @@ def store_extracted_data(user_id, file_id, project_id, extracted_data):
                     update_status_query = "UPDATE public.files SET ocr_status = 'Completed' WHERE id = %s"
                     cur.execute(update_status_query, (file_id,))
                     conn.commit()
+                    metrics.files_total.inc(stage="extraction")
+                    report_progress("extracted")
                     return "Data successfully stored/updated."
 
                 except Exception as e:
                     conn.rollback()
                     logging.error(f"Error storing extracted data: {e}")
+                    metrics.errors_total.inc(stage="extraction_store")
                     return f"Error storing data: {e}"
 
     except Exception as e:
@@ -282,11 +618,7 @@ def store_extracted_data(user_id, file_id, project_id, extracted_data):
 
 def fetch_user_id(file_id):
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return None, "Database connection error"
-
-        with conn:
+        with get_db_connection() as conn:
             with conn.cursor() as cur:
                 query = "SELECT user_id FROM files WHERE files.id = %s"
                 try:
@@ -304,6 +636,15 @@ def fetch_user_id(file_id):
         logging.error(f"Error fetching user_id: {e}")
         return None, str(e)
 
+# Get the OCR text out of an ocr_json_1 value. Returns None for an unexpected format.
+def ocr_text_from_data(ocr_data):
+    # Handle both list and dict cases for ocr_data
+    if isinstance(ocr_data, list) and ocr_data:
+        return ocr_data[0].get("text", "")  # Take "text" from first item if list
+    elif isinstance(ocr_data, dict):
+        return ocr_data.get("text", "")  # Original behavior for dict
+    return None
+
 def process_single_document(file_id):
     id_db, file_id_from_db, project_id, ocr_data, error = fetch_ocr_text(file_id)
     if error:
@@ -315,13 +656,8 @@ def process_single_document(file_id):
 
     logging.info(f"ocr_data fetched for file_id: {file_id}")
 
-    # Handle both list and dict cases for ocr_data
-    if isinstance(ocr_data, list) and ocr_data:
-        ocr_text = ocr_data[0].get("text", "")  # Take "text" from first item if list
-    elif isinstance(ocr_data, dict):
-        ocr_text = ocr_data.get("text", "")  # Original behavior for dict
-    else:
-        ocr_text = ""  # Default to empty string if unexpected format
+    ocr_text = ocr_text_from_data(ocr_data)
+    if ocr_text is None:
         logging.warning(f"Unexpected ocr_data format for file {file_id}")
         return f"Error processing file_id {file_id}. No OCR Data Returned."
 
@@ -340,11 +676,7 @@ def process_single_document(file_id):
 
 def fetch_file_ids_by_project(project_id):
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return None, "Database connection error"
-
-        with conn:
+        with get_db_connection() as conn:
             with conn.cursor() as cur:
                 query = "SELECT id FROM public.files WHERE project_id = %s AND ocr_status = 'Extracting'"
                 cur.execute(query, (project_id,))
@@ -369,14 +701,154 @@ def process_documents_by_project(project_id):
         return ["No files to process"]
 
     results = []
-    for file_id in file_ids:
-        logging.info(f"Processing file ID: {file_id}")
-        result = process_single_document(file_id)
+    for file_id, result in process_documents_bulk(project_id):
         results.append(f"File ID {file_id}: {result}")
-        logging.info(f"Completed processing file ID {file_id}: {result}")
     
     return results
 
+# Bulk path for project runs
+# -------------------------
+# process_single_document makes five or more round trips per file. For a whole project we instead
+#   1. load the 'Extracting' files with their OCR text and user_id in one joined query per batch of
+#      BULK_BATCH_SIZE rows (keyset on files.id, each batch in its own short transaction, so no
+#      connection is held while the OpenAI calls run),
+#   2. run the OpenAI extraction for a batch concurrently,
+#   3. upsert the batch's runsheets with one INSERT ... ON CONFLICT (file_id, project_id) statement
+#      and flip their ocr_status with one ANY(%s) update.
+# The upsert needs a unique index on the conflict target, which the existing schema does not have;
+# migrate_runsheets.py creates it (after removing duplicate rows) and ensure_runsheets_unique_index
+# refuses the first bulk write of a process when it is missing.
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "50"))
+
+_runsheets_index_ready = False
+_runsheets_index_lock = threading.Lock()
+
+# Check, once per process, that the unique index of the bulk upsert exists. Creating it removes
+# duplicate runsheets, so that is left to migrate_runsheets.py and never done from the worker path.
+def ensure_runsheets_unique_index():
+    global _runsheets_index_ready
+    with _runsheets_index_lock:
+        if _runsheets_index_ready:
+            return
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                if not runsheets_unique_index_exists(cur):
+                    raise RuntimeError(f"public.runsheets has no unique index on (file_id, project_id); "
+                                       f"run 'python migrate_runsheets.py' to create {RUNSHEETS_UNIQUE_INDEX}")
+        _runsheets_index_ready = True
+
+# Yield lists of (file_id, project_id, user_id, ocr_data id, ocr_json_1 format, OCR text) for all 'Extracting' files of a project.
+# Every batch is read in its own transaction and the connection is back in the pool before the batch is yielded.
+# The newest ocr_data row wins when a file has several.
+def fetch_extracting_documents(project_id, batch_size=None):
+    batch_size = batch_size or BULK_BATCH_SIZE
+    query = """
+        SELECT DISTINCT ON (f.id) f.id, f.project_id, f.user_id, o.id, o.ocr_json_1::jsonb->>'format', o.ocr_json_1::jsonb->>'text'
+        FROM public.files f
+        LEFT JOIN public.ocr_data o ON o.file_id = f.id
+        WHERE f.project_id = %s AND f.ocr_status = 'Extracting' AND f.id > %s
+        ORDER BY f.id, o.id DESC
+        LIMIT %s
+    """
+    last_id = 0
+    while True:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, (project_id, last_id, batch_size))
+                rows = cur.fetchall()
+        if not rows:
+            break
+        yield rows
+        last_id = rows[-1][0]
+
+# INSERT ... ON CONFLICT (file_id, project_id) statement for runsheet records, with the given VALUES clause.
+def runsheet_upsert_query(values):
+    columns = ", ".join(RUNSHEET_COLUMNS)
+    updates = ",\n                ".join(
+        f"{column} = COALESCE(EXCLUDED.{column}, runsheets.{column})"
+        for column in RUNSHEET_COLUMNS if column not in ("file_id", "project_id")
+    )
+    return f"""
+        INSERT INTO public.runsheets ({columns})
+        VALUES {values}
+        ON CONFLICT (file_id, project_id) DO UPDATE SET
+                {updates}
+    """
+
+# Upsert many runsheet records and mark their files 'Completed' in one transaction.
+def store_extracted_data_bulk(records):
+    if not records:
+        return 0
+    ensure_runsheets_unique_index()
+    upsert_query = runsheet_upsert_query("%s")
+    file_ids = [record[0] for record in records]
+    with metrics.db_write_seconds.time(stage="extraction"), get_db_connection() as conn:
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur, upsert_query, records, page_size=len(records))
+            cur.execute("UPDATE public.files SET ocr_status = 'Completed' WHERE id = ANY(%s)", (file_ids,))
+    metrics.files_total.inc(len(records), stage="extraction")
+    report_progress("extracted", len(records))
+    return len(records)
+
+# store_extracted_data_bulk for the async execution mode, on an asyncpg pool (see db.create_async_pool).
+async def store_extracted_data_bulk_async(async_pool, records):
+    if not records:
+        return 0
+    await asyncio.to_thread(ensure_runsheets_unique_index)
+    upsert_query = runsheet_upsert_query("(" + ", ".join(f"${index}" for index in range(1, len(RUNSHEET_COLUMNS) + 1)) + ")")
+    file_ids = [record[0] for record in records]
+    with metrics.db_write_seconds.time(stage="extraction"):
+        async with async_pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany(upsert_query, records)
+                await conn.execute("UPDATE public.files SET ocr_status = 'Completed' WHERE id = ANY($1::int[])", file_ids)
+    metrics.files_total.inc(len(records), stage="extraction")
+    await asyncio.to_thread(report_progress, "extracted", len(records))
+    return len(records)
+
+# Run the bulk path for a project. Returns (file_id, result) pairs, like the old per-file path.
+def process_documents_bulk(project_id):
+    def extract(row):
+        file_id, file_project_id, user_id, ocr_row_id, ocr_format_version, ocr_text = row
+        if ocr_row_id is None:
+            return file_id, None, f"No OCR data found for file_id {file_id}"
+        try:
+            ocr_text = ocr_text_for_row(ocr_row_id, ocr_format_version, ocr_text)
+        except (json.JSONDecodeError, TypeError):
+            return file_id, None, "Invalid JSON format"
+        if ocr_text is None:
+            return file_id, None, f"Error processing file_id {file_id}. No OCR Data Returned."
+
+        logging.info(f"Processing file ID: {file_id}")
+        extracted_data = extract_and_process_document(ocr_text)
+        if "error" in extracted_data:
+            logging.error(f"Error processing document {file_id}: {extracted_data}")
+            metrics.errors_total.inc(stage="extraction")
+            return file_id, None, f"Error processing document {file_id}: {extracted_data.get('error') if isinstance(extracted_data, dict) else extracted_data}"
+        record = build_runsheet_record(user_id, file_id, file_project_id, extracted_data)
+        if record is None:
+            return file_id, None, "Invalid JSON data"
+        return file_id, record, None
+
+    results = []
+    for rows in fetch_extracting_documents(project_id):
+        batch = scheduler.map("openai", extract, rows)
+        records = [record for _, record, _ in batch if record is not None]
+        try:
+            store_extracted_data_bulk(records)
+            stored = "Data successfully stored/updated."
+        except Exception as e:
+            logging.error(f"Error storing runsheet batch for project {project_id}: {e}")
+            metrics.errors_total.inc(stage="extraction_store")
+            stored = f"Error storing data: {e}"
+        for file_id, record, error in batch:
+            result = error if record is None else stored
+            logging.info(f"Completed processing file ID {file_id}: {result}")
+            results.append((file_id, result))
+
+    logging.info(f"OpenAI limiter stats: {openai_limiter.stats()}")
+    logging.info(f"Prompt cache stats: {prompt_registry.stats()}")
+    return results
 
 
 # Flask app initialization
@@ -400,14 +872,11 @@ def process_project(project_id):
 
         # Process each file_id
         results = []
-        for file_id in file_ids:
-            logging.info(f"Processing file ID: {file_id}")
-            result = process_single_document(file_id)
+        for file_id, result in process_documents_bulk(project_id):
             results.append({
                 "file_id": file_id,
                 "result": result
             })
-            logging.info(f"Completed processing file ID {file_id}: {result}")
         
         # Return the results in JSON format
         return jsonify({
@@ -0,0 +1,196 @@
+"""
+Local instrument type classifier.
+
+Choosing one of the prompts.json instrument types used to cost a full gpt-4o-mini call per document,
+while the type is nearly always written in the first lines ("WARRANTY DEED", "OIL AND GAS LEASE",
+"RIGHT OF WAY"). This classifier scores every instrument type on keyword and n-gram features of the
+start of the document:
+
+  - the instrument type names and their aliases from prompt_registry.py, plus the phrases in
+    INSTRUMENT_KEYWORDS (longer phrases weigh more, they are more specific)
+  - matches in the heading (the first HEADING_LINES non-empty lines) weigh HEADING_WEIGHT times more,
+    and the phrase that starts the heading gets a further bonus ("ASSIGNMENT OF OIL AND GAS LEASE"
+    is an Assignment, not a Lease)
+  - phrases are matched longest first and a matched phrase hides the shorter phrases inside it, so
+    "deed of trust" is not also read as "deed"
+  - OTHER_KEYWORDS are lien and security instruments (deeds of trust, mortgages, liens), which are
+    none of the prompts.json types; when they win the answer is "Other"
+
+The confidence is the margin of the best type over the runner-up, scaled by how much evidence was
+found. With INSTRUMENT_CLASSIFIER=hybrid, extract_instrument_type only falls back to the LLM when it
+is below INSTRUMENT_CLASSIFIER_MIN_CONFIDENCE. The default is llm: on the held-out fixtures the
+confident answers are still wrong about one time in five, so hybrid is opt-in until that matches the LLM.
+
+Evaluation on labeled fixtures (JSON lines with "text" and "instrument_type"):
+
+    python instrument_classifier.py fixtures/instrument_types.jsonl
+    python instrument_classifier.py fixtures/instrument_types_heldout.jsonl
+
+reports accuracy on the confident documents, accuracy of the local label on all documents, and
+how many LLM calls the classifier avoided. instrument_types_heldout.jsonl holds recorded-style lien,
+security and release instruments that were not written from the keyword lists; it is the more honest
+of the two numbers (the keywords were tuned on instrument_types.jsonl), and it still has confident
+errors, e.g. a bare "RECONVEYANCE" is read as "Other".
+
+Configuration (.env):
+
+INSTRUMENT_CLASSIFIER=                   # llm (default), hybrid or local
+INSTRUMENT_CLASSIFIER_MIN_CONFIDENCE=
+"""
+
+import os
+import sys
+import json
+import argparse
+
+from prompt_registry import prompt_registry, normalize_name, INSTRUMENT_TYPE_ALIASES
+
+
+INSTRUMENT_CLASSIFIER = os.getenv("INSTRUMENT_CLASSIFIER", "llm")
+INSTRUMENT_CLASSIFIER_MIN_CONFIDENCE = float(os.getenv("INSTRUMENT_CLASSIFIER_MIN_CONFIDENCE", "0.6"))
+
+CLASSIFIER_PREFIX_CHARS = 3000
+HEADING_LINES = 6
+HEADING_WEIGHT = 3.0
+LEADING_PHRASE_BONUS = 4.0
+EVIDENCE_FOR_FULL_CONFIDENCE = 6.0
+
+# Phrases typical of each instrument type, besides its name and aliases
+INSTRUMENT_KEYWORDS = {
+    "Deed": ["warranty deed", "special warranty deed", "general warranty deed", "mineral deed", "royalty deed",
+             "grant deed", "deed of gift", "grant bargain sell and convey", "grantor", "grantee"],
+    "Lease": ["oil and gas lease", "paid up oil and gas lease", "mineral lease", "lessor", "lessee",
+              "primary term", "royalty on oil"],
+    "Release": ["release of oil and gas lease", "release of lien", "partial release", "releases and discharges",
+                "full release", "release of deed of trust", "release of mortgage", "satisfaction of mortgage",
+                "release of vendor's lien", "reconveyance", "deed of reconveyance"],
+    "Waiver": ["waiver", "waive", "waives", "hereby waives"],
+    "Quitclaim": ["quitclaim deed", "quit claim deed", "remise release and quitclaim", "quitclaims"],
+    "Option": ["option to purchase", "option agreement", "option to lease", "optionee", "optionor"],
+    "Easement or Right of Way": ["right of way", "right of way agreement", "easement", "pipeline easement",
+                                 "right of ingress and egress"],
+    "Ratification": ["ratification", "ratification of oil and gas lease", "ratify", "ratifies and confirms"],
+    "Affidavit": ["affidavit", "affidavit of heirship", "affiant", "sworn to and subscribed", "being duly sworn"],
+    "Probate": ["probate", "letters testamentary", "letters of administration", "estate of", "independent executor",
+                "probate court"],
+    "Will and Testament": ["last will and testament", "will and testament", "i give devise and bequeath",
+                           "being of sound mind", "testator", "testatrix"],
+    "Death Certificate": ["certificate of death", "death certificate", "cause of death", "date of death",
+                          "certificate of vital record"],
+    "Obituary": ["obituary", "passed away", "survived by", "preceded in death", "funeral services"],
+    "Divorce": ["final decree of divorce", "decree of divorce", "divorce", "petitioner", "respondent",
+                "dissolution of marriage"],
+    "Adoption": ["adoption", "decree of adoption", "adoptive parent", "adopted child"],
+    "Court Case": ["district court", "cause no", "plaintiff", "defendant", "judgment", "in the matter of",
+                   "county court at law"],
+    "Assignment": ["assignment", "assignment of oil and gas lease", "assignment and bill of sale", "assignor",
+                   "assignee", "assigns transfers and conveys"],
+}
+
+# Lien and security instruments: the answer among the prompts.json types is "Other"
+# (possessives are written with the apostrophe, normalize_name reads "vendor's" as "vendor s")
+OTHER_KEYWORDS = ["deed of trust", "mortgage", "mortgagor", "mortgagee", "trustee", "promissory note",
+                  "secures the payment", "secure the payment", "security instrument", "lien", "mechanics lien",
+                  "mechanic's lien", "materialman's lien", "vendors lien", "vendor's lien", "lis pendens",
+                  "financing statement", "abstract of judgment", "judgment lien"]
+
+
+class InstrumentClassifier:
+    def __init__(self, instrument_types, keywords=None, aliases=None, other_keywords=None):
+        self.instrument_types = [name for name in instrument_types if name != "Other"]
+        self.features = {}  # normalized phrase -> [(instrument type, weight)]
+        phrases_by_type = {}
+        for instrument_type in self.instrument_types:
+            phrases = phrases_by_type[instrument_type] = {instrument_type}
+            phrases.update(alias for alias, target in (aliases or {}).items() if target == instrument_type)
+            phrases.update((keywords or {}).get(instrument_type, []))
+        if other_keywords and "Other" in instrument_types:
+            phrases_by_type["Other"] = set(other_keywords)
+        for instrument_type, phrases in phrases_by_type.items():
+            for phrase in phrases:
+                normalized = normalize_name(phrase)
+                if normalized:
+                    self.features.setdefault(normalized, []).append((instrument_type, len(normalized.split()) ** 1.5))
+        # Longest phrases first: a matched phrase hides the shorter phrases it contains
+        self.ordered_features = sorted(self.features.items(), key=lambda item: len(item[0]), reverse=True)
+
+    # Returns (instrument_type, confidence, scores) for the start of a document.
+    def classify(self, ocr_text):
+        lines = [line for line in (ocr_text or "")[:CLASSIFIER_PREFIX_CHARS].splitlines() if line.strip()]
+        heading = f" {normalize_name(' '.join(lines[:HEADING_LINES]))} "
+        body = f" {normalize_name(' '.join(lines[HEADING_LINES:]))} "
+
+        scores = {}
+        leading = None  # (position, phrase length, instrument type) of the earliest phrase in the heading
+        for phrase, targets in self.ordered_features:
+            padded = f" {phrase} "
+            heading_hits = heading.count(padded)
+            body_hits = body.count(padded)
+            if not heading_hits and not body_hits:
+                continue
+            position = heading.find(padded)
+            mask = " " + "#" * len(phrase) + " "  # Same length, so heading positions stay comparable
+            heading = heading.replace(padded, mask)
+            body = body.replace(padded, mask)
+            for instrument_type, weight in targets:
+                scores[instrument_type] = scores.get(instrument_type, 0.0) + weight * (HEADING_WEIGHT * heading_hits + body_hits)
+                if heading_hits:
+                    candidate = (position, -len(phrase), instrument_type)
+                    if leading is None or candidate < leading:
+                        leading = candidate
+        if leading is not None:
+            scores[leading[2]] += LEADING_PHRASE_BONUS
+
+        if not scores:
+            return "Other", 0.0, scores
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        best_type, best = ranked[0]
+        runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+        margin = (best - runner_up) / best
+        evidence = min(1.0, best / EVIDENCE_FOR_FULL_CONFIDENCE)
+        return best_type, round(margin * evidence, 4), scores
+
+
+instrument_classifier = InstrumentClassifier(prompt_registry.instrument_types, INSTRUMENT_KEYWORDS, INSTRUMENT_TYPE_ALIASES,
+                                             OTHER_KEYWORDS)
+
+
+# Evaluate the classifier on labeled fixtures. Low-confidence documents count as LLM calls.
+def evaluate(fixtures, min_confidence=None):
+    min_confidence = INSTRUMENT_CLASSIFIER_MIN_CONFIDENCE if min_confidence is None else min_confidence
+    total = confident = confident_correct = local_correct = 0
+    errors = []
+    for fixture in fixtures:
+        expected = prompt_registry.resolve_instrument_type(fixture["instrument_type"])
+        label, confidence, _ = instrument_classifier.classify(fixture["text"])
+        total += 1
+        local_correct += label == expected
+        if confidence >= min_confidence:
+            confident += 1
+            confident_correct += label == expected
+            if label != expected:
+                errors.append({"expected": expected, "predicted": label, "confidence": confidence,
+                               "start": fixture["text"][:80]})
+    return {
+        "documents": total,
+        "min_confidence": min_confidence,
+        "llm_calls_avoided": confident,
+        "llm_calls_needed": total - confident,
+        "accuracy_when_confident": round(confident_correct / confident, 4) if confident else None,
+        "accuracy_local_only": round(local_correct / total, 4) if total else None,
+        "confident_errors": errors,
+    }
+
+
+def load_fixtures(path):
+    with open(path, "r", encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the local instrument type classifier on labeled fixtures")
+    parser.add_argument("fixtures", help="JSON lines file with 'text' and 'instrument_type'")
+    parser.add_argument("--min-confidence", type=float)
+    args = parser.parse_args()
+    json.dump(evaluate(load_fixtures(args.fixtures), args.min_confidence), sys.stdout, indent=4)
+    print()
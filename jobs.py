@@ -0,0 +1,365 @@
+"""
+Durable extraction job queue backed by PostgreSQL.
+
+/start-extraction used to start a raw threading.Thread per call: no way to poll progress, a second
+call for the same project duplicated all OCR and LLM spend, and a restart lost everything in flight.
+Jobs now live in public.extraction_jobs:
+
+  - enqueue_job is idempotent per project: while a project has a queued, running or waiting job,
+    enqueueing again returns that job (enforced by a partial unique index)
+  - a pool of worker threads claims queued jobs with FOR UPDATE SKIP LOCKED, so several
+    processes can share the queue
+  - running jobs send a heartbeat; jobs whose heartbeat is older than JOB_STALE_SECONDS
+    (the process died) are put back in the queue, up to JOB_MAX_ATTEMPTS attempts
+  - the pipeline reports per-stage progress (files downloaded / OCR'd / extracted) with
+    report_progress, read back by get_job_status. Progress only counts for the job in the
+    current_job_id context variable, which a worker sets while it runs the job (the scheduler
+    pools and pipeline threads carry it over), so the legacy /batch_ocr and /file_ocr routes
+    never add to a job's counters. Counts are added up in memory and written at most every
+    JOB_PROGRESS_FLUSH_SECONDS (and when a job stops), one UPDATE per job, so per-file progress
+    costs no database round trip on the hot path
+
+Job status values: queued, running, waiting, completed, failed.
+
+A handler that has handed work to an external service which takes hours (the OpenAI Batch API,
+see openai_batch.py) raises JobWaiting instead of holding a worker thread while it polls. The job
+is then 'waiting': its worker is released and the job is claimed again after the requested delay,
+when the handler runs again and picks up its saved state.
+
+A job is only 'completed' when the run left none of the project's files in 'Processing' (OCR failed)
+or 'Extracting' (extraction failed); the pipeline stages log and skip failing files, so the file
+statuses are what tells a clean run from a partial one. Otherwise the job is 'failed' with the
+counts as its error, and enqueueing the project again retries exactly those files.
+
+Configuration (.env):
+
+JOB_WORKERS=
+JOB_POLL_SECONDS=
+JOB_STALE_SECONDS=
+JOB_MAX_ATTEMPTS=
+JOB_PROGRESS_FLUSH_SECONDS=
+"""
+
+import os
+import time
+import uuid
+import logging
+import threading
+import contextvars
+
+from db import db_connection
+
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "5"))
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "300"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_PROGRESS_FLUSH_SECONDS = float(os.getenv("JOB_PROGRESS_FLUSH_SECONDS", "5"))
+
+PROGRESS_COLUMNS = {
+    "downloaded": "files_downloaded",
+    "ocred": "files_ocred",
+    "extracted": "files_extracted",
+}
+
+CREATE_JOBS_TABLE_QUERY = """
+CREATE TABLE IF NOT EXISTS public.extraction_jobs (
+    id SERIAL PRIMARY KEY,
+    project_id INTEGER NOT NULL,
+    mode TEXT,
+    status TEXT NOT NULL DEFAULT 'queued',
+    files_total INTEGER NOT NULL DEFAULT 0,
+    files_downloaded INTEGER NOT NULL DEFAULT 0,
+    files_ocred INTEGER NOT NULL DEFAULT 0,
+    files_extracted INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    worker_id TEXT,
+    heartbeat_at TIMESTAMPTZ,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ
+);
+ALTER TABLE public.extraction_jobs ADD COLUMN IF NOT EXISTS not_before TIMESTAMPTZ;
+DROP INDEX IF EXISTS public.extraction_jobs_active_project_key;
+CREATE UNIQUE INDEX IF NOT EXISTS extraction_jobs_open_project_key
+    ON public.extraction_jobs (project_id) WHERE status IN ('queued', 'running', 'waiting');
+"""
+
+JOB_COLUMNS = ("id", "project_id", "mode", "status", "files_total", "files_downloaded", "files_ocred",
+               "files_extracted", "attempts", "error", "created_at", "started_at", "finished_at")
+
+_table_ready = False
+_table_lock = threading.Lock()
+
+_progress = {}  # job id -> {progress column: count not written yet}
+_progress_lock = threading.Lock()
+_progress_flushed_at = 0.0
+
+# Id of the job whose handler is running in this context, None outside a job
+current_job_id = contextvars.ContextVar("current_job_id", default=None)
+
+
+class JobWaiting(Exception):
+    """Raised by a job handler whose work goes on elsewhere: run the job again in retry_seconds."""
+
+    def __init__(self, message, retry_seconds):
+        super().__init__(message)
+        self.retry_seconds = retry_seconds
+
+
+def ensure_jobs_table():
+    global _table_ready
+    with _table_lock:
+        if _table_ready:
+            return
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(CREATE_JOBS_TABLE_QUERY)
+        _table_ready = True
+
+
+def _row_to_job(row):
+    return dict(zip(JOB_COLUMNS, row)) if row else None
+
+
+# Queue an extraction job for a project. Returns (job, created): created is False when
+# the project already had a queued, running or waiting job, which is returned instead.
+def enqueue_job(project_id, mode=None):
+    ensure_jobs_table()
+    columns = ", ".join(JOB_COLUMNS)
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                INSERT INTO public.extraction_jobs (project_id, mode)
+                VALUES (%s, %s)
+                ON CONFLICT (project_id) WHERE status IN ('queued', 'running', 'waiting') DO NOTHING
+                RETURNING {columns}
+            """, (project_id, mode))
+            row = cur.fetchone()
+            if row:
+                return _row_to_job(row), True
+            cur.execute(f"""
+                SELECT {columns} FROM public.extraction_jobs
+                WHERE project_id = %s AND status IN ('queued', 'running', 'waiting')
+            """, (project_id,))
+            return _row_to_job(cur.fetchone()), False
+
+
+# Latest job of a project, or None.
+def get_job_status(project_id):
+    ensure_jobs_table()
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT {", ".join(JOB_COLUMNS)} FROM public.extraction_jobs
+                WHERE project_id = %s ORDER BY id DESC LIMIT 1
+            """, (project_id,))
+            return _row_to_job(cur.fetchone())
+
+
+# Add count to a stage counter of the job being run in this context. Does nothing outside a job.
+# The counts are written by flush_progress, at most every JOB_PROGRESS_FLUSH_SECONDS.
+def report_progress(stage, count=1):
+    job_id = current_job_id.get()
+    if not count or job_id is None:
+        return
+    column = PROGRESS_COLUMNS[stage]
+    with _progress_lock:
+        counts = _progress.setdefault(job_id, {})
+        counts[column] = counts.get(column, 0) + count
+        if time.monotonic() - _progress_flushed_at < JOB_PROGRESS_FLUSH_SECONDS:
+            return
+    flush_progress()
+
+
+# Write the progress counted since the last flush, one UPDATE per job.
+def flush_progress():
+    global _progress, _progress_flushed_at
+    with _progress_lock:
+        pending, _progress = _progress, {}
+        _progress_flushed_at = time.monotonic()
+    if not pending:
+        return
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                for job_id, counts in pending.items():
+                    updates = ", ".join(f"{column} = {column} + %s" for column in counts)
+                    cur.execute(f"""
+                        UPDATE public.extraction_jobs SET {updates}
+                        WHERE id = %s AND status = 'running'
+                    """, (*counts.values(), job_id))
+    except Exception as e:
+        logging.warning(f"Could not report progress for jobs {sorted(pending)}: {e}")
+
+
+# Claim a queued job, or a waiting job whose delay is over. A waiting job resumes the attempt it
+# was on: its attempt count, start time and progress counters are kept.
+def claim_job(worker_id):
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                UPDATE public.extraction_jobs SET
+                    status = 'running',
+                    worker_id = %s,
+                    attempts = CASE WHEN status = 'waiting' THEN attempts ELSE attempts + 1 END,
+                    heartbeat_at = now(),
+                    not_before = NULL,
+                    started_at = CASE WHEN status = 'waiting' THEN started_at ELSE now() END,
+                    files_downloaded = CASE WHEN status = 'waiting' THEN files_downloaded ELSE 0 END,
+                    files_ocred = CASE WHEN status = 'waiting' THEN files_ocred ELSE 0 END,
+                    files_extracted = CASE WHEN status = 'waiting' THEN files_extracted ELSE 0 END,
+                    files_total = CASE WHEN status = 'waiting' THEN files_total ELSE (
+                        SELECT count(*) FROM public.files f
+                        WHERE f.project_id = extraction_jobs.project_id AND f.ocr_status IN ('Processing', 'Extracting')
+                    ) END
+                WHERE id = (
+                    SELECT id FROM public.extraction_jobs
+                    WHERE status = 'queued' OR (status = 'waiting' AND not_before <= now())
+                    ORDER BY created_at FOR UPDATE SKIP LOCKED LIMIT 1
+                )
+                RETURNING {", ".join(JOB_COLUMNS)}
+            """, (worker_id,))
+            return _row_to_job(cur.fetchone())
+
+
+def finish_job(job_id, status, error=None):
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE public.extraction_jobs SET status = %s, error = %s, finished_at = now(), worker_id = NULL
+                WHERE id = %s
+            """, (status, error, job_id))
+
+
+# Release a running job until retry_seconds from now, when claim_job hands it out again.
+def wait_job(job_id, retry_seconds, message):
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE public.extraction_jobs SET status = 'waiting', error = %s, worker_id = NULL,
+                    not_before = now() + make_interval(secs => %s)
+                WHERE id = %s
+            """, (message, retry_seconds, job_id))
+
+
+# Files of a project that a run left unfinished, as {ocr_status: count} for 'Processing' and 'Extracting'.
+def count_unfinished_files(project_id):
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT ocr_status, COUNT(*) FROM public.files
+                WHERE project_id = %s AND ocr_status IN ('Processing', 'Extracting')
+                GROUP BY ocr_status
+            """, (project_id,))
+            return dict(cur.fetchall())
+
+
+def heartbeat(worker_ids):
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE public.extraction_jobs SET heartbeat_at = now()
+                WHERE status = 'running' AND worker_id = ANY(%s)
+            """, (list(worker_ids),))
+
+
+# Put running jobs whose worker stopped sending heartbeats back in the queue (or fail them after JOB_MAX_ATTEMPTS).
+def requeue_stale_jobs():
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE public.extraction_jobs SET
+                    status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'queued' END,
+                    error = CASE WHEN attempts >= %s THEN 'Worker stopped responding' ELSE error END,
+                    finished_at = CASE WHEN attempts >= %s THEN now() ELSE NULL END,
+                    worker_id = NULL
+                WHERE status = 'running' AND heartbeat_at < now() - make_interval(secs => %s)
+                RETURNING id, status
+            """, (JOB_MAX_ATTEMPTS, JOB_MAX_ATTEMPTS, JOB_MAX_ATTEMPTS, JOB_STALE_SECONDS))
+            for job_id, status in cur.fetchall():
+                logging.warning(f"Stale extraction job {job_id} moved to {status}")
+
+
+class JobWorkerPool:
+    """Worker threads that run handler(project_id, mode) for every claimed job."""
+
+    def __init__(self, handler, workers=None, poll_seconds=None):
+        self.handler = handler
+        self.workers = JOB_WORKERS if workers is None else workers
+        self.poll_seconds = JOB_POLL_SECONDS if poll_seconds is None else poll_seconds
+        self.process_id = uuid.uuid4().hex[:8]
+        self.active_workers = set()
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        ensure_jobs_table()
+        for index in range(self.workers):
+            threading.Thread(target=self._work, args=(f"{self.process_id}-{index}",), name=f"job-worker-{index}", daemon=True).start()
+        threading.Thread(target=self._maintain, name="job-heartbeat", daemon=True).start()
+        logging.info(f"Started {self.workers} extraction job workers ({self.process_id})")
+
+    def _maintain(self):
+        while True:
+            try:
+                with self._lock:
+                    active = set(self.active_workers)
+                if active:
+                    heartbeat(active)
+                flush_progress()
+                requeue_stale_jobs()
+            except Exception as e:
+                logging.error(f"Job heartbeat failed: {e}")
+            time.sleep(max(1.0, JOB_STALE_SECONDS / 5))
+
+    def _work(self, worker_id):
+        while True:
+            try:
+                job = claim_job(worker_id)
+            except Exception as e:
+                logging.error(f"Could not claim extraction job: {e}")
+                job = None
+            if job is None:
+                time.sleep(self.poll_seconds)
+                continue
+
+            with self._lock:
+                self.active_workers.add(worker_id)
+            logging.info(f"Job {job['id']} started for project {job['project_id']} (attempt {job['attempts']})")
+            token = current_job_id.set(job["id"])
+            try:
+                self.handler(job["project_id"], job["mode"])
+                flush_progress()
+                unfinished = count_unfinished_files(job["project_id"])
+                if unfinished:
+                    error = ", ".join(f"{count} files left in {status}" for status, count in sorted(unfinished.items()))
+                    finish_job(job["id"], "failed", error)
+                    logging.error(f"Job {job['id']} failed for project {job['project_id']}: {error}")
+                else:
+                    finish_job(job["id"], "completed")
+                    logging.info(f"Job {job['id']} completed for project {job['project_id']}")
+            except JobWaiting as e:
+                flush_progress()
+                logging.info(f"Job {job['id']} waiting for project {job['project_id']}, "
+                             f"running again in {e.retry_seconds:.0f}s: {e}")
+                try:
+                    wait_job(job["id"], e.retry_seconds, str(e))
+                except Exception as wait_error:
+                    logging.error(f"Could not mark job {job['id']} as waiting: {wait_error}")
+            except Exception as e:
+                logging.error(f"Job {job['id']} failed for project {job['project_id']}: {e}")
+                flush_progress()
+                try:
+                    finish_job(job["id"], "failed", str(e))
+                except Exception as finish_error:
+                    logging.error(f"Could not mark job {job['id']} as failed: {finish_error}")
+            finally:
+                current_job_id.reset(token)
+                with self._lock:
+                    self.active_workers.discard(worker_id)
@@ -0,0 +1,233 @@
+"""
+Memoization layer for OpenAI extraction responses.
+
+A response is keyed by a hash of:
+  - the model name
+  - the system prompt
+  - the static instructions of the compiled prompt (see prompt_registry.py)
+  - the variable message (the OCR text, with the window note for long documents)
+so an unchanged document with unchanged prompts never goes back to the network,
+while editing prompts.json or switching models naturally misses the cache.
+
+Two backends are available, selected with LLM_CACHE_BACKEND:
+  disk      JSON files under LLM_CACHE_DIR (default)
+  postgres  the public.llm_cache table (created on first use)
+  none      caching disabled
+
+Entries older than LLM_CACHE_TTL_HOURS are ignored and removed, and once there are more than
+LLM_CACHE_MAX_ENTRIES entries the least recently used ones are evicted.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import tempfile
+
+
+# Build the cache key for one LLM call from the pieces that decide its answer.
+def make_cache_key(model, system_prompt, prompt_entry, ocr_text):
+    digest = hashlib.sha256()
+    for part in (model, system_prompt, json.dumps(prompt_entry, sort_keys=True, ensure_ascii=False), ocr_text):
+        encoded = (part or "").encode("utf-8")
+        digest.update(len(encoded).to_bytes(8, "big"))  # Length prefix so parts can't run into each other
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+class DiskCacheBackend:
+    """Stores each response as a JSON file; file mtime is the LRU clock."""
+
+    def __init__(self, cache_dir, ttl_seconds, max_entries):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._puts_since_evict = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                entry = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError):
+            self._remove(path)
+            return None
+        if time.time() - entry.get("created_at", 0) > self.ttl_seconds:
+            self._remove(path)
+            return None
+        os.utime(path)
+        return entry.get("response")
+
+    def put(self, key, response):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump({"created_at": time.time(), "response": response}, file, ensure_ascii=False)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            self._puts_since_evict += 1
+            if self._puts_since_evict < 100:
+                return
+            self._puts_since_evict = 0
+        self.evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        entries = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    try:
+                        entries.append((os.stat(path).st_mtime, path))
+                    except FileNotFoundError:
+                        continue
+        entries.sort()
+        now = time.time()
+        overflow = len(entries) - self.max_entries
+        for index, (mtime, path) in enumerate(entries):
+            if index < overflow or now - mtime > self.ttl_seconds:
+                self._remove(path)
+
+
+class PostgresCacheBackend:
+    """Stores responses in public.llm_cache so every worker process shares them."""
+
+    CREATE_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS public.llm_cache (
+        cache_key TEXT PRIMARY KEY,
+        response JSONB NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        last_used_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """
+
+    def __init__(self, get_connection, ttl_seconds, max_entries):
+        self.get_connection = get_connection
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._table_ready = False
+        self._puts_since_evict = 0
+        self._lock = threading.Lock()
+
+    def _ensure_table(self, cur):
+        if not self._table_ready:
+            cur.execute(self.CREATE_TABLE_QUERY)
+            self._table_ready = True
+
+    def get(self, key):
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                self._ensure_table(cur)
+                cur.execute("""
+                    UPDATE public.llm_cache SET last_used_at = now()
+                    WHERE cache_key = %s AND created_at > now() - make_interval(secs => %s)
+                    RETURNING response
+                """, (key, self.ttl_seconds))
+                row = cur.fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]) if isinstance(row[0], str) else row[0]
+
+    def put(self, key, response):
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                self._ensure_table(cur)
+                cur.execute("""
+                    INSERT INTO public.llm_cache (cache_key, response) VALUES (%s, %s)
+                    ON CONFLICT (cache_key) DO UPDATE SET
+                        response = EXCLUDED.response,
+                        created_at = now(),
+                        last_used_at = now()
+                """, (key, json.dumps(response)))
+
+        with self._lock:
+            self._puts_since_evict += 1
+            if self._puts_since_evict < 100:
+                return
+            self._puts_since_evict = 0
+        self.evict()
+
+    def evict(self):
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                self._ensure_table(cur)
+                cur.execute("DELETE FROM public.llm_cache WHERE created_at <= now() - make_interval(secs => %s)", (self.ttl_seconds,))
+                cur.execute("""
+                    DELETE FROM public.llm_cache WHERE cache_key IN (
+                        SELECT cache_key FROM public.llm_cache ORDER BY last_used_at DESC OFFSET %s
+                    )
+                """, (self.max_entries,))
+
+
+class LlmCache:
+    """Front end over a cache backend; backend failures are logged and treated as misses."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        response = None
+        if self.backend is not None:
+            try:
+                response = self.backend.get(key)
+            except Exception as e:
+                logging.warning(f"LLM cache read failed: {e}")
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+    def put(self, key, response):
+        if self.backend is None:
+            return
+        try:
+            self.backend.put(key, response)
+        except Exception as e:
+            logging.warning(f"LLM cache write failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+# Build the cache configured in the environment. get_connection is only used by the postgres backend
+# and must return a connection usable as a context manager that commits on exit.
+def create_llm_cache(get_connection=None):
+    backend_name = os.getenv("LLM_CACHE_BACKEND", "disk").lower()
+    ttl_seconds = float(os.getenv("LLM_CACHE_TTL_HOURS", "720")) * 3600
+    max_entries = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "100000"))
+
+    if backend_name == "none":
+        backend = None
+    elif backend_name == "postgres":
+        backend = PostgresCacheBackend(get_connection, ttl_seconds, max_entries)
+    else:
+        backend = DiskCacheBackend(os.getenv("LLM_CACHE_DIR", "llm_cache"), ttl_seconds, max_entries)
+    return LlmCache(backend)
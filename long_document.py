@@ -0,0 +1,155 @@
+"""
+Helpers for long-document extraction (probate files, court cases, multi-instrument recordings).
+
+Short documents are extracted with one prompt holding the whole OCR text. Documents whose OCR text
+is estimated above LONG_DOCUMENT_THRESHOLD_TOKENS are extracted map-reduce style instead:
+
+  1. split   the OCR text into page windows of about LONG_DOCUMENT_WINDOW_TOKENS tokens, cut on
+             line breaks (ocr_json_1 stores no page boundaries, so a window approximates one or
+             two recorded pages)
+  2. map     every window is extracted on its own, in parallel (extract_data.py)
+  3. reduce  the candidates found for each runsheet field are merged by resolve_fields
+
+Instrument classification only needs the heading of the document, so it is given the first
+INSTRUMENT_PREFIX_CHARS characters of the text whatever the document length.
+
+Every document gets a TokenBudget of DOCUMENT_TOKEN_BUDGET tokens. Calls are reserved against it
+with their estimated size before they are sent; windows that no longer fit are skipped, which makes
+the document an extraction error (no runsheet from part of the pages). The budget report (used,
+reserved, skipped windows) is logged and returned with the extraction result.
+
+Configuration (.env):
+
+LONG_DOCUMENT_THRESHOLD_TOKENS=
+LONG_DOCUMENT_WINDOW_TOKENS=
+INSTRUMENT_PREFIX_CHARS=
+DOCUMENT_TOKEN_BUDGET=
+"""
+
+import os
+import threading
+from collections import Counter
+
+
+LONG_DOCUMENT_THRESHOLD_TOKENS = int(os.getenv("LONG_DOCUMENT_THRESHOLD_TOKENS", "12000"))
+LONG_DOCUMENT_WINDOW_TOKENS = int(os.getenv("LONG_DOCUMENT_WINDOW_TOKENS", "2000"))
+INSTRUMENT_PREFIX_CHARS = int(os.getenv("INSTRUMENT_PREFIX_CHARS", "4000"))
+DOCUMENT_TOKEN_BUDGET = int(os.getenv("DOCUMENT_TOKEN_BUDGET", "60000"))
+
+CHARS_PER_TOKEN = 4
+
+# Fields resolved by concatenating the distinct candidates of all windows instead of a vote
+CONCATENATED_FIELDS = {"property_description"}
+
+EMPTY_VALUES = {"", "n/a", "na", "none", "null", "not found", "not available", "unknown", "not specified"}
+
+
+def estimate_text_tokens(text):
+    return len(text or "") // CHARS_PER_TOKEN
+
+
+def is_long_document(ocr_text):
+    return estimate_text_tokens(ocr_text) > LONG_DOCUMENT_THRESHOLD_TOKENS
+
+
+# The part of the document the instrument type is read from: its first lines, cut on a line break.
+def instrument_prefix(ocr_text, max_chars=None):
+    max_chars = max_chars or INSTRUMENT_PREFIX_CHARS
+    if len(ocr_text) <= max_chars:
+        return ocr_text
+    cut = ocr_text.rfind("\n", 0, max_chars)
+    return ocr_text[:cut if cut > max_chars // 2 else max_chars]
+
+
+# Split text into consecutive windows of about window_tokens tokens, cut on line breaks.
+def split_windows(ocr_text, window_tokens=None):
+    max_chars = (window_tokens or LONG_DOCUMENT_WINDOW_TOKENS) * CHARS_PER_TOKEN
+    windows = []
+    start = 0
+    while start < len(ocr_text):
+        end = min(len(ocr_text), start + max_chars)
+        if end < len(ocr_text):
+            cut = ocr_text.rfind("\n", start, end)
+            if cut > start + max_chars // 2:
+                end = cut + 1
+        window = ocr_text[start:end]
+        if window.strip():
+            windows.append(window)
+        start = end
+    return windows
+
+
+class TokenBudget:
+    """Per-document token allowance. reserve() before a call, settle() with the real usage after it."""
+
+    def __init__(self, limit=None):
+        self.limit = DOCUMENT_TOKEN_BUDGET if limit is None else limit
+        self.used = 0
+        self.reserved = 0
+        self.calls = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    # Reserve estimated tokens for a call. Returns False (and counts the call as skipped) when it does not fit.
+    def reserve(self, estimated_tokens):
+        with self._lock:
+            if self.used + self.reserved + estimated_tokens > self.limit:
+                self.skipped += 1
+                return False
+            self.reserved += estimated_tokens
+            return True
+
+    def settle(self, estimated_tokens, used_tokens):
+        with self._lock:
+            self.reserved -= estimated_tokens
+            self.used += used_tokens if used_tokens is not None else estimated_tokens
+            self.calls += 1
+
+    # Count tokens of a call that was made without a reservation (the instrument type call).
+    def charge(self, used_tokens):
+        self.settle(0, used_tokens or 0)
+
+    def report(self):
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "used": self.used,
+                "reserved": self.reserved,
+                "calls": self.calls,
+                "skipped_calls": self.skipped,
+                "exceeded": self.skipped > 0,
+            }
+
+
+def is_empty_value(value):
+    if value is None:
+        return True
+    if isinstance(value, (list, dict)):
+        return not value
+    return str(value).strip().lower() in EMPTY_VALUES
+
+
+# Merge the per-window extractions into one value per field.
+# Voted fields take the value found in most windows (ties go to the earliest window),
+# concatenated fields keep every distinct value in window order.
+def resolve_fields(window_results, fields):
+    resolved = {}
+    candidates = {}
+    for field in fields:
+        values = [result.get(field) for result in window_results if isinstance(result, dict)]
+        values = [value.strip() if isinstance(value, str) else value for value in values if not is_empty_value(value)]
+        candidates[field] = len(values)
+        if not values:
+            resolved[field] = ""
+        elif field in CONCATENATED_FIELDS:
+            distinct = []
+            for value in values:
+                if value not in distinct:
+                    distinct.append(value)
+            resolved[field] = "; ".join(str(value) for value in distinct)
+        else:
+            keys = [str(value).lower() for value in values]
+            counts = Counter(keys)
+            best = max(counts.values())
+            resolved[field] = next(value for value, key in zip(values, keys) if counts[key] == best)
+    return resolved, candidates
@@ -0,0 +1,199 @@
+"""
+In-process metrics for the OCR and extraction pipeline, served at /metrics (ocr.py) in the
+Prometheus text format so they can be scraped instead of grepping logs.txt.
+
+The registry is deliberately small (counters, gauges and histograms with labels, no external
+dependency). Metrics are labeled by stage and, where it is known, by instrument type:
+
+  titlemine_download_seconds / _bytes                  S3 downloads
+  titlemine_ocr_request_seconds{provider,kind}         one OCR call (kind = file | chunk)
+  titlemine_ocr_seconds_per_page{provider,kind}        the same call divided by its page count
+  titlemine_ocr_response_bytes{provider}               serialized size of each OCR response document
+  titlemine_ocr_hedge_duplicates_total{provider}       losing hedged OCR requests that were sent anyway
+  titlemine_openai_request_seconds{stage,instrument_type}
+  titlemine_openai_tokens{stage,instrument_type,kind}  kind = prompt | completion | cached
+  titlemine_db_write_seconds{stage}
+  titlemine_cpu_task_seconds{task,where}               CPU-bound steps (cpu_pool.py), where = process | inline
+  titlemine_files_total{stage}                         files through each stage
+  titlemine_errors_total{stage}
+  titlemine_instrument_classifications_total{source}  local classifier or LLM
+  titlemine_rate_limited_total{provider}               429 / quota errors per provider
+  titlemine_queue_depth{pool}, titlemine_running{pool} scheduler pools, read at scrape time
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+from scheduler import scheduler
+
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = (64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2, 256 * 1024 ** 2)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+
+
+def format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines.extend(self._render_items(items))
+        return lines
+
+    def _render_items(self, items):
+        return [f"{self.name}{format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=(), collect=None):
+        super().__init__(name, help_text, labelnames)
+        self.collect = collect  # Optional callback returning {label values tuple: value}, called at render time
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def render(self):
+        if self.collect is not None:
+            values = self.collect()
+            with self._lock:
+                self._values = dict(values)
+        return super().render()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.observers = []  # callback(value, labels) per observation, e.g. benchmark.py's sample recorder
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][index] += 1
+            state["sum"] += value
+            state["count"] += 1
+        for observer in self.observers:
+            observer(value, labels)
+
+    def add_observer(self, callback):
+        self.observers.append(callback)
+
+    def _matches(self, key, labels):
+        return all(key[self.labelnames.index(name)] == str(value) for name, value in labels.items())
+
+    def count(self, **labels):
+        with self._lock:
+            return sum(state["count"] for key, state in self._values.items() if self._matches(key, labels))
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def _render_items(self, items):
+        lines = []
+        for key, state in items:
+            for bound, count in zip(self.buckets, state["counts"]):
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, [('le', bound)])} {count}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, [('le', '+Inf')])} {state['count']}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {round(state['sum'], 6)}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {state['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=(), collect=None):
+        return self._register(Gauge(name, help_text, labelnames, collect))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def _pool_values(field):
+    return lambda: {(name,): stats[field] for name, stats in scheduler.stats()["pools"].items()}
+
+
+registry = MetricsRegistry()
+
+download_seconds = registry.histogram("titlemine_download_seconds", "S3 download time per file")
+download_bytes = registry.histogram("titlemine_download_bytes", "S3 download size per file", buckets=BYTES_BUCKETS)
+ocr_request_seconds = registry.histogram("titlemine_ocr_request_seconds", "OCR call latency", ("provider", "kind"))
+ocr_seconds_per_page = registry.histogram("titlemine_ocr_seconds_per_page", "OCR call latency divided by its page count",
+                                          ("provider", "kind"), buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30))
+ocr_response_bytes = registry.histogram("titlemine_ocr_response_bytes", "Serialized size of each OCR response document",
+                                        ("provider",), buckets=BYTES_BUCKETS)
+ocr_hedge_duplicates_total = registry.counter("titlemine_ocr_hedge_duplicates_total",
+                                              "Losing hedged OCR requests that still ran (duplicate cost)", ("provider",))
+openai_request_seconds = registry.histogram("titlemine_openai_request_seconds", "OpenAI call latency",
+                                            ("stage", "instrument_type"))
+openai_tokens = registry.histogram("titlemine_openai_tokens", "OpenAI tokens per call",
+                                   ("stage", "instrument_type", "kind"), buckets=TOKEN_BUCKETS)
+db_write_seconds = registry.histogram("titlemine_db_write_seconds", "Database write latency", ("stage",))
+cpu_task_seconds = registry.histogram("titlemine_cpu_task_seconds", "CPU-bound task time, pool queueing included",
+                                      ("task", "where"))
+files_total = registry.counter("titlemine_files_total", "Files completed per stage", ("stage",))
+errors_total = registry.counter("titlemine_errors_total", "Errors per stage", ("stage",))
+instrument_classifications_total = registry.counter("titlemine_instrument_classifications_total",
+                                                    "Instrument type decisions by source (local | llm)", ("source",))
+rate_limited_total = registry.counter("titlemine_rate_limited_total", "Rate limit (429 / quota) responses", ("provider",))
+queue_depth = registry.gauge("titlemine_queue_depth", "Tasks waiting in each scheduler pool", ("pool",), _pool_values("queued"))
+running_tasks = registry.gauge("titlemine_running", "Tasks running in each scheduler pool", ("pool",), _pool_values("running"))
@@ -0,0 +1,93 @@
+"""
+Migration: unique index on public.runsheets (file_id, project_id).
+
+The bulk extraction path (store_extracted_data_bulk in extract_data.py) upserts runsheets with
+INSERT ... ON CONFLICT (file_id, project_id), which needs a unique index on the conflict target.
+The per-file path never prevented duplicate runsheets, so existing tables may hold several rows per
+(file_id, project_id); all but the newest row (highest id) of each pair must go before the index can be
+created. That deletes production data, so it is run explicitly and reviewed first:
+
+    python migrate_runsheets.py            # dry run: lists the duplicate rows that would be removed
+    python migrate_runsheets.py --apply    # removes them (logging every one) and creates the index
+
+CREATE UNIQUE INDEX (not CONCURRENTLY, it runs in the migration's transaction) blocks writes to
+runsheets until it is done, so run the migration while extraction is stopped.
+
+extract_data.py only checks that the index exists and refuses bulk writes until it does.
+"""
+
+import sys
+import logging
+import argparse
+
+from db import db_connection
+
+
+RUNSHEETS_UNIQUE_INDEX = "runsheets_file_id_project_id_key"
+
+# Whether public.runsheets already has a unique index (or constraint) on exactly (file_id, project_id).
+RUNSHEETS_UNIQUE_INDEX_EXISTS_QUERY = """
+    SELECT 1 FROM pg_index i
+    JOIN pg_class t ON t.oid = i.indrelid
+    JOIN pg_namespace n ON n.oid = t.relnamespace
+    WHERE n.nspname = 'public' AND t.relname = 'runsheets' AND i.indisunique AND i.indpred IS NULL
+      AND i.indnatts = 2
+      AND (SELECT array_agg(a.attname::text ORDER BY a.attname) FROM pg_attribute a
+           WHERE a.attrelid = t.oid AND a.attnum = ANY(i.indkey)) = ARRAY['file_id', 'project_id']
+"""
+
+# Rows that share their (file_id, project_id) with a newer row (higher id); these are the ones removed.
+# ids come from the SERIAL primary key, unlike ctid they do not move on UPDATE or VACUUM.
+DUPLICATE_RUNSHEETS_QUERY = """
+    SELECT a.id, a.file_id, a.project_id FROM public.runsheets a
+    WHERE EXISTS (SELECT 1 FROM public.runsheets b
+                  WHERE b.file_id = a.file_id AND b.project_id = a.project_id AND a.id < b.id)
+    ORDER BY a.project_id, a.file_id, a.id
+"""
+
+
+def runsheets_unique_index_exists(cur):
+    cur.execute(RUNSHEETS_UNIQUE_INDEX_EXISTS_QUERY)
+    return cur.fetchone() is not None
+
+
+# Remove duplicate runsheets and create the unique index. Without apply, only report what would be removed.
+# An advisory lock keeps two migrations from running at the same time.
+def migrate(apply=False):
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (RUNSHEETS_UNIQUE_INDEX,))
+            if runsheets_unique_index_exists(cur):
+                logging.info("public.runsheets already has a unique index on (file_id, project_id), nothing to do")
+                return 0
+            cur.execute(DUPLICATE_RUNSHEETS_QUERY)
+            duplicates = cur.fetchall()
+            for runsheet_id, file_id, project_id in duplicates:
+                logging.info(f"{'Removing' if apply else 'Would remove'} duplicate runsheet id={runsheet_id} "
+                             f"file_id={file_id} project_id={project_id}")
+            if not apply:
+                logging.info(f"Dry run: {len(duplicates)} duplicate runsheets would be removed; rerun with --apply")
+                return len(duplicates)
+            cur.execute("""
+                DELETE FROM public.runsheets a USING public.runsheets b
+                WHERE a.file_id = b.file_id AND a.project_id = b.project_id AND a.id < b.id
+            """)
+            removed = cur.rowcount
+            logging.warning(f"Removed {removed} duplicate runsheets")
+            cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {RUNSHEETS_UNIQUE_INDEX} "
+                        f"ON public.runsheets (file_id, project_id)")
+            logging.info(f"Created unique index {RUNSHEETS_UNIQUE_INDEX} on public.runsheets")
+            return removed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create the unique (file_id, project_id) index on public.runsheets")
+    parser.add_argument("--apply", action="store_true", help="remove the duplicates and create the index")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    migrate(apply=args.apply)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,7 +10,8 @@ Fetch all files under the given project_id where OCR processing is incomplete.
 Download all these files from their respective S3 URLs concurrently.
 Perform OCR processing on these files using Google’s Document AI.
 Store the extracted OCR text in the database table OCR_data (columns: ocr_text_1 and ocr_json_1).
-Along with OCR Text data, extract the JSON with OCR confidence from Document AI and store it in ocr_json_1.
+Along with OCR Text data, extract the JSON with OCR confidence from Document AI and store it in ocr_json_1
+(compact format 2: text once plus offset/confidence arrays, see ocr_format.py).
 When OCR processing is complete, update the ocr_status of all processed files to "Completed".
 Limitations:
 
@@ -19,11 +20,16 @@ Document AI has a file size limit of 20 MB for single-file processing.
 Processing is limited by API rate limits of Google Document AI.
 To-Do:
 
-Add a second OCR Provider: Amazon Textract or Anthropic.
-Switch to Batch Processing Mode on Document AI to disable the file size limit.
+Add a second OCR Provider: Amazon Textract or Anthropic (implement OcrProvider in ocr_providers.py).
+Batch Processing Mode on Document AI (no file size limit) is available with OCR_BACKEND=batch, see docai_batch.py.
 API Endpoint:
 https://host:port/api/v1/batch_ocr/:project_id
 
+Background OCR + extraction runs as a durable job (see jobs.py):
+https://host:port/start-extraction/:project_id       queue a job (idempotent per project)
+https://host:port/extraction-status/:project_id      job status with per-stage progress
+https://host:port/metrics                             Prometheus metrics per stage (see metrics.py)
+
 Response:
 
 Processing:
@@ -55,7 +61,8 @@ requests
 google.cloud
 json
 os
-concurrent.futures (for parallel processing)
+concurrent.futures (for parallel processing, through the shared pools in scheduler.py;
+                    PDF parsing, splitting and JSON serialization run in the process pool in cpu_pool.py)
 
 
 The .env file is expected to contain the following environment variables:
@@ -63,6 +70,7 @@ The .env file is expected to contain the following environment variables:
 GOOGLE_APPLICATION_CREDENTIALS=
 CREDENTIALS_PATH=
 
+DATABASE_URL=    (optional, takes precedence over the DB_* variables)
 DB_NAME=
 DB_HOST=
 DB_PORT=
@@ -73,6 +81,12 @@ PROJECT_ID =
 LOCATION = 
 PROCESSOR_ID = 
 
+OCR_BACKEND =        (online or batch)
+OCR_PROVIDER =       (documentai or fake, see ocr_providers.py for hedged requests)
+OPENAI_BACKEND =     (online or batch, see openai_batch.py for overnight backfills through the Batch API; batch needs EXTRACTION_MODE=serial)
+EXTRACTION_MODE =    (serial, pipeline or async: one event loop with aiohttp, async Document AI, AsyncOpenAI and asyncpg)
+ASYNC_MAX_IN_FLIGHT = ASYNC_DOWNLOAD_CONCURRENCY = ASYNC_OCR_FILES = ASYNC_DOCAI_CONCURRENCY =
+
 """
 
 
@@ -90,13 +104,29 @@ import json
 import PyPDF2
 from PyPDF2 import PdfReader, PdfWriter
 from PyPDF2.errors import PdfReadError
-from flask import Flask, jsonify, request
-from google.cloud import documentai_v1 as documentai
+from flask import Flask, Response, jsonify, request
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor
 import logging
 import threading
+import contextvars
+import time
+import queue
+import asyncio
+from concurrent.futures import as_completed
 from extract_data import *
+from ocr_cache import ocr_cache
+from cpu_pool import cpu_pool, ocr_data_size
+from cpu_worker import plan_pdf, split_for_batch, write_json_file
+from docai_batch import run_batch_ocr
+from scheduler import scheduler
+from s3_download import download_to_file, download_to_file_async, create_async_session, DownloadCache
+from db import db_connection, create_async_pool
+from ocr_format import ocr_column_values
+from jobs import JobWaiting, JobWorkerPool, enqueue_job, get_job_status, report_progress
+from ocr_providers import create_ocr_provider
+from openai_batch import OPENAI_BACKEND, has_saved_batches, process_documents_batch
+import metrics
+from text_layer import TEXT_LAYER_FAST_PATH, text_layer_result
 
 
 # Load environment variables
@@ -112,14 +142,8 @@ os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = credentials_path
 # Initialize Flask App
 app = Flask(__name__)
 
-# Database Configuration
-DB_CONFIG = {
-    "dbname": os.getenv("DB_NAME"),
-    "host": os.getenv("DB_HOST"),
-    "port": os.getenv("DB_PORT"),
-    "user": os.getenv("DB_USER"),
-    "password": os.getenv("DB_PASSWORD"),
-}
+# Database Configuration: connections come from the shared pool in db.py,
+# which uses DATABASE_URL or falls back to the DB_* variables.
 
 
 # Google Document AI Configuration
@@ -127,10 +151,58 @@ PROJECT_ID = os.getenv("PROJECT_ID")
 LOCATION = os.getenv("LOCATION")
 PROCESSOR_ID = os.getenv("PROCESSOR_ID")
 
+# OCR provider for online processing: Document AI by default, optionally hedged (OCR_PROVIDER, OCR_HEDGE)
+ocr_provider = create_ocr_provider(PROJECT_ID, LOCATION, PROCESSOR_ID)
+
 
-# Folder to store downloaded and OCR files
+# Folder to store downloaded and OCR files, kept under DOWNLOAD_CACHE_MAX_MB by LRU eviction
 DOWNLOAD_FOLDER = "download_file"
 os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+download_cache = DownloadCache(
+    DOWNLOAD_FOLDER,
+    max_bytes=int(float(os.getenv("DOWNLOAD_CACHE_MAX_MB", "5120")) * 1024 * 1024),
+    min_age_seconds=float(os.getenv("DOWNLOAD_CACHE_MIN_AGE_SECONDS", "3600")),
+)
+
+# OCR backend: "online" sends one synchronous process_document call per file or chunk,
+# "batch" submits every file of a request as one Document AI batch operation (see docai_batch.py).
+OCR_BACKEND = os.getenv("OCR_BACKEND", "online")
+
+# Document AI synchronous processing limits and the number of chunks of one file OCR'd at the same time
+MAX_OCR_SIZE_MB = 20
+MAX_OCR_PAGES = 15
+OCR_CHUNK_CONCURRENCY = int(os.getenv("OCR_CHUNK_CONCURRENCY", "4"))
+
+# Retries of failed OCR calls (only the failed chunks are sent again) with exponential back-off
+OCR_CHUNK_RETRIES = int(os.getenv("OCR_CHUNK_RETRIES", "3"))
+OCR_RETRY_BASE_SECONDS = float(os.getenv("OCR_RETRY_BASE_SECONDS", "2"))
+OCR_RETRY_MAX_SECONDS = float(os.getenv("OCR_RETRY_MAX_SECONDS", "30"))
+
+# Serial mode commits OCR results every OCR_COMMIT_BATCH_SIZE files, so an interrupted run only redoes
+# the files OCR'd since the last commit (committed files leave the 'Processing' status)
+OCR_COMMIT_BATCH_SIZE = int(os.getenv("OCR_COMMIT_BATCH_SIZE", "10"))
+
+# Extraction mode: "serial" runs OCR for the whole project before OpenAI extraction,
+# "pipeline" streams every file to extraction as soon as its OCR result is committed,
+# "async" does the same on one event loop instead of threads (see the async execution mode section).
+EXTRACTION_MODE = os.getenv("EXTRACTION_MODE", "serial")
+
+# The OpenAI Batch API backend (openai_batch.py) works on a whole project's backlog at once, so only
+# the serial mode uses it; pipeline and async extract each file online as soon as it is OCR'd.
+if OPENAI_BACKEND == "batch" and EXTRACTION_MODE != "serial":
+    raise ValueError(f"OPENAI_BACKEND=batch requires EXTRACTION_MODE=serial, not {EXTRACTION_MODE}")
+
+# Streaming pipeline configuration
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "8"))
+PIPELINE_DOWNLOAD_WORKERS = int(os.getenv("PIPELINE_DOWNLOAD_WORKERS", "4"))
+PIPELINE_OCR_WORKERS = int(os.getenv("PIPELINE_OCR_WORKERS", "4"))
+PIPELINE_EXTRACT_WORKERS = int(os.getenv("PIPELINE_EXTRACT_WORKERS", "2"))
+
+# Async mode configuration
+ASYNC_MAX_IN_FLIGHT = int(os.getenv("ASYNC_MAX_IN_FLIGHT", "200"))
+ASYNC_DOWNLOAD_CONCURRENCY = int(os.getenv("ASYNC_DOWNLOAD_CONCURRENCY", "32"))
+ASYNC_OCR_FILES = int(os.getenv("ASYNC_OCR_FILES", "16"))
+ASYNC_DOCAI_CONCURRENCY = int(os.getenv("ASYNC_DOCAI_CONCURRENCY", "32"))
 
 
 
@@ -149,9 +221,6 @@ def save_project_files_to_variable(project_id, user_id, files):
 # Get files which not completed ocr by project ID from the database and save them to a JSON file
 def get_files_by_project(project_id): 
     """Fetch all file IDs for a given project."""
-    conn = psycopg2.connect(**DB_CONFIG)
-    cur = conn.cursor()
-
     query = """
     SELECT id, user_id, project_id, file_name, s3_url, ocr_status 
     FROM public.files 
@@ -165,11 +234,11 @@ def get_files_by_project(project_id):
     # Extracting: OCR is complete and OpenAI Extraction is in progress
     # Completed: Runsheet is inserted for this file.
 
-    cur.execute(query, (project_id,))
-    files = cur.fetchall()
-    print(files)
-    cur.close()
-    conn.close()
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query, (project_id,))
+            files = cur.fetchall()
+    logging.debug(f"{len(files)} files pending OCR for project_id: {project_id}")
 
     # Save project ID and file IDs to a JSON file
     if files:
@@ -179,9 +248,6 @@ def get_files_by_project(project_id):
     return files
 
 def get_single_file_by_file_id(file_id): 
-    conn = psycopg2.connect(**DB_CONFIG)
-    cur = conn.cursor()
-
     query = """
     SELECT id, user_id, project_id, file_name, s3_url, ocr_status 
     FROM public.files 
@@ -189,11 +255,10 @@ def get_single_file_by_file_id(file_id):
     AND (ocr_status = 'Processing')
     """
     # Ensure OCR Status in files table before using this function.
-    cur.execute(query, (file_id,))
-    files = cur.fetchall()
-
-    cur.close()
-    conn.close()
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query, (file_id,))
+            files = cur.fetchall()
 
     # Save project ID and file IDs to a JSON file
     if files:
@@ -206,22 +271,44 @@ def get_single_file_by_file_id(file_id):
 
 
 
+# Local path of a downloaded file, and whether it is already there (then it counts as recently used).
+def download_target(user_id, project_id, file_id, file_extension):
+    file_name = f"download_pdf_{user_id}_{project_id}_{file_id}{file_extension}"
+    file_path = os.path.join(DOWNLOAD_FOLDER, file_name)
+    if os.path.exists(file_path):  # Only complete files exist under this name, partial ones end in .part
+        download_cache.touch(file_path)
+        return file_path, True
+    return file_path, False
+
+
+def record_download_error(s3_url, error):
+    logging.error(f"Failed to download file from S3: {s3_url} : {error}")
+    metrics.errors_total.inc(stage="download")
+
+
+def record_download(result, project_id, file_id):
+    metrics.download_seconds.observe(result.seconds)
+    metrics.download_bytes.observe(result.size_bytes)
+    metrics.files_total.inc(stage="download")
+    logging.info(f"Downloaded file from S3: file_id: {file_id}; project_id {project_id}; "
+                 f"{result.size_bytes / (1024 * 1024):.2f} MB in {result.seconds:.2f}s ({result.mb_per_second:.2f} MB/s)")
+
+
 # The download_file_from_s3 function downloads a file from an S3 URL and saves it locally.
+# Downloads go through the pooled, resumable engine in s3_download.py; files already in the download folder are reused.
 def download_file_from_s3(s3_url, user_id, project_id, file_id, file_extension):
     """Download a file from S3 URL and save it locally"""
-    file_name = f"download_pdf_{user_id}_{project_id}_{file_id}{file_extension}"
-    file_path = os.path.join(DOWNLOAD_FOLDER, file_name)
-    if os.path.exists(file_path):
+    file_path, exists = download_target(user_id, project_id, file_id, file_extension)
+    if exists:
         return file_path
-    response = requests.get(s3_url, stream=True)
-    if response.status_code == 200:
-        with open(file_path, "wb") as file: 
-            for chunk in response.iter_content(1024):
-                file.write(chunk)
-        logging.info(f"Downloaded file from S3: file_id: {file_id}; project_id {project_id}")
-        return file_path 
-    logging.error(f"Failed to download file from S3: {s3_url}")
-    return None
+    try:
+        result = download_to_file(s3_url, file_path)
+    except Exception as e:
+        record_download_error(s3_url, e)
+        return None
+    record_download(result, project_id, file_id)
+    download_cache.evict()
+    return file_path
 
 
 
@@ -239,6 +326,7 @@ def download_files_concurrently(files):
             pdf_file_path = download_file_from_s3(s3_url, user_id, project_id, id, file_extension)
             if pdf_file_path:
                 downloaded_files.append(pdf_file_path)
+                report_progress("downloaded")
             else:
                 logging.error(f"Failed to download file from S3: {file_name} : {s3_url} project_id: {project_id}")
                 
@@ -249,15 +337,20 @@ def download_files_concurrently(files):
         logging.error(f"No files to download. project_id: {temp_project_id}")
         return []
 
-    with ThreadPoolExecutor() as executor:    # No limit on concurrent downloads
-        executor.map(download_file, files)
+    started = time.monotonic()
+    scheduler.map("download", download_file, files)    # Bounded by the shared download pool
+    elapsed = time.monotonic() - started
 
     logging.info(f"All files downloaded. project_id: {temp_project_id}")
 
+    total_size = 0
     for file_path in downloaded_files:
         file_size = os.path.getsize(file_path) / (1024 * 1024)  # Convert size to MB
+        total_size += file_size
         file_size_formatted = f"{file_size:.2f}"  # Format file size to 2 decimal places
         file_sizes.append({"file_name": os.path.basename(file_path), "file_size": file_size_formatted})
+    logging.info(f"Download throughput for project_id {temp_project_id}: {len(downloaded_files)} files, "
+                 f"{total_size:.2f} MB in {elapsed:.2f}s ({total_size / elapsed if elapsed > 0 else 0:.2f} MB/s, cache hits included)")
 
     return downloaded_files, file_sizes
 
@@ -265,9 +358,8 @@ def download_files_concurrently(files):
 def save_ocr_output_as_json(user_id, project_id, file_id, extracted_data):
     """Save OCR output as JSON."""
     ocr_file_path = os.path.join(DOWNLOAD_FOLDER, f"download_json_{user_id}_{project_id}_{file_id}.json")
-    with open(ocr_file_path, "w", encoding="utf-8") as json_file:
-        json.dump(extracted_data, json_file, indent=4, ensure_ascii=False)
-        logging.info(f"OCR JSON saved successfully: {ocr_file_path}")
+    cpu_pool.run(write_json_file, ocr_file_path, extracted_data, size=ocr_data_size(extracted_data))  # indent=4 is pure-Python JSON
+    logging.info(f"OCR JSON saved successfully: {ocr_file_path}")
 
 #  This function iterates through a list of extracted OCR data and saves each entry as a JSON file using the save_ocr_output_as_json function.
 def save_ocr_outputs_as_json(extracted_data_list):
@@ -280,106 +372,263 @@ def save_ocr_outputs_as_json(extracted_data_list):
         save_ocr_output_as_json(user_id, project_id, file_id, extracted_data)
 
 
-def extract_text_with_confidence(file_path):
-    """Extracts text and confidence scores from a document using Google Document AI"""
-    
-    if not os.path.exists(credentials_path):
-        raise FileNotFoundError(f"Credentials file not found: {credentials_path}")
+# OCR cache key of a file and its cached result (None on a miss).
+def cached_ocr_result(file_path):
+    cache_key = ocr_cache.key_for_file(file_path)
+    cached_data = ocr_cache.get(cache_key)
+    if cached_data is not None:
+        logging.info(f"OCR cache hit: {file_path}")
+    return cache_key, cached_data
 
-    def split_pdf(file_path, start_page, end_page):
-        with open(file_path, 'rb') as file:
-            reader = PdfReader(file)
-            writer = PdfWriter()
-            for page_num in range(start_page, end_page):
-                writer.add_page(reader.pages[page_num])
-            split_file_path = f"{os.path.splitext(file_path)[0]}_pages_{start_page+1}_to_{end_page}.pdf"
-            with open(split_file_path, 'wb') as output_file:
-                writer.write(output_file)
-            return split_file_path
-
-    def process_document(file_path):
-        client = documentai.DocumentProcessorServiceClient()
-        with open(file_path, "rb") as file:
-            content = file.read()
-        raw_document = documentai.RawDocument(content=content, mime_type="application/pdf")
-        name = f"projects/{PROJECT_ID}/locations/{LOCATION}/processors/{PROCESSOR_ID}"
-        request = documentai.ProcessRequest(name=name, raw_document=raw_document)
-
-        # Debugging statement to log request details
-        logging.info(f"Processing document: {file_path}, Size: {len(content)} bytes")
-
-        response = client.process_document(request=request)
-
-        # Debugging statement to log response details
-        logging.info(f"Document processed: {file_path}, Size: {len(content)} bytes")
-
-        document_dict = documentai.Document.to_dict(response.document)
-        extracted_text = document_dict.get("text", "")
-        extracted_data = {"text": extracted_text, "confidence_scores": []}
-
-        for page in response.document.pages:
-            for block in page.blocks:
-                for segment in block.layout.text_anchor.text_segments:
-                    segment_text = document_dict["text"][segment.start_index:segment.end_index]
-                    confidence = block.layout.confidence
-                    extracted_data["confidence_scores"].append({
-                        "text": segment_text,
-                        "confidence": confidence
-                    })
-
-        return extracted_data
-
-    def split_and_process(file_path, max_size_mb=20, max_pages=15):
-        total_size_mb = os.path.getsize(file_path) / (1024 * 1024)
-        with open(file_path, 'rb') as file:
-            reader = PdfReader(file)
-            total_pages = len(reader.pages)
-            size_per_page_mb = total_size_mb / total_pages
 
-        if total_size_mb <= max_size_mb and total_pages <= max_pages:
-            return [process_document(file_path)]
-
-        start_page = 0
-        extracted_data = []
-
-        while start_page < total_pages:
-            end_page = start_page
-            current_size_mb = 0
-            while end_page < total_pages and current_size_mb + size_per_page_mb <= max_size_mb and (end_page - start_page) < max_pages:
-                current_size_mb += size_per_page_mb
-                end_page += 1
-
-            split_file_path = split_pdf(file_path, start_page, end_page)
-            extracted_data.extend(split_and_process(split_file_path))
+def extract_text_with_confidence(file_path):
+    """Extracts text and confidence scores from a document, using the OCR cache before Google Document AI"""
+    cache_key, cached_data = cached_ocr_result(file_path)
+    if cached_data is not None:
+        return cached_data
 
-            start_page = end_page
+    extracted_data = run_document_ai_ocr(file_path, cache_key)
+    cache_ocr_result(cache_key, extracted_data)
+    return extracted_data
 
-        return extracted_data
 
-    total_size_mb = os.path.getsize(file_path) / (1024 * 1024)
-    with open(file_path, 'rb') as file:
-        reader = PdfReader(file)
-        num_pages = len(reader.pages)
+def run_document_ai_ocr(file_path, file_key=None):
+    """Extracts text and confidence scores from a document using Google Document AI"""
+    plan = plan_document_ocr(file_path, file_key)
+    if plan.done:
+        return plan.result
+    return plan.merge(ocr_chunks(file_path, plan.file_key, plan.chunks, plan.kind))
+
+
+class OcrPlan:
+    """What is left to OCR for one file: the chunks to send, plus the parts already known
+    (checkpointed chunks and text-layer pages). done is True when no OCR call is needed."""
+
+    def __init__(self, done=False, result=None, chunks=(), kind="chunk", file_key=None, checkpointed=None, text_layer_pages=None):
+        self.done = done
+        self.result = result
+        self.chunks = chunks
+        self.kind = kind
+        self.file_key = file_key
+        self.checkpointed = checkpointed or {}
+        self.text_layer_pages = text_layer_pages or {}
+
+    # Combine the OCR results of self.chunks (in chunk order) with the known parts, in page order.
+    def merge(self, chunk_results):
+        if self.kind == "file":
+            return chunk_results[0]
+        parts = list(self.checkpointed.items())
+        parts.extend((start_page, result) for (start_page, _, _), result in zip(self.chunks, chunk_results))
+        parts.extend((page_num, text_layer_result([route])) for page_num, route in self.text_layer_pages.items())
+        parts.sort(key=lambda part: part[0])
+        return merge_chunk_results([result for _, result in parts])
+
+
+# Read a PDF and decide how it is OCR'd: text layer only, one call for the whole file, or chunks
+# (text-layer pages left out, checkpointed chunks reused). No OCR call; the PDF is parsed once, in the
+# CPU pool. file_key is the file's OCR cache key when the caller already hashed it.
+def plan_document_ocr(file_path, file_key=None):
+    if not os.path.exists(credentials_path):
+        raise FileNotFoundError(f"Credentials file not found: {credentials_path}")
 
-        # Extract file ID from the file path
+    # Extract file ID from the file path
     file_id = os.path.basename(file_path).split('_')[4].split('.')[0]
 
-    if total_size_mb > 20 and num_pages == 1:
-        # print('Splitting for this file is not possible !')
-        logging.error(f'Splitting for this file is not possible! File ID: {file_id}')
-    elif total_size_mb > 20:
-        return split_and_process(file_path)
-    elif num_pages > 15:
-        extracted_data = []
-        for start_page in range(0, num_pages, 15):
-            end_page = min(start_page + 15, num_pages)
-            split_file_path = split_pdf(file_path, start_page, end_page)
-            extracted_data.extend(split_and_process(split_file_path))
-        return extracted_data
-    else:
-        return process_document(file_path)
-
+    # Page count, text layer and chunk PDFs in a worker process, which maps the file instead of receiving its bytes
+    max_bytes = MAX_OCR_SIZE_MB * 1024 * 1024
+    pdf = cpu_pool.run(plan_pdf, file_path, file_id, TEXT_LAYER_FAST_PATH, max_bytes, MAX_OCR_PAGES,
+                       size=os.path.getsize(file_path))
 
+    # Pages with a good embedded text layer are read locally, only the rest go to Document AI
+    if pdf.kind == "text_layer":
+        logging.info(f"All {pdf.page_count} pages read from the text layer, Document AI skipped. File ID: {file_id}")
+        return OcrPlan(done=True, result=text_layer_result(pdf.routes))
+    if pdf.kind == "too_large":
+        logging.error(f'Splitting for this file is not possible! File ID: {file_id}')
+        return OcrPlan(done=True)
+    if pdf.kind == "file":
+        with open(file_path, 'rb') as file:
+            return OcrPlan(chunks=[(0, pdf.page_count, file.read())], kind="file")
+
+    # Chunks checkpointed by an earlier attempt are not sent again
+    text_layer_pages = {route.page_num: route for route in pdf.routes if route.use_text_layer}
+    file_key = file_key or ocr_cache.key_for_file(file_path)
+    checkpointed = {}
+    chunks = []
+    for chunk in pdf.chunks:
+        checkpoint = ocr_cache.get(ocr_cache.key_for_chunk(file_key, chunk[0], chunk[1]))
+        if checkpoint is None:
+            chunks.append(chunk)
+        else:
+            checkpointed[chunk[0]] = checkpoint
+    if checkpointed:
+        logging.info(f"Resuming from checkpoints: {len(checkpointed)} chunks done, {len(chunks)} to OCR. File ID: {file_id}")
+    logging.info(f"Processing {len(chunks)} chunks concurrently ({len(text_layer_pages)} pages from the text layer). File ID: {file_id}")
+    return OcrPlan(chunks=chunks, file_key=file_key, checkpointed=checkpointed, text_layer_pages=text_layer_pages)
+
+
+class ChunkAttempts:
+    """Retry bookkeeping of ocr_chunks and ocr_chunks_async: the chunks still to OCR, the results so far
+    and the back-off before each attempt. The two only differ in how they send and wait."""
+
+    def __init__(self, file_path, chunks, kind):
+        self.file_path = file_path
+        self.chunks = chunks
+        self.kind = kind
+        self.results = {}
+        self.pending = list(range(len(chunks)))
+
+    # Delay before each attempt while chunks are pending: 0, then bounded exponential back-off.
+    def delays(self):
+        for attempt in range(OCR_CHUNK_RETRIES + 1):
+            if not self.pending:
+                return
+            delay = 0
+            if attempt:
+                delay = min(OCR_RETRY_MAX_SECONDS, OCR_RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+                logging.warning(f"Retrying {len(self.pending)} of {len(self.chunks)} {self.kind}s in {delay:.1f}s "
+                                f"(attempt {attempt + 1}): {self.file_path}")
+            yield delay
+
+    def label(self, chunk):
+        start_page, end_page, _ = chunk
+        return self.file_path if self.kind == "file" else f"{self.file_path} pages {start_page + 1} to {end_page}"
+
+    # Take the outcomes of an attempt, (chunk index, result or exception) pairs; failed chunks stay pending.
+    def record(self, outcomes):
+        self.pending = []
+        for index, outcome in outcomes:
+            if isinstance(outcome, BaseException):
+                start_page, end_page, _ = self.chunks[index]
+                logging.error(f"OCR failed for pages {start_page + 1} to {end_page} of {self.file_path}: {outcome}")
+                self.pending.append(index)
+            else:
+                self.results[index] = outcome
+
+    def final_results(self):
+        if self.pending:
+            raise RuntimeError(f"OCR failed for {len(self.pending)} of {len(self.chunks)} {self.kind}s "
+                               f"after {OCR_CHUNK_RETRIES + 1} attempts: {self.file_path}")
+        return [self.results[index] for index in range(len(self.chunks))]
+
+
+# Checkpoint a finished chunk under the file's key, so an interrupted file resumes from it.
+def checkpoint_chunk(file_key, chunk, result):
+    if file_key is not None:
+        start_page, end_page, _ = chunk
+        cache_ocr_result(ocr_cache.key_for_chunk(file_key, start_page, end_page), result)
+
+
+# OCR (start_page, end_page, content) chunks on the shared Document AI pool, at most OCR_CHUNK_CONCURRENCY
+# of this file at a time. Every chunk is checkpointed as soon as it is done (when file_key is given);
+# failed chunks are retried alone with bounded exponential back-off. Returns the results in chunk order.
+def ocr_chunks(file_path, file_key, chunks, kind):
+    file_slots = threading.BoundedSemaphore(OCR_CHUNK_CONCURRENCY)
+    attempts = ChunkAttempts(file_path, chunks, kind)
+
+    def process_chunk(chunk):
+        start_page, end_page, chunk_content = chunk
+        result = process_document(chunk_content, attempts.label(chunk), end_page - start_page, kind)
+        checkpoint_chunk(file_key, chunk, result)
+        return result
+
+    def submit_chunk(chunk):
+        file_slots.acquire()
+        future = scheduler.submit("docai", process_chunk, chunk)
+        future.add_done_callback(lambda _: file_slots.release())
+        return future
+
+    for delay in attempts.delays():
+        time.sleep(delay)
+        futures = [(index, submit_chunk(chunks[index])) for index in attempts.pending]
+        attempts.record([(index, future.exception() or future.result()) for index, future in futures])
+    return attempts.final_results()
+
+
+# Sends one PDF (a whole file or an in-memory chunk) to the configured OCR provider (see ocr_providers.py)
+# and returns its text and block confidences. Every confidence entry carries start_index/end_index offsets into "text".
+def process_document(content, label, pages=None, kind="file"):
+    started = time.monotonic()
+    try:
+        extracted_data = ocr_provider.process(content, label)
+    except Exception as e:
+        record_ocr_error(e)
+        raise
+    record_ocr_call(time.monotonic() - started, pages, kind)
+    return extracted_data
+
+
+def record_ocr_error(error):
+    metrics.errors_total.inc(stage="ocr")
+    if type(error).__name__ in ("ResourceExhausted", "TooManyRequests"):
+        metrics.rate_limited_total.inc(provider=ocr_provider.name)
+
+
+def record_ocr_call(elapsed, pages, kind):
+    metrics.ocr_request_seconds.observe(elapsed, provider=ocr_provider.name, kind=kind)
+    if pages:
+        metrics.ocr_seconds_per_page.observe(elapsed / pages, provider=ocr_provider.name, kind=kind)
+
+
+# Merge chunk OCR results (in page order) into one document, shifting offsets by the text that precedes each chunk.
+def merge_chunk_results(chunk_results):
+    merged = {"text": "", "confidence_scores": []}
+    text_parts = []
+    offset = 0
+    for result in chunk_results:
+        for score in result["confidence_scores"]:
+            score = dict(score)
+            if "start_index" in score:
+                score["start_index"] += offset
+                score["end_index"] += offset
+            merged["confidence_scores"].append(score)
+        text_parts.append(result["text"])
+        offset += len(result["text"])
+    merged["text"] = "".join(text_parts)
+    answered_by = sorted({result["answered_by"] for result in chunk_results if result.get("answered_by")})
+    if answered_by:
+        merged["answered_by"] = ",".join(answered_by)
+    return merged
+
+
+# Put an OCR result in the cache, unless there is none or (part of) it came from a hedging backup
+# provider (answered_by), which does not belong in the primary provider's cache namespace.
+def cache_ocr_result(cache_key, extracted_data):
+    if extracted_data is None or extracted_data.get("answered_by"):
+        return
+    ocr_cache.put(cache_key, extracted_data)
+
+
+
+
+# Extract user_id, project_id, and file_id from a download_pdf_<user_id>_<project_id>_<file_id>.pdf file name
+def parse_download_file_name(file_path):
+    file_name_parts = os.path.basename(file_path).split('_')
+    user_id = file_name_parts[2]
+    project_id = file_name_parts[3]
+    file_id = file_name_parts[4].split('.')[0]
+    return user_id, project_id, file_id
+
+
+# This function runs OCR on a single downloaded file and tags the result with the user_id, project_id and file_id parsed from the file name.
+def process_file(file_path):
+    try:
+        logging.info(f"Processing file: {file_path}")
+        extracted_data = extract_text_with_confidence(file_path) # Extract text and confidence scores from the document
+        user_id, project_id, file_id = parse_download_file_name(file_path)
+        metrics.files_total.inc(stage="ocr")
+        
+        return {
+            'user_id': user_id,
+            'project_id': project_id,
+            'file_id': file_id,
+            'extracted_data': extracted_data
+        }
+    
+    except Exception as e:
+        logging.error(f"Error processing file {file_path}: {e} (finished chunks are checkpointed, the next run resumes from them)")
+        metrics.errors_total.inc(stage="ocr")
+        return None
 
 
 # This function processes multiple documents using Google Document AI to extract text and confidence scores, saves the extracted data as JSON files, and returns the aggregated results.
@@ -388,61 +637,140 @@ def extract_text_with_confidence_batch(downloaded_files, file_sizes):
     
     all_extracted_data = [] # List to store all extracted data from multiple documents
 
-    def process_file(file_path):
-        try:
-            logging.info(f"Processing file: {file_path}")
-            extracted_data = extract_text_with_confidence(file_path) # Extract text and confidence scores from the document
-
-            # Extract user_id, project_id, and file_id from the file name
-            file_name_parts = os.path.basename(file_path).split('_')
-            user_id = file_name_parts[2]
-            project_id = file_name_parts[3]
-            file_id = file_name_parts[4].split('.')[0]
-            
-            return {
-                'user_id': user_id,
-                'project_id': project_id,
-                'file_id': file_id,
-                'extracted_data': extracted_data
-            }
-        
-        except Exception as e:
-            logging.error(f"Error processing file {file_path}: {e}")
-            return None
-
-    
-
-    # with ThreadPoolExecutor(max_workers=5) as executor:  # Limit to 5 concurrent threads
-    with ThreadPoolExecutor() as executor:  # No limit on concurrent threads
-        results = list(executor.map(process_file, downloaded_files))
+    if OCR_BACKEND == "batch":
+        results = extract_text_with_confidence_batch_mode(downloaded_files)
+    else:
+        results = scheduler.map("ocr", process_file, downloaded_files)  # Bounded by the shared OCR pool
 
-    # Filter out any None results due to errors
-    results = [result for result in results if result is not None]
+    # Filter out errors and files without OCR output (a single page over the size limit), so they stay in 'Processing'
+    for result in results:
+        if result is not None and result['extracted_data'] is None:
+            logging.error(f"OCR returned no data for file_id: {result['file_id']}")
+    results = [result for result in results if result is not None and result['extracted_data'] is not None]
 
     all_extracted_data.extend(results)
 
     # Save all OCR outputs as JSON
     save_ocr_outputs_as_json(all_extracted_data)
     logging.info("Done with Extracts text and confidence scores ")
+    logging.info(f"OCR cache stats: {ocr_cache.stats()}")
+    logging.info(f"Scheduler stats: {scheduler.stats()}")
     return all_extracted_data
 
 
 
 
+# OCR the downloaded files and commit the results to ocr_data every OCR_COMMIT_BATCH_SIZE files, as they finish.
+# Files whose OCR failed keep the 'Processing' status, so the next run of the project picks up exactly those.
+def ocr_and_commit(project_id, downloaded_files, file_sizes):
+    if OCR_BACKEND == "batch":
+        all_extracted_data = extract_text_with_confidence_batch(downloaded_files, file_sizes)
+        return save_and_update_ocr_data_batch(project_id, all_extracted_data)
+
+    committed = 0
+    failed = 0
+    batch = []
+
+    def commit(batch):
+        save_ocr_outputs_as_json(batch)
+        return save_and_update_ocr_data_batch(project_id, batch)
+
+    futures = [scheduler.submit("ocr", process_file, file_path) for file_path in downloaded_files]
+    for future in as_completed(futures):
+        data = future.result()
+        if data is None or data['extracted_data'] is None:
+            if data is not None:
+                logging.error(f"OCR returned no data for file_id: {data['file_id']}")
+            failed += 1
+            continue
+        batch.append(data)
+        if len(batch) >= OCR_COMMIT_BATCH_SIZE:
+            if commit(batch):
+                committed += len(batch)
+            else:
+                failed += len(batch)
+            batch = []
+    if batch:
+        if commit(batch):
+            committed += len(batch)
+        else:
+            failed += len(batch)
+
+    logging.info(f"OCR committed for {committed} files, {failed} failed and stay in 'Processing' for the next run. project_id: {project_id}")
+    logging.info(f"OCR cache stats: {ocr_cache.stats()}")
+    logging.info(f"Scheduler stats: {scheduler.stats()}")
+    return failed == 0
+
+
+# Batch processing mode: all files that are not in the OCR cache go to Document AI as one
+# batch_process_documents operation (see docai_batch.py), without the 20 MB / 15 page splitting.
+# With the text-layer fast path, pages with a good text layer are read locally like in the online
+# path: only the runs of pages that need OCR are sent, then merged back in page order.
+def extract_text_with_confidence_batch_mode(downloaded_files):
+    results = {}
+    plans = {}  # file_path -> (cache key, page routes, (start_page, end_page, path) runs to OCR)
+    for file_path in downloaded_files:
+        cache_key, extracted_data = cached_ocr_result(file_path)
+        if extracted_data is not None:
+            results[file_path] = extracted_data
+            continue
+        if not TEXT_LAYER_FAST_PATH:
+            plans[file_path] = (cache_key, [], [(0, None, file_path)])
+            continue
+        file_id = parse_download_file_name(file_path)[2]
+        routes, runs = cpu_pool.run(split_for_batch, file_path, file_id, size=os.path.getsize(file_path))
+        if runs:
+            plans[file_path] = (cache_key, routes, runs)
+            continue
+        logging.info(f"All {len(routes)} pages read from the text layer, Document AI skipped. File ID: {file_id}")
+        results[file_path] = text_layer_result(routes)
+        cache_ocr_result(cache_key, results[file_path])
+
+    run_paths = [path for _, _, runs in plans.values() for _, _, path in runs]
+    processor_name = f"projects/{PROJECT_ID}/locations/{LOCATION}/processors/{PROCESSOR_ID}"
+    try:
+        batch_results = run_batch_ocr(run_paths, processor_name)
+    except Exception as e:
+        logging.error(f"Batch OCR failed: {e}")
+        batch_results = {}
+    finally:
+        for path in run_paths:
+            if path not in plans:  # Page-run PDFs written by split_for_batch, not downloaded files
+                os.remove(path)
+
+    for file_path, (cache_key, routes, runs) in plans.items():
+        if any(path not in batch_results for _, _, path in runs):
+            logging.error(f"Error processing file {file_path}: no batch OCR output")
+            continue
+        parts = [(start_page, batch_results[path]) for start_page, _, path in runs]
+        parts.extend((route.page_num, text_layer_result([route])) for route in routes if route.use_text_layer)
+        parts.sort(key=lambda part: part[0])
+        results[file_path] = parts[0][1] if len(parts) == 1 else merge_chunk_results([result for _, result in parts])
+        cache_ocr_result(cache_key, results[file_path])
+
+    all_extracted_data = []
+    for file_path in downloaded_files:
+        if file_path not in results:
+            continue
+        user_id, project_id, file_id = parse_download_file_name(file_path)
+        all_extracted_data.append({
+            'user_id': user_id,
+            'project_id': project_id,
+            'file_id': file_id,
+            'extracted_data': results[file_path]
+        })
+    return all_extracted_data
+
+
 # This function inserts or updates OCR data for multiple files in the database and updates their OCR status to 'Completed'.
-def save_and_update_ocr_data_batch(project_id, all_extracted_data, db_config):
-    conn = psycopg2.connect(**db_config)
-    cur = conn.cursor()
-    
+def save_and_update_ocr_data_batch(project_id, all_extracted_data):
     try:
-        new_records = []
-        for data in all_extracted_data:
-            extracted_data = data['extracted_data']
-            if isinstance(extracted_data, list):
-                extracted_data = {"text": "", "confidence_scores": extracted_data}
-            new_records.append(
-                (data['file_id'], project_id, json.dumps(extracted_data), extracted_data.get('text', '').replace("\n", " "))
-        )
+        # Compact format, text stored once (see ocr_format.py), encoded in parallel in the CPU pool
+        column_values = cpu_pool.map(ocr_column_values, [data['extracted_data'] for data in all_extracted_data], size=ocr_data_size)
+        new_records = [
+            (data['file_id'], project_id, ocr_json, ocr_text)
+            for data, (ocr_json, ocr_text) in zip(all_extracted_data, column_values)
+        ]
         
         insert_query = """
         INSERT INTO public.ocr_data (file_id, project_id, ocr_json_1, ocr_text_1)
@@ -453,20 +781,21 @@ def save_and_update_ocr_data_batch(project_id, all_extracted_data, db_config):
             ocr_text_1 = EXCLUDED.ocr_text_1
         """
         
-        psycopg2.extras.execute_values(cur, insert_query, new_records)
-        
         file_ids = [data['file_id'] for data in all_extracted_data]
         update_status_query = "UPDATE public.files SET ocr_status = 'Extracting' WHERE id = ANY(%s::int[])" 
-        cur.execute(update_status_query, (file_ids,))
-        
-        conn.commit()
+
+        # Both statements run in one transaction, committed when the block exits
+        with metrics.db_write_seconds.time(stage="ocr"), db_connection() as conn:
+            with conn.cursor() as cur:
+                psycopg2.extras.execute_values(cur, insert_query, new_records)
+                cur.execute(update_status_query, (file_ids,))
+        report_progress("ocred", len(file_ids))
+        return True
         
     except Exception as e:
-        conn.rollback()
         logging.error(f"Error in save_and_update_ocr_data_batch: {e} project_id: {project_id}")
-    finally:
-        cur.close()
-        conn.close()
+        metrics.errors_total.inc(stage="ocr_store")
+        return False
 
 def start_ocr(project_id):
     files = get_files_by_project(project_id)
@@ -474,8 +803,7 @@ def start_ocr(project_id):
         logging.error(f"No files found for OCR in this project: {project_id}")
     else:
         downloaded_files, file_sizes = download_files_concurrently(files)
-        all_extracted_data = extract_text_with_confidence_batch(downloaded_files, file_sizes)
-        save_and_update_ocr_data_batch(project_id, all_extracted_data, DB_CONFIG)
+        ocr_and_commit(project_id, downloaded_files, file_sizes)
         logging.info(f"OCR data saved successfully in the database for project_id: {project_id}")
     
 
@@ -490,14 +818,12 @@ def start_openai(project_id):
 
         # Process each file_id
         results = []
-        for file_id in file_ids:
-            logging.info(f"Processing file ID: {file_id}")
-            result = process_single_document(file_id)
+        process_documents = process_documents_batch if OPENAI_BACKEND == "batch" else process_documents_bulk
+        for file_id, result in process_documents(project_id):
             results.append({
                 "file_id": file_id,
                 "result": result
             })
-            logging.info(f"Completed processing file ID {file_id}: {result}")
         
         # Return the results in JSON format
         logging.info({
@@ -506,16 +832,339 @@ def start_openai(project_id):
             "timestamp": datetime.now().isoformat()
         })
 
+    except JobWaiting:
+        raise  # OpenAI batches still running: the job runs again later (see openai_batch.py)
     except Exception as e:
         logging.error(f"Error processing project {project_id}: {e}")
-
-def start_extraction(project_id):
-    
-    start_ocr(project_id)
+        raise
+
+def start_extraction(project_id, mode=None):
+    mode = mode or EXTRACTION_MODE
+    if mode == "pipeline":
+        start_extraction_pipeline(project_id)
+        return
+    if mode == "async":
+        start_extraction_async(project_id)
+        return
+
+    if OPENAI_BACKEND == "batch" and has_saved_batches(project_id):
+        # A waiting job polling its OpenAI batches: OCR ran before they were submitted
+        logging.info(f"Resuming OpenAI batches of project {project_id}, skipping OCR")
+    else:
+        start_ocr(project_id)
     logging.info(f"Starting OpenAI Extraction: {project_id}")
     start_openai(project_id)
     logging.info(f"OpenAI Extraction Completed: {project_id}")
-    
+
+
+# Marker passed through the pipeline queues once a stage has no more work.
+PIPELINE_DONE = object()
+
+# This function starts the worker threads of one pipeline stage. Each worker takes items from input_queue,
+# runs handler on them and forwards every non-None result to output_queue.
+def start_pipeline_stage(name, handler, input_queue, output_queue, workers):
+    def worker():
+        while True:
+            item = input_queue.get()
+            if item is PIPELINE_DONE:
+                input_queue.put(PIPELINE_DONE)  # Let the other workers of this stage see it too
+                return
+            try:
+                result = handler(item)
+            except Exception as e:
+                logging.error(f"Error in pipeline stage {name}: {e}")
+                continue
+            if result is not None and output_queue is not None:
+                output_queue.put(result)
+
+    # Each thread runs in its own copy of the caller's context, so jobs.current_job_id follows the work
+    threads = [threading.Thread(target=contextvars.copy_context().run, args=(worker,), name=f"{name}-{i}", daemon=True)
+               for i in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+# This function waits for a pipeline stage to drain and then closes the next stage's queue.
+def finish_pipeline_stage(threads, output_queue):
+    for thread in threads:
+        thread.join()
+    if output_queue is not None:
+        output_queue.put(PIPELINE_DONE)
+
+
+# Streaming mode of start_extraction: download -> OCR -> OCR commit -> OpenAI extraction per file.
+# Stages are linked by bounded queues so a slow PDF only holds up its own file, and every file
+# moves to 'Extracting' and then 'Completed' on its own.
+def start_extraction_pipeline(project_id):
+    files = get_files_by_project(project_id)
+    pending_file_ids, error = fetch_file_ids_by_project(project_id)  # Files left in 'Extracting' by an earlier run
+    if not files and not pending_file_ids:
+        logging.error(f"No files found for OCR or extraction in this project: {project_id}")
+        return
+
+    download_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    ocr_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    extract_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+
+    def download_stage(file):
+        id, user_id, file_project_id, file_name, s3_url, ocr_status = file
+        file_extension = os.path.splitext(file_name)[1]
+        file_path = download_file_from_s3(s3_url, user_id, file_project_id, id, file_extension)
+        if not file_path:
+            logging.error(f"Failed to download file from S3: {file_name} : {s3_url} project_id: {project_id}")
+        else:
+            report_progress("downloaded")
+        return file_path
+
+    def ocr_stage(file_path):
+        data = process_file(file_path)
+        if data is None or data['extracted_data'] is None:
+            logging.error(f"OCR returned no data for file: {file_path}")
+            return None
+        save_ocr_output_as_json(data['user_id'], data['project_id'], data['file_id'], data['extracted_data'])
+        if not save_and_update_ocr_data_batch(project_id, [data]):
+            return None
+        logging.info(f"OCR data committed for file_id: {data['file_id']}; project_id {project_id}")
+        return data['file_id']
+
+    def extract_stage(file_id):
+        logging.info(f"Processing file ID: {file_id}")
+        result = process_single_document(file_id)
+        logging.info(f"Completed processing file ID {file_id}: {result}")
+
+    download_threads = start_pipeline_stage("download", download_stage, download_queue, ocr_queue, PIPELINE_DOWNLOAD_WORKERS)
+    ocr_threads = start_pipeline_stage("ocr", ocr_stage, ocr_queue, extract_queue, PIPELINE_OCR_WORKERS)
+    extract_threads = start_pipeline_stage("extract", extract_stage, extract_queue, None, PIPELINE_EXTRACT_WORKERS)
+
+    # Feed the leftover 'Extracting' files from a separate thread so they don't hold up the downloads
+    pending_feeder = threading.Thread(target=lambda: [extract_queue.put(file_id) for file_id in pending_file_ids or []], daemon=True)
+    pending_feeder.start()
+    for file in files or []:
+        download_queue.put(file)
+    download_queue.put(PIPELINE_DONE)
+
+    finish_pipeline_stage(download_threads, ocr_queue)
+    pending_feeder.join()
+    finish_pipeline_stage(ocr_threads, extract_queue)
+    finish_pipeline_stage(extract_threads, None)
+    logging.info(f"Pipeline extraction completed: {project_id}")
+
+
+# Async execution mode
+# --------------------
+# The pipeline and serial modes hold one OS thread per file in flight, blocked on the network nearly
+# all the time. In async mode a project runs on one event loop: aiohttp for S3, the Document AI async
+# client (ocr_providers.py), AsyncOpenAI (extract_data.py) and asyncpg. Every file goes through
+# download -> OCR -> OCR commit -> extraction -> runsheet on its own, like the pipeline mode.
+# Memory stays bounded: at most ASYNC_MAX_IN_FLIGHT files are between download and runsheet, and
+# only ASYNC_OCR_FILES of them hold their PDF bytes. PDF parsing and splitting, the OCR cache and the
+# OCR JSON files still block, so they run in worker threads (asyncio.to_thread).
+
+class AsyncLimits:
+    """Semaphores of one async run, created inside its event loop."""
+
+    def __init__(self):
+        self.downloads = asyncio.Semaphore(ASYNC_DOWNLOAD_CONCURRENCY)
+        self.ocr_files = asyncio.Semaphore(ASYNC_OCR_FILES)
+        self.docai = asyncio.Semaphore(ASYNC_DOCAI_CONCURRENCY)
+
+
+async def download_file_from_s3_async(session, limits, s3_url, user_id, project_id, file_id, file_extension):
+    file_path, exists = download_target(user_id, project_id, file_id, file_extension)
+    if exists:
+        return file_path
+    try:
+        async with limits.downloads:
+            result = await download_to_file_async(session, s3_url, file_path)
+    except Exception as e:
+        record_download_error(s3_url, e)
+        return None
+    record_download(result, project_id, file_id)
+    await asyncio.to_thread(download_cache.evict)
+    return file_path
+
+
+# extract_text_with_confidence for the async mode: same cache, plan and merge, OCR calls on the event loop.
+async def extract_text_with_confidence_async(file_path, limits):
+    cache_key, cached_data = await asyncio.to_thread(cached_ocr_result, file_path)
+    if cached_data is not None:
+        return cached_data
+
+    async with limits.ocr_files:
+        plan = await asyncio.to_thread(plan_document_ocr, file_path, cache_key)
+        if plan.done:
+            extracted_data = plan.result
+        else:
+            chunk_results = await ocr_chunks_async(file_path, plan.file_key, plan.chunks, plan.kind, limits)
+            extracted_data = await asyncio.to_thread(plan.merge, chunk_results)
+    await asyncio.to_thread(cache_ocr_result, cache_key, extracted_data)
+    return extracted_data
+
+
+# ocr_chunks for the async mode: OCR_CHUNK_CONCURRENCY chunks of this file at a time, ASYNC_DOCAI_CONCURRENCY
+# calls in total, checkpoints and retries of the failed chunks like ocr_chunks.
+async def ocr_chunks_async(file_path, file_key, chunks, kind, limits):
+    file_slots = asyncio.Semaphore(OCR_CHUNK_CONCURRENCY)
+    attempts = ChunkAttempts(file_path, chunks, kind)
+
+    async def process_chunk(chunk):
+        start_page, end_page, chunk_content = chunk
+        async with file_slots, limits.docai:
+            result = await process_document_async(chunk_content, attempts.label(chunk), end_page - start_page, kind)
+        await asyncio.to_thread(checkpoint_chunk, file_key, chunk, result)
+        return result
+
+    for delay in attempts.delays():
+        await asyncio.sleep(delay)
+        pending = attempts.pending
+        outcomes = await asyncio.gather(*(process_chunk(chunks[index]) for index in pending), return_exceptions=True)
+        attempts.record(zip(pending, outcomes))
+    return attempts.final_results()
+
+
+async def process_document_async(content, label, pages=None, kind="file"):
+    started = time.monotonic()
+    try:
+        extracted_data = await ocr_provider.process_async(content, label)
+    except Exception as e:
+        record_ocr_error(e)
+        raise
+    record_ocr_call(time.monotonic() - started, pages, kind)
+    return extracted_data
+
+
+# Store one file's OCR result in ocr_data and move the file to 'Extracting', in one transaction.
+async def save_and_update_ocr_data_async(async_pool, user_id, project_id, file_id, extracted_data):
+    await asyncio.to_thread(save_ocr_output_as_json, user_id, project_id, file_id, extracted_data)
+    ocr_json, ocr_text = await asyncio.to_thread(cpu_pool.run, ocr_column_values, extracted_data, size=ocr_data_size(extracted_data))
+    with metrics.db_write_seconds.time(stage="ocr"):
+        async with async_pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    INSERT INTO public.ocr_data (file_id, project_id, ocr_json_1, ocr_text_1)
+                    VALUES ($1, $2, $3::jsonb, $4)
+                    ON CONFLICT (file_id, project_id)
+                    DO UPDATE SET ocr_json_1 = EXCLUDED.ocr_json_1, ocr_text_1 = EXCLUDED.ocr_text_1
+                """, file_id, project_id, ocr_json, ocr_text)
+                await conn.execute("UPDATE public.files SET ocr_status = 'Extracting' WHERE id = $1", file_id)
+    await asyncio.to_thread(report_progress, "ocred")
+
+
+# Extract one document and upsert its runsheet.
+async def extract_file_async(async_pool, user_id, project_id, file_id, ocr_text):
+    logging.info(f"Processing file ID: {file_id}")
+    extracted_data = await extract_and_process_document_async(ocr_text)
+    if isinstance(extracted_data, str) or "error" in extracted_data:
+        logging.error(f"Error processing document {file_id}: {extracted_data}")
+        metrics.errors_total.inc(stage="extraction")
+        return
+    record = build_runsheet_record(user_id, file_id, project_id, extracted_data)
+    if record is None:
+        logging.error(f"Invalid JSON data for file ID {file_id}")
+        return
+    await store_extracted_data_bulk_async(async_pool, [record])
+    logging.info(f"Completed processing file ID {file_id}")
+
+
+# Download, OCR and commit one 'Processing' file, then extract it unless extract is False.
+async def process_file_async(session, async_pool, limits, file, extract):
+    file_id, user_id, project_id, file_name, s3_url, ocr_status = file
+    file_path = await download_file_from_s3_async(
+        session, limits, s3_url, user_id, project_id, file_id, os.path.splitext(file_name)[1])
+    if not file_path:
+        logging.error(f"Failed to download file from S3: {file_name} : {s3_url} project_id: {project_id}")
+        return
+    await asyncio.to_thread(report_progress, "downloaded")
+
+    logging.info(f"Processing file: {file_path}")
+    try:
+        extracted_data = await extract_text_with_confidence_async(file_path, limits)
+    except Exception as e:
+        logging.error(f"Error processing file {file_path}: {e} (finished chunks are checkpointed, the next run resumes from them)")
+        metrics.errors_total.inc(stage="ocr")
+        return
+    if extracted_data is None:
+        logging.error(f"OCR returned no data for file: {file_path}")
+        return
+    metrics.files_total.inc(stage="ocr")
+    try:
+        await save_and_update_ocr_data_async(async_pool, user_id, project_id, file_id, extracted_data)
+    except Exception as e:
+        logging.error(f"Error saving OCR data for file {file_id}: {e} project_id: {project_id}")
+        metrics.errors_total.inc(stage="ocr_store")
+        return
+    if extract:
+        await extract_file_async(async_pool, user_id, project_id, file_id, extracted_data["text"])
+
+
+# Extract a file left in 'Extracting' by an earlier run.
+async def extract_pending_file_async(async_pool, row):
+    file_id, project_id, user_id, ocr_row_id, ocr_format_version, ocr_text = row
+    if ocr_row_id is None:
+        logging.error(f"No OCR data found for file_id {file_id}")
+        return
+    ocr_text = await asyncio.to_thread(ocr_text_for_row, ocr_row_id, ocr_format_version, ocr_text)
+    if ocr_text is None:
+        logging.error(f"Error processing file_id {file_id}. No OCR Data Returned.")
+        return
+    await extract_file_async(async_pool, user_id, project_id, file_id, ocr_text)
+
+
+# Run handler over items with at most limit of them in flight.
+async def run_bounded(limit, handler, items):
+    iterator = iter(items)
+
+    async def worker():
+        for item in iterator:
+            await handler(item)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, min(limit, len(items))))))
+
+
+# One async run: OCR the given 'Processing' files (all of the project by default) and, when extract is True,
+# extract them and the files left in 'Extracting' by earlier runs.
+async def run_extraction_async(project_id, files=None, extract=True):
+    limits = AsyncLimits()
+    async_pool = await create_async_pool()
+    try:
+        if files is None:
+            files = await async_pool.fetch("""
+                SELECT id, user_id, project_id, file_name, s3_url, ocr_status
+                FROM public.files WHERE project_id = $1 AND ocr_status = 'Processing'
+            """, project_id)
+        pending = []
+        if extract:  # The bulk path's keyset query (newest ocr_data row per file), in short transactions
+            pending = await asyncio.to_thread(
+                lambda: [row for rows in fetch_extracting_documents(project_id) for row in rows])
+        if not files and not pending:
+            logging.error(f"No files found for OCR or extraction in this project: {project_id}")
+            return
+        logging.info(f"Async run for project {project_id}: {len(files)} files to OCR, {len(pending)} to extract")
+
+        async with create_async_session() as session:
+            async def handle(item):
+                kind, row = item
+                try:
+                    if kind == "ocr":
+                        await process_file_async(session, async_pool, limits, tuple(row), extract)
+                    else:
+                        await extract_pending_file_async(async_pool, tuple(row))
+                except Exception as e:
+                    logging.error(f"Error in async run for file {row[0]} ({kind}): {e}")
+
+            items = [("extract", row) for row in pending] + [("ocr", row) for row in files]
+            await run_bounded(ASYNC_MAX_IN_FLIGHT, handle, items)
+    finally:
+        await async_pool.close()
+    logging.info(f"Async run completed: {project_id}")
+    logging.info(f"OCR cache stats: {ocr_cache.stats()}")
+    logging.info(f"OpenAI limiter stats: {openai_limiter.stats()}")
+
+
+def start_extraction_async(project_id, files=None, extract=True):
+    asyncio.run(run_extraction_async(project_id, files, extract))
+
 
 
 @app.route("/api/v1/batch_ocr/<int:project_id>", methods=["POST"])
@@ -523,9 +1172,11 @@ def batch_ocr(project_id):
     files = get_files_by_project(project_id)
     if not files:
         return jsonify({"error": "No files found for this project."}), 404
-    downloaded_files, file_sizes = download_files_concurrently(files)
-    all_extracted_data = extract_text_with_confidence_batch(downloaded_files, file_sizes)
-    save_and_update_ocr_data_batch(project_id, all_extracted_data, DB_CONFIG)
+    if EXTRACTION_MODE == "async":
+        start_extraction_async(project_id, files, extract=False)
+    else:
+        downloaded_files, file_sizes = download_files_concurrently(files)
+        ocr_and_commit(project_id, downloaded_files, file_sizes)
     logging.info(f"OCR data saved successfully in the database.{project_id}")
     return jsonify({"message": "Inserted/Updated Data successfully in DataBase"}), 200
 
@@ -534,17 +1185,58 @@ def file_ocr(project_id, file_id):
     files = get_single_file_by_file_id(file_id)
     if not files:
         return jsonify({"error": "File does not match the OCR criteria, Check ocr_status."}), 404
-    downloaded_files, file_sizes = download_files_concurrently(files)
-    all_extracted_data = extract_text_with_confidence_batch(downloaded_files, file_sizes)
-    save_and_update_ocr_data_batch(project_id, all_extracted_data, DB_CONFIG)
+    if EXTRACTION_MODE == "async":
+        start_extraction_async(project_id, files, extract=False)
+    else:
+        downloaded_files, file_sizes = download_files_concurrently(files)
+        ocr_and_commit(project_id, downloaded_files, file_sizes)
     logging.info("OCR data saved successfully in the database.")
     return jsonify({"message": "Inserted/Updated Data successfully in DataBase"}), 200
 
+# Durable worker pool that runs start_extraction for queued jobs (see jobs.py)
+job_workers = JobWorkerPool(start_extraction)
+
 @app.route('/start-extraction/<int:project_id>', methods=['GET'])
 def start_task(project_id):
-    thread = threading.Thread(target=start_extraction, args=(project_id,))
-    thread.start()
-    return jsonify({"message": "OCR and Extraction started", "project_id": project_id}), 202
+    mode = request.args.get("mode")
+    if OPENAI_BACKEND == "batch" and mode not in (None, "serial"):
+        return jsonify({"error": f"OPENAI_BACKEND=batch only supports the serial mode, not {mode}.",
+                        "project_id": project_id}), 400
+    job_workers.start()
+    job, created = enqueue_job(project_id, mode)
+    message = "OCR and Extraction started" if created else "OCR and Extraction already in progress"
+    return jsonify({"message": message, "status": "processing", "project_id": project_id, "job_id": job["id"]}), 202
+
+@app.route('/extraction-status/<int:project_id>', methods=['GET'])
+def extraction_status(project_id):
+    job = get_job_status(project_id)
+    if not job:
+        return jsonify({"error": "No extraction job found for this project.", "project_id": project_id}), 404
+    status = "processing" if job["status"] in ("queued", "running", "waiting") else job["status"]
+    return jsonify({
+        "status": status,
+        "project_id": project_id,
+        "job_id": job["id"],
+        "job_status": job["status"],
+        "progress": {
+            "files_total": job["files_total"],
+            "files_downloaded": job["files_downloaded"],
+            "files_ocred": job["files_ocred"],
+            "files_extracted": job["files_extracted"],
+        },
+        "attempts": job["attempts"],
+        "error": job["error"],
+        "created_at": job["created_at"].isoformat() if job["created_at"] else None,
+        "started_at": job["started_at"].isoformat() if job["started_at"] else None,
+        "finished_at": job["finished_at"].isoformat() if job["finished_at"] else None,
+    }), 200
+
+# Prometheus text format metrics for every pipeline stage (see metrics.py)
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
 
 if __name__ == "__main__":
+    job_workers.start()
     app.run(debug=True, host="0.0.0.0", port=5000)
\ No newline at end of file
@@ -0,0 +1,171 @@
+"""
+Content-addressed cache for OCR results.
+
+Results are keyed by the SHA-256 of the PDF bytes together with the OCR processor
+(OCR_PROVIDER, PROJECT_ID/LOCATION/PROCESSOR_ID and PROCESSOR_VERSION), so re-uploads, the same deed
+in several projects and retries after a failed DB write never go back to Document AI.
+A different processor or processor version gives a different key, and so does a change
+to the text-layer fast path settings (text_layer.py), since they decide which pages are OCR'd,
+or to OCR_CONFIDENCE_GRANULARITY / DOCAI_RESPONSE_FIELD_MASK (ocr_providers.py), since they decide
+the shape and level of the stored confidence scores.
+
+Every entry is one JSON file holding the {"text", "confidence_scores"} payload.
+Chunks of split files are checkpointed under key_for_chunk as soon as they are OCR'd, so a
+failed or interrupted file only redoes its missing chunks. Checkpoints age out through the same
+LRU eviction as whole-file entries.
+When the cache grows over OCR_CACHE_MAX_MB, the least recently used entries are removed
+(entries are touched on every hit, so file mtime is the LRU clock).
+
+The .env file may contain the following variables:
+
+OCR_CACHE_DIR=
+OCR_CACHE_MAX_MB=
+PROCESSOR_VERSION=
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import tempfile
+
+from text_layer import TEXT_LAYER_FAST_PATH, TEXT_LAYER_MIN_SCORE, TEXT_LAYER_MIN_CHARS
+from ocr_providers import OCR_CONFIDENCE_GRANULARITY, DOCAI_RESPONSE_FIELD_MASK
+
+
+class OcrCache:
+    """Persistent OCR result cache with size based LRU eviction and hit-rate statistics."""
+
+    def __init__(self, cache_dir, max_bytes, namespace=""):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key_for_bytes(self, content):
+        return self._namespaced_key(hashlib.sha256(content).hexdigest())
+
+    def key_for_file(self, file_path):
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(block)
+        return self._namespaced_key(digest.hexdigest())
+
+    # Checkpoint key for the OCR result of pages [start_page, end_page) of the file with key file_key
+    def key_for_chunk(self, file_key, start_page, end_page):
+        return self._namespaced_key(f"{file_key}:pages:{start_page}-{end_page}")
+
+    def _namespaced_key(self, content_hash):
+        return hashlib.sha256(f"{self.namespace}:{content_hash}".encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+            os.utime(path)  # Mark as recently used
+        except FileNotFoundError:
+            data = None
+        except (OSError, json.JSONDecodeError) as e:
+            logging.warning(f"Discarding unreadable OCR cache entry {key}: {e}")
+            self._remove(path)
+            data = None
+
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write through a temp file so a crash never leaves a half-written entry behind
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                json.dump(data, file, ensure_ascii=False)
+            # The size is scanned (first put) and the entry moved into place under the lock,
+            # so the scan never already includes an entry that is then counted again
+            with self._lock:
+                size = self._current_size()
+                old_size = os.path.getsize(path) if os.path.exists(path) else 0
+                os.replace(temp_path, path)
+                self._size = size - old_size + os.path.getsize(path)
+                if self._size > self.max_bytes:
+                    self._evict()
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _current_size(self):
+        if self._size is None:
+            self._size = sum(os.path.getsize(path) for path, _ in self._entries())
+        return self._size
+
+    def _entries(self):
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    try:
+                        yield path, os.stat(path)
+                    except FileNotFoundError:
+                        continue
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        # Drop least recently used entries until we are at 90% of the size cap
+        target = self.max_bytes * 0.9
+        for path, stat in sorted(self._entries(), key=lambda entry: entry[1].st_mtime):
+            if self._size <= target:
+                break
+            self._remove(path)
+            self._size -= stat.st_size
+            self.evictions += 1
+        logging.info(f"OCR cache eviction done: {self.evictions} evictions so far, size {self._size} bytes")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "size_bytes": self._current_size(),
+                "max_bytes": self.max_bytes,
+            }
+
+
+ocr_cache = OcrCache(
+    cache_dir=os.getenv("OCR_CACHE_DIR", "ocr_cache"),
+    max_bytes=int(float(os.getenv("OCR_CACHE_MAX_MB", "2048")) * 1024 * 1024),
+    namespace="/".join([
+        os.getenv("OCR_PROVIDER", "documentai"),
+        os.getenv("PROJECT_ID") or "",
+        os.getenv("LOCATION") or "",
+        os.getenv("PROCESSOR_ID") or "",
+        os.getenv("PROCESSOR_VERSION") or "",
+        f"textlayer={TEXT_LAYER_MIN_SCORE}:{TEXT_LAYER_MIN_CHARS}" if TEXT_LAYER_FAST_PATH else "textlayer=off",
+        f"granularity={OCR_CONFIDENCE_GRANULARITY}",
+        f"fieldmask={'on' if DOCAI_RESPONSE_FIELD_MASK else 'off'}",
+    ]),
+)
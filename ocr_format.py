@@ -0,0 +1,148 @@
+"""
+Compact, versioned storage format for ocr_data.ocr_json_1.
+
+Format 1 (legacy) repeated every block's text inside "confidence_scores" next to the full "text":
+
+    {"text": "...", "confidence_scores": [{"text": "...", "confidence": 0.98}, ...]}
+
+and chunked files were stored as {"text": "", "confidence_scores": [<one format 1 dict per chunk>]}.
+
+Format 2 stores the text once and the confidences as parallel offset arrays:
+
+    {
+        "format": 2,
+        "text": "...",
+        "confidence": {
+            "encoding": "zlib+base64",          # or "plain"
+            "data": "<base64 of zlib(JSON {"start": [...], "end": [...], "confidence": [...]})>"
+        }
+    }
+
+    ("plain" keeps "start", "end" and "confidence" as JSON arrays instead of "data")
+
+Readers that only need the text select ocr_json_1::jsonb->>'text' and never touch the confidences.
+The cast is explicit because the column may be json, jsonb or (in older schemas) TEXT holding JSON;
+->> has no TEXT operand, and the cast is a no-op on jsonb.
+Rows still in format 1 are rewritten to format 2 the first time they are read (see migrate_ocr_row),
+and their ocr_text_1 is refilled from the decoded text (legacy chunked rows stored it empty).
+ocr_text_1 keeps its flattened copy of the text for existing consumers.
+
+Configuration (.env):
+
+OCR_JSON_COMPRESS=     # true (default) or false
+"""
+
+import os
+import json
+import zlib
+import base64
+
+
+FORMAT_VERSION = 2
+OCR_JSON_COMPRESS = os.getenv("OCR_JSON_COMPRESS", "true").lower() in ("1", "true", "yes")
+
+
+# Bring any format 1 value (dict, chunk list, or the {"text": "", "confidence_scores": [chunks]} wrapper)
+# to a single {"text", "confidence_scores"} dict whose entries all carry start_index/end_index.
+def normalize_ocr_data(ocr_data):
+    if isinstance(ocr_data, list):
+        ocr_data = {"text": "", "confidence_scores": ocr_data}
+    if not isinstance(ocr_data, dict):
+        return {"text": "", "confidence_scores": []}
+
+    scores = ocr_data.get("confidence_scores", [])
+    if scores and all(isinstance(score, dict) and "confidence_scores" in score for score in scores):
+        # Chunk results stored as a list: merge them into one document
+        chunks = [normalize_ocr_data(chunk) for chunk in scores]
+        merged = {"text": "", "confidence_scores": []}
+        offset = 0
+        for chunk in chunks:
+            for score in chunk["confidence_scores"]:
+                merged["confidence_scores"].append({**score, "start_index": score["start_index"] + offset, "end_index": score["end_index"] + offset})
+            merged["text"] += chunk["text"]
+            offset += len(chunk["text"])
+        return merged
+
+    text = ocr_data.get("text", "") or ""
+    normalized = []
+    cursor = 0
+    for score in scores:
+        start = score.get("start_index")
+        end = score.get("end_index")
+        if start is None or end is None:
+            # Legacy entries have no offsets: locate the block text after the previous block
+            segment_text = score.get("text", "")
+            start = text.find(segment_text, cursor) if segment_text else cursor
+            if start < 0:
+                start = text.find(segment_text)
+            if start < 0:
+                continue
+            end = start + len(segment_text)
+        cursor = end
+        normalized.append({"text": text[start:end], "confidence": score.get("confidence", 0.0), "start_index": start, "end_index": end})
+    return {"text": text, "confidence_scores": normalized}
+
+
+# Encode OCR output ({"text", "confidence_scores"} in any format 1 shape) as a format 2 ocr_json_1 value.
+def encode_ocr_payload(ocr_data, compress=None):
+    compress = OCR_JSON_COMPRESS if compress is None else compress
+    ocr_data = normalize_ocr_data(ocr_data)
+    arrays = {
+        "start": [score["start_index"] for score in ocr_data["confidence_scores"]],
+        "end": [score["end_index"] for score in ocr_data["confidence_scores"]],
+        "confidence": [round(float(score["confidence"]), 4) for score in ocr_data["confidence_scores"]],
+    }
+    if compress:
+        data = zlib.compress(json.dumps(arrays, separators=(",", ":")).encode("utf-8"), 6)
+        confidence = {"encoding": "zlib+base64", "data": base64.b64encode(data).decode("ascii")}
+    else:
+        confidence = {"encoding": "plain", **arrays}
+    return {"format": FORMAT_VERSION, "text": ocr_data["text"], "confidence": confidence}
+
+
+# The ocr_json_1 (serialized format 2 value) and ocr_text_1 (flattened text) column values of one OCR result.
+def ocr_column_values(ocr_data):
+    payload = encode_ocr_payload(ocr_data)
+    return json.dumps(payload), payload["text"].replace("\n", " ")
+
+
+def is_compact(ocr_json):
+    return isinstance(ocr_json, dict) and ocr_json.get("format") == FORMAT_VERSION
+
+
+# Decode a format 2 value (or normalize a format 1 value) back to {"text", "confidence_scores"}.
+def decode_ocr_payload(ocr_json):
+    if isinstance(ocr_json, str):
+        ocr_json = json.loads(ocr_json)
+    if not is_compact(ocr_json):
+        return normalize_ocr_data(ocr_json)
+
+    confidence = ocr_json.get("confidence", {})
+    if confidence.get("encoding") == "zlib+base64":
+        arrays = json.loads(zlib.decompress(base64.b64decode(confidence["data"])).decode("utf-8"))
+    else:
+        arrays = confidence
+    text = ocr_json.get("text", "")
+    return {
+        "text": text,
+        "confidence_scores": [
+            {"text": text[start:end], "confidence": score, "start_index": start, "end_index": end}
+            for start, end, score in zip(arrays.get("start", []), arrays.get("end", []), arrays.get("confidence", []))
+        ],
+    }
+
+
+# Rewrite one ocr_data row to format 2 if it is still in format 1. Returns the row's text.
+def migrate_ocr_row(cur, ocr_row_id):
+    cur.execute("SELECT ocr_json_1 FROM public.ocr_data WHERE id = %s FOR UPDATE", (ocr_row_id,))
+    row = cur.fetchone()
+    if row is None or row[0] is None:
+        return None
+    ocr_json = json.loads(row[0]) if isinstance(row[0], str) else row[0]
+    if is_compact(ocr_json):
+        return ocr_json.get("text", "")
+    payload = encode_ocr_payload(ocr_json)
+    # Legacy chunked rows kept an empty ocr_text_1, it gets the merged text too
+    cur.execute("UPDATE public.ocr_data SET ocr_json_1 = %s, ocr_text_1 = %s WHERE id = %s",
+                (json.dumps(payload), payload["text"].replace("\n", " "), ocr_row_id))
+    return payload["text"]
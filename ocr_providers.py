@@ -0,0 +1,628 @@
+"""
+OCR providers.
+
+Every provider turns the bytes of one PDF (a whole file or a chunk) into the normalized structure
+the rest of the pipeline stores:
+
+    {"text": "...", "confidence_scores": [{"text", "confidence", "start_index", "end_index"}, ...]}
+
+  DocumentAiProvider  Google Document AI online processing (process_document)
+  FakeOcrProvider     local stand-in with a configurable latency distribution, for offline runs
+                      and benchmarks; its output is deterministic per input
+  HedgedOcrProvider   wraps a primary and a backup provider: when the primary has not answered
+                      within its recent p95 latency, the same request is sent to the backup and the
+                      first successful answer wins (the other one is ignored)
+
+Document AI responses are read by walk_document in one pass over the raw proto: the text plus the
+confidence of every layout element at OCR_CONFIDENCE_GRANULARITY (block, paragraph, line or token).
+Nothing is converted to dicts (the old Document.to_dict copied page images, tokens and every
+layout level only to read "text"), and the request's field mask asks Document AI for just the text
+and that one level, so a response's size, and the memory to hold it, is bounded by its text and
+element count. titlemine_ocr_response_bytes records the response sizes. Compare peak memory and
+time of both ways on a synthetic scanned document with:
+
+    python ocr_providers.py --walker --pages 15 --granularity block
+
+Every provider also has process_async for the async execution mode: Document AI uses its async
+gRPC client, the fake provider sleeps on the event loop, and hedging races asyncio tasks. Providers
+without a native async path run process() in a worker thread.
+
+Hedging is bounded: no more than OCR_HEDGE_MAX_RATIO of the requests fire a backup, so a slow
+provider cannot double the load on itself. The p95 is kept per request size bucket (HEDGE_SIZE_BUCKETS),
+since a 15 page whole-file request is legitimately slower than a one-page chunk; until
+OCR_HEDGE_MIN_SAMPLES latencies of a bucket are known its deadline is OCR_HEDGE_INITIAL_DEADLINE_SECONDS.
+An answer from a backup that is a different provider is marked with "answered_by", so it is not
+cached under the primary provider's ocr_cache namespace. Only primary requests feed the p95, also when
+the backup is the same provider. A primary that fails before the deadline is failed over to the backup
+at once (outside OCR_HEDGE_MAX_RATIO); the error is only raised when the backup fails too. The losing request of a hedge is not stopped once it has been sent: it
+keeps its ocr_hedge slot and Document AI quota until it finishes, and is counted in
+titlemine_ocr_hedge_duplicates_total (and "duplicates" in stats()) as the cost of hedging.
+
+Latency specs for the fake provider ("kind:param=value,..."):
+
+    fixed:seconds=1.5
+    uniform:low=0.5,high=2
+    lognormal:median=1.5,sigma=0.5
+    bimodal:median=1,sigma=0.3,slow_ratio=0.05,slow_factor=8     (a slow tail on 5% of requests)
+
+Offline benchmark of the hedging logic:
+
+    python ocr_providers.py --requests 500 --concurrency 16 --latency bimodal:median=1,slow_ratio=0.05
+
+Configuration (.env):
+
+OCR_PROVIDER=                 # documentai (default) or fake
+OCR_HEDGE=                    # true or false (default)
+OCR_HEDGE_BACKUP=             # provider used for backup requests, defaults to OCR_PROVIDER
+OCR_HEDGE_QUANTILE=
+OCR_HEDGE_MIN_SAMPLES=
+OCR_HEDGE_INITIAL_DEADLINE_SECONDS=
+OCR_HEDGE_MAX_RATIO=
+FAKE_OCR_LATENCY=
+FAKE_OCR_FAILURE_RATE=
+OCR_CONFIDENCE_GRANULARITY=   # block (default), paragraph, line or token
+DOCAI_RESPONSE_FIELD_MASK=    # true (default) or false
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import argparse
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from scheduler import scheduler
+import metrics
+
+
+OCR_PROVIDER = os.getenv("OCR_PROVIDER", "documentai")
+OCR_HEDGE = os.getenv("OCR_HEDGE", "false").lower() in ("1", "true", "yes")
+OCR_HEDGE_BACKUP = os.getenv("OCR_HEDGE_BACKUP") or OCR_PROVIDER
+OCR_HEDGE_QUANTILE = float(os.getenv("OCR_HEDGE_QUANTILE", "0.95"))
+OCR_HEDGE_MIN_SAMPLES = int(os.getenv("OCR_HEDGE_MIN_SAMPLES", "20"))
+OCR_HEDGE_INITIAL_DEADLINE_SECONDS = float(os.getenv("OCR_HEDGE_INITIAL_DEADLINE_SECONDS", "30"))
+OCR_HEDGE_MAX_RATIO = float(os.getenv("OCR_HEDGE_MAX_RATIO", "0.1"))
+FAKE_OCR_LATENCY = os.getenv("FAKE_OCR_LATENCY", "lognormal:median=1.5,sigma=0.5")
+FAKE_OCR_FAILURE_RATE = float(os.getenv("FAKE_OCR_FAILURE_RATE", "0"))
+OCR_CONFIDENCE_GRANULARITY = os.getenv("OCR_CONFIDENCE_GRANULARITY", "block")
+DOCAI_RESPONSE_FIELD_MASK = os.getenv("DOCAI_RESPONSE_FIELD_MASK", "true").lower() in ("1", "true", "yes")
+
+# Upper bounds (request bytes) of the hedging latency buckets; larger requests share the last bucket
+HEDGE_SIZE_BUCKETS = (256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024)
+
+# Document.Page field holding the layout elements of each granularity
+LAYOUT_ELEMENTS = {"block": "blocks", "paragraph": "paragraphs", "line": "lines", "token": "tokens"}
+
+
+class OcrProvider:
+    """Base class: process(content, label) returns {"text", "confidence_scores"} for one PDF."""
+
+    name = "provider"
+
+    def process(self, content, label):
+        raise NotImplementedError
+
+    async def process_async(self, content, label):
+        return await asyncio.to_thread(self.process, content, label)
+
+
+class DocumentAiProvider(OcrProvider):
+    name = "documentai"
+
+    def __init__(self, project_id, location, processor_id, granularity=None):
+        from google.cloud import documentai_v1 as documentai  # Only needed for the real provider
+        from google.protobuf import field_mask_pb2
+        self.documentai = documentai
+        self.processor_name = f"projects/{project_id}/locations/{location}/processors/{processor_id}"
+        self.granularity = granularity or OCR_CONFIDENCE_GRANULARITY
+        if self.granularity not in LAYOUT_ELEMENTS:
+            raise ValueError(f"Unknown OCR confidence granularity: {self.granularity}")
+        # Only the text and the layout level that is read come back (no page images, no other levels)
+        self.field_mask = field_mask_pb2.FieldMask(paths=["text", f"pages.{LAYOUT_ELEMENTS[self.granularity]}"])
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._async_clients = weakref.WeakKeyDictionary()  # gRPC aio channels belong to one event loop
+
+    # One client (and gRPC channel) shared by every request
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                self._client = self.documentai.DocumentProcessorServiceClient()
+            return self._client
+
+    def async_client(self):
+        loop = asyncio.get_running_loop()
+        with self._client_lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = self._async_clients[loop] = self.documentai.DocumentProcessorServiceAsyncClient()
+            return client
+
+    def _request(self, content):
+        raw_document = self.documentai.RawDocument(content=content, mime_type="application/pdf")
+        if DOCAI_RESPONSE_FIELD_MASK:
+            return self.documentai.ProcessRequest(name=self.processor_name, raw_document=raw_document, field_mask=self.field_mask)
+        return self.documentai.ProcessRequest(name=self.processor_name, raw_document=raw_document)
+
+    def process(self, content, label):
+        request = self._request(content)
+
+        # Debugging statement to log request details
+        logging.info(f"Processing document: {label}, Size: {len(content)} bytes")
+
+        scheduler.throttle("docai")
+        response = self.client.process_document(request=request)
+
+        # Debugging statement to log response details
+        logging.info(f"Document processed: {label}, Size: {len(content)} bytes")
+        return self._extracted_data(response)
+
+    async def process_async(self, content, label):
+        request = self._request(content)
+        logging.info(f"Processing document: {label}, Size: {len(content)} bytes")
+        await scheduler.throttle_async("docai")
+        response = await self.async_client().process_document(request=request)
+        logging.info(f"Document processed: {label}, Size: {len(content)} bytes")
+        return self._extracted_data(response)
+
+    def _extracted_data(self, response):
+        document = self.documentai.Document.pb(response.document)  # The raw protobuf, no proto-plus wrappers
+        metrics.ocr_response_bytes.observe(document.ByteSize(), provider=self.name)
+        return walk_document(document, self.granularity)
+
+
+# Read the text and the confidence of every layout element of one granularity from a Document AI
+# Document (raw protobuf or proto-plus) in one pass. Returns {"text", "confidence_scores"}.
+def walk_document(document, granularity="block"):
+    elements = LAYOUT_ELEMENTS[granularity]
+    text = document.text
+    confidence_scores = []
+    for page in document.pages:
+        for element in getattr(page, elements):
+            layout = element.layout
+            confidence = layout.confidence
+            for segment in layout.text_anchor.text_segments:
+                start_index = int(segment.start_index)
+                end_index = int(segment.end_index)
+                confidence_scores.append({
+                    "text": text[start_index:end_index],
+                    "confidence": confidence,
+                    "start_index": start_index,
+                    "end_index": end_index,
+                })
+    return {"text": text, "confidence_scores": confidence_scores}
+
+# Parse a latency spec ("lognormal:median=1.5,sigma=0.5") into a function returning one latency in seconds.
+def parse_latency(spec):
+    kind, _, params = spec.partition(":")
+    values = {key: float(value) for key, value in (item.split("=") for item in params.split(",") if item)}
+    if kind == "fixed":
+        return lambda rng: values.get("seconds", 1.0)
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values.get("low", 0.5), values.get("high", 2.0))
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(0, values.get("sigma", 0.5)) * values.get("median", 1.0)
+    if kind == "bimodal":
+        def bimodal(rng):
+            latency = rng.lognormvariate(0, values.get("sigma", 0.3)) * values.get("median", 1.0)
+            if rng.random() < values.get("slow_ratio", 0.05):
+                latency *= values.get("slow_factor", 8.0)
+            return latency
+        return bimodal
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class FakeOcrProvider(OcrProvider):
+    """Sleeps for a latency drawn from the configured distribution and returns synthetic OCR output."""
+
+    name = "fake"
+
+    def __init__(self, latency=None, failure_rate=None, seed=None, time_scale=1.0):
+        self.latency_spec = latency or FAKE_OCR_LATENCY
+        self.sample_latency = parse_latency(self.latency_spec)
+        self.failure_rate = FAKE_OCR_FAILURE_RATE if failure_rate is None else failure_rate
+        self.time_scale = time_scale
+        self.calls = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _draw(self):
+        with self._lock:
+            self.calls += 1
+            return self.sample_latency(self._rng) * self.time_scale, self._rng.random() < self.failure_rate
+
+    def process(self, content, label):
+        latency, failed = self._draw()
+        time.sleep(latency)
+        return self._result(content, label, failed)
+
+    async def process_async(self, content, label):
+        latency, failed = self._draw()
+        await asyncio.sleep(latency)
+        return self._result(content, label, failed)
+
+    def _result(self, content, label, failed):
+        if failed:
+            raise RuntimeError(f"Fake OCR failure: {label}")
+
+        digest = hashlib.sha256(content).hexdigest()
+        lines = [f"FAKE OCR {digest[:16]} line {index + 1}\n" for index in range(5)]
+        extracted_data = {"text": "".join(lines), "confidence_scores": []}
+        offset = 0
+        for index, line in enumerate(lines):
+            extracted_data["confidence_scores"].append({
+                "text": line,
+                "confidence": round(0.9 + int(digest[index * 2:index * 2 + 2], 16) / 2550, 4),
+                "start_index": offset,
+                "end_index": offset + len(line),
+            })
+            offset += len(line)
+        return extracted_data
+
+
+class HedgedOcrProvider(OcrProvider):
+    """Sends a backup request when the primary is slower than its recent p95 and returns the first answer."""
+
+    def __init__(self, primary, backup=None, quantile=None, min_samples=None, initial_deadline=None,
+                 max_hedge_ratio=None, submit=None):
+        self.primary = primary
+        self.backup = backup or primary
+        self.name = f"hedged({primary.name},{self.backup.name})"
+        self.quantile = OCR_HEDGE_QUANTILE if quantile is None else quantile
+        self.min_samples = OCR_HEDGE_MIN_SAMPLES if min_samples is None else min_samples
+        self.initial_deadline = OCR_HEDGE_INITIAL_DEADLINE_SECONDS if initial_deadline is None else initial_deadline
+        self.max_hedge_ratio = OCR_HEDGE_MAX_RATIO if max_hedge_ratio is None else max_hedge_ratio
+        # Attempts run on their own pool: callers are docai pool tasks and must not wait on their own pool
+        self.submit = submit or (lambda fn, *args: scheduler.submit("ocr_hedge", fn, *args))
+        self.latencies = {}  # size bucket -> recent primary latencies
+        self.requests = 0
+        self.hedged = 0
+        self.backup_wins = 0
+        self.duplicates = 0  # losing requests that ran to completion anyway
+        self.failovers = 0  # backups sent because the primary failed
+        self._lock = threading.Lock()
+
+    def deadline(self, bucket=0):
+        with self._lock:
+            latencies = self.latencies.get(bucket, ())
+            if len(latencies) < self.min_samples:
+                return self.initial_deadline
+            ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))]
+
+    def _may_hedge(self):
+        with self._lock:
+            if self.hedged + 1 > self.max_hedge_ratio * self.requests:
+                return False
+            self.hedged += 1
+            return True
+
+    def _timed(self, provider, content, label, primary=False):
+        started = time.monotonic()
+        result = provider.process(content, label)
+        return self._record(provider, started, content, result, primary)
+
+    async def _timed_async(self, provider, content, label, primary=False):
+        started = time.monotonic()
+        result = await provider.process_async(content, label)
+        return self._record(provider, started, content, result, primary)
+
+    # Only the primary request feeds the hedge deadline, also when the backup is the same provider
+    def _record(self, provider, started, content, result, primary):
+        if primary:
+            with self._lock:
+                self.latencies.setdefault(size_bucket(len(content)), deque(maxlen=500)).append(time.monotonic() - started)
+        elif provider.name != self.primary.name:
+            result = dict(result, answered_by=provider.name)
+        return result
+
+    # The primary failed before the hedge deadline: the backup is sent at once, outside the hedge ratio
+    def _failover(self, error, label):
+        logging.warning(f"OCR hedge: {self.primary.name} failed ({error}), sending backup request: {label}")
+        with self._lock:
+            self.failovers += 1
+
+    def _count_duplicate(self, provider):
+        with self._lock:
+            self.duplicates += 1
+        metrics.ocr_hedge_duplicates_total.inc(provider=provider.name)
+
+    def process(self, content, label):
+        with self._lock:
+            self.requests += 1
+        deadline = self.deadline(size_bucket(len(content)))
+        primary = self.submit(self._timed, self.primary, content, label, True)
+        done, _ = wait([primary], timeout=deadline)
+        if done and primary.exception() is not None:
+            self._failover(primary.exception(), label)
+            return self.submit(self._timed, self.backup, content, label + " (failover)").result()
+        if done or not self._may_hedge():
+            return primary.result()
+
+        logging.info(f"OCR hedge: no answer from {self.primary.name} after {deadline:.2f}s, sending backup request: {label}")
+        backup = self.submit(self._timed, self.backup, content, label + " (hedge)")
+        providers = {primary: self.primary, backup: self.backup}
+        pending = {primary, backup}
+        last_error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    last_error = future.exception()
+                    continue
+                if future is backup:
+                    with self._lock:
+                        self.backup_wins += 1
+                # A request that already started cannot be stopped: it still runs to the end and is billed
+                for other in pending:
+                    if not other.cancel():
+                        self._count_duplicate(providers[other])
+                return future.result()
+        raise last_error
+
+    async def process_async(self, content, label):
+        with self._lock:
+            self.requests += 1
+        deadline = self.deadline(size_bucket(len(content)))
+        primary = asyncio.ensure_future(self._timed_async(self.primary, content, label, True))
+        done, _ = await asyncio.wait([primary], timeout=deadline)
+        if done and primary.exception() is not None:
+            self._failover(primary.exception(), label)
+            return await self._timed_async(self.backup, content, label + " (failover)")
+        if done or not self._may_hedge():
+            return await primary
+
+        logging.info(f"OCR hedge: no answer from {self.primary.name} after {deadline:.2f}s, sending backup request: {label}")
+        backup = asyncio.ensure_future(self._timed_async(self.backup, content, label + " (hedge)"))
+        providers = {primary: self.primary, backup: self.backup}
+        pending = {primary, backup}
+        last_error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    last_error = task.exception()
+                    continue
+                if task is backup:
+                    with self._lock:
+                        self.backup_wins += 1
+                # Cancelling the task stops waiting for the call, but the request was already sent and is billed
+                for other in pending:
+                    other.cancel()
+                    self._count_duplicate(providers[other])
+                return task.result()
+        raise last_error
+
+    def stats(self):
+        with self._lock:
+            buckets = sorted(self.latencies)
+        deadlines = {size_bucket_name(bucket): round(self.deadline(bucket), 3) for bucket in buckets}
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedged": self.hedged,
+                "backup_wins": self.backup_wins,
+                "duplicates": self.duplicates,
+                "failovers": self.failovers,
+                "deadline_seconds": deadlines,
+            }
+
+
+def size_bucket(size):
+    return next((index for index, bound in enumerate(HEDGE_SIZE_BUCKETS) if size <= bound), len(HEDGE_SIZE_BUCKETS))
+
+
+def size_bucket_name(bucket):
+    if bucket < len(HEDGE_SIZE_BUCKETS):
+        return f"<={HEDGE_SIZE_BUCKETS[bucket] // 1024}KB"
+    return f">{HEDGE_SIZE_BUCKETS[-1] // 1024}KB"
+
+
+def create_provider(name, project_id=None, location=None, processor_id=None):
+    if name == "documentai":
+        return DocumentAiProvider(project_id, location, processor_id)
+    if name == "fake":
+        return FakeOcrProvider()
+    raise ValueError(f"Unknown OCR provider: {name}")
+
+
+# OCR provider configured by OCR_PROVIDER, wrapped for hedged dispatch when OCR_HEDGE is on.
+def create_ocr_provider(project_id=None, location=None, processor_id=None):
+    primary = create_provider(OCR_PROVIDER, project_id, location, processor_id)
+    if not OCR_HEDGE:
+        return primary
+    backup = primary if OCR_HEDGE_BACKUP == OCR_PROVIDER else create_provider(OCR_HEDGE_BACKUP, project_id, location, processor_id)
+    return HedgedOcrProvider(primary, backup)
+
+
+def percentile(values, quantile):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))] if ordered else 0.0
+
+
+# Run the same request stream against a plain and a hedged fake provider and compare their latencies.
+def run_benchmark(requests, concurrency, latency, failure_rate=0.0, seed=1, time_scale=0.01):
+    report = {}
+    for mode in ("plain", "hedged"):
+        fake = FakeOcrProvider(latency, failure_rate, seed=seed, time_scale=time_scale)
+        executor = ThreadPoolExecutor(max_workers=concurrency * 2)
+        provider = fake if mode == "plain" else HedgedOcrProvider(
+            fake, min_samples=20, initial_deadline=60 * time_scale, submit=executor.submit)
+        samples = []
+
+        def one(index):
+            started = time.monotonic()
+            try:
+                provider.process(index.to_bytes(8, "big"), f"request {index}")
+            except RuntimeError:
+                pass
+            samples.append((time.monotonic() - started) / time_scale)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as callers:
+            list(callers.map(one, range(requests)))
+        executor.shutdown(wait=True)
+        report[mode] = {
+            "p50_seconds": round(percentile(samples, 0.50), 3),
+            "p95_seconds": round(percentile(samples, 0.95), 3),
+            "p99_seconds": round(percentile(samples, 0.99), 3),
+            "max_seconds": round(max(samples), 3),
+            "provider_calls": fake.calls,
+            "extra_load": round(fake.calls / requests - 1, 3),
+        }
+        if mode == "hedged":
+            hedge_stats = provider.stats()
+            hedge_stats["deadline_seconds"] = {bucket: round(deadline / time_scale, 3)
+                                               for bucket, deadline in hedge_stats["deadline_seconds"].items()}
+            report[mode]["hedge"] = hedge_stats
+    return report
+
+
+# A Document AI response shaped like a scanned title document: every page has an image and blocks,
+# paragraphs, lines and tokens with bounding boxes over the shared text.
+def synthetic_document(documentai, pages, image_kb=400, lines_per_page=45, words_per_line=12, seed=1):
+    Document = documentai.Document
+    rng = random.Random(seed)
+    box = [documentai.NormalizedVertex(x=x, y=y) for x, y in ((0.1, 0.1), (0.9, 0.1), (0.9, 0.12), (0.1, 0.12))]
+
+    def element(element_type, start_index, end_index):
+        return element_type(layout=Document.Page.Layout(
+            text_anchor=Document.TextAnchor(text_segments=[Document.TextAnchor.TextSegment(start_index=start_index, end_index=end_index)]),
+            confidence=round(0.8 + rng.random() / 5, 4),
+            bounding_poly=documentai.BoundingPoly(normalized_vertices=box),
+        ))
+
+    text_parts = []
+    offset = 0
+    page_messages = []
+    for page_num in range(pages):
+        elements = {"blocks": [], "paragraphs": [], "lines": [], "tokens": []}
+        block_start = paragraph_start = offset
+        for line_num in range(lines_per_page):
+            line_start = offset
+            for word_num in range(words_per_line):
+                word = f"grantor{page_num}x{line_num}x{word_num} "
+                elements["tokens"].append(element(Document.Page.Token, offset, offset + len(word)))
+                text_parts.append(word)
+                offset += len(word)
+            text_parts.append("\n")
+            offset += 1
+            elements["lines"].append(element(Document.Page.Line, line_start, offset))
+            if line_num % 5 == 4 or line_num == lines_per_page - 1:
+                elements["paragraphs"].append(element(Document.Page.Paragraph, paragraph_start, offset))
+                paragraph_start = offset
+            if line_num % 15 == 14 or line_num == lines_per_page - 1:
+                elements["blocks"].append(element(Document.Page.Block, block_start, offset))
+                block_start = offset
+        image = Document.Page.Image(content=rng.randbytes(image_kb * 1024), mime_type="image/png", width=2550, height=3300)
+        page_messages.append(Document.Page(page_number=page_num + 1, image=image, **elements))
+    return documentai.Document(text="".join(text_parts), pages=page_messages)
+
+
+# What Document AI returns for a request with the field mask: the text and one layout level only.
+def masked_document(documentai, document, granularity):
+    elements = LAYOUT_ELEMENTS[granularity]
+    pages = [documentai.Document.Page(**{elements: getattr(page, elements)}) for page in document.pages]
+    return documentai.Document(text=document.text, pages=pages)
+
+
+# The extraction before walk_document, kept for the benchmark: Document.to_dict, then a second walk over the blocks.
+def to_dict_extracted_data(documentai, response):
+    document_dict = documentai.Document.to_dict(response.document)
+    extracted_data = {"text": document_dict.get("text", ""), "confidence_scores": []}
+    for page in response.document.pages:
+        for block in page.blocks:
+            for segment in block.layout.text_anchor.text_segments:
+                extracted_data["confidence_scores"].append({
+                    "text": document_dict["text"][segment.start_index:segment.end_index],
+                    "confidence": block.layout.confidence,
+                    "start_index": int(segment.start_index),
+                    "end_index": int(segment.end_index),
+                })
+    return extracted_data
+
+
+# Parse one serialized ProcessResponse and extract it, in a fresh process. Reports the time and RSS
+# growth of an untraced run, then the Python heap peak (tracemalloc) of a second run.
+def measure_extraction(wire_path, method, granularity):
+    import resource  # Unix only, like the rest of the benchmark helpers
+    import tracemalloc
+    from google.cloud import documentai_v1 as documentai
+    with open(wire_path, "rb") as file:
+        wire = file.read()
+
+    def extract():
+        response = documentai.ProcessResponse.deserialize(wire)
+        if method == "to_dict":
+            return to_dict_extracted_data(documentai, response)
+        return walk_document(documentai.Document.pb(response.document), granularity)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    extracted_data = extract()
+    seconds = time.perf_counter() - started
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    del extracted_data
+
+    tracemalloc.start()
+    extracted_data = extract()
+    _, python_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "response_bytes": len(wire),
+        "seconds": round(seconds, 4),
+        "rss_growth_mb": round(rss_growth / 1024, 2),  # ru_maxrss is in KiB on Linux
+        "python_peak_mb": round(python_peak / (1024 * 1024), 2),
+        "confidence_scores": len(extracted_data["confidence_scores"]),
+    }
+
+
+# Compare the old to_dict extraction with walk_document, without and with the response field mask.
+def run_walker_benchmark(pages, granularity, image_kb):
+    import tempfile
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from google.cloud import documentai_v1 as documentai
+    document = synthetic_document(documentai, pages, image_kb)
+    runs = (
+        ("to_dict", document),
+        ("walker", document),
+        ("walker_field_mask", masked_document(documentai, document, granularity)),
+    )
+    report = {"pages": pages, "granularity": granularity, "image_kb": image_kb}
+    with tempfile.TemporaryDirectory(prefix="docai_walker_") as folder:
+        for name, run_document in runs:
+            wire_path = os.path.join(folder, f"{name}.bin")
+            with open(wire_path, "wb") as file:
+                file.write(documentai.ProcessResponse.serialize(documentai.ProcessResponse(document=run_document)))
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                method = "to_dict" if name == "to_dict" else "walker"
+                report[name] = executor.submit(measure_extraction, wire_path, method, granularity).result()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark hedged OCR dispatch against the fake provider")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", default="bimodal:median=1,sigma=0.3,slow_ratio=0.05,slow_factor=8")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--time-scale", type=float, default=0.01, help="real seconds slept per simulated second")
+    parser.add_argument("--walker", action="store_true", help="benchmark Document AI response extraction instead")
+    parser.add_argument("--pages", type=int, default=15, help="pages of the synthetic Document AI response (--walker)")
+    parser.add_argument("--granularity", default="block", choices=sorted(LAYOUT_ELEMENTS))
+    parser.add_argument("--image-kb", type=int, default=400, help="page image size of the synthetic response (--walker)")
+    args = parser.parse_args()
+    if args.walker:
+        report = run_walker_benchmark(args.pages, args.granularity, args.image_kb)
+    else:
+        report = run_benchmark(args.requests, args.concurrency, args.latency, args.failure_rate, time_scale=args.time_scale)
+    json.dump(report, sys.stdout, indent=4)
+    print()
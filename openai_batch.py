@@ -0,0 +1,512 @@
+"""
+OpenAI Batch API backend for large extraction backlogs.
+
+Overnight backfills do not need interactive latency. Instead of synchronous chat.completions calls
+per file (which run into the per-minute limits and the retry stalls of the online path), the whole
+'Extracting' backlog of a project goes through the Batch API, which has its own, much larger,
+queue quota and a lower token price:
+
+  1. instrument type: documents the local classifier (instrument_classifier.py) is not confident
+     about are written to a JSONL batch file, uploaded and submitted
+  2. the batch is checked once; until it is done the run stops there (see below), then its output
+     file is downloaded
+  3. extraction: one request per document (one per window for long documents, see long_document.py)
+     with the compiled prompt of its instrument type, submitted and polled the same way
+  4. the answers are merged like the online path and applied with store_extracted_data_bulk,
+     BULK_BATCH_SIZE runsheets per statement
+
+Requests use the same compiled prompts and cache keys as extract_data.py, so cached answers are not
+requested again and batch answers fill the LLM cache. The submitted batch ids are kept in
+public.openai_batches, one row per project and phase: running the project again after a restart, in
+any process or host that claims its job, resumes polling those batches instead of paying for them twice. The state also records the custom_id of every submitted
+request, so files that reach 'Extracting' after a phase was submitted go into a follow-up batch of
+that phase instead of being left without an answer. Files without an answer stay 'Extracting' for the next run.
+
+Only EXTRACTION_MODE=serial uses this backend; ocr.py refuses to start with OPENAI_BACKEND=batch and
+the pipeline or async mode, which extract every file online as soon as it is OCR'd.
+
+A batch can take up to its 24h completion window, so a run never sits polling it: when a submitted
+batch is not done yet, process_documents_batch raises BatchesPending (a jobs.JobWaiting) and the
+extraction job is released as 'waiting' and run again after OPENAI_BATCH_POLL_SECONDS, resuming from
+the saved state. Such a poll only checks the batch status: the OCR text is not loaded until the
+batches are done, and the instrument types are saved with the batch ids, so the local classifier
+runs (and is counted in the metrics) once per document, not once per poll. While a project has
+saved batches start_extraction also skips its OCR step (see has_saved_batches). The command line
+below (wait=True) polls in place instead, up to OPENAI_BATCH_TIMEOUT_SECONDS.
+
+The service is used through the openai client, so OPENAI_BASE_URL can point at the fake OpenAI server
+of benchmark.py, which implements /v1/files and /v1/batches:
+
+    python benchmark.py --serve-openai 8089
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_BACKEND=batch python openai_batch.py <project_id>
+
+Configuration (.env):
+
+OPENAI_BACKEND=                    # online (default) or batch
+OPENAI_BATCH_DIR=                  # JSONL input files of the submitted batches
+OPENAI_BATCH_POLL_SECONDS=
+OPENAI_BATCH_TIMEOUT_SECONDS=
+OPENAI_BATCH_COMPLETION_WINDOW=
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+
+from openai.types.chat import ChatCompletion
+
+import metrics
+from db import db_connection
+from jobs import JobWaiting
+from llm_cache import make_cache_key
+from long_document import TokenBudget, is_long_document, split_windows
+from prompt_registry import prompt_registry, DOCUMENT_MESSAGE
+from extract_data import (
+    BULK_BATCH_SIZE, EXTRACTION_RESPONSE_FORMAT, OPENAI_MODEL, build_runsheet_record, completion_content, estimate_tokens,
+    fetch_extracting_documents, get_openai_client, instrument_type_request, llm_cache, local_instrument_type,
+    merge_windows, ocr_text_for_row, store_extracted_data_bulk, window_message,
+)
+
+
+OPENAI_BACKEND = os.getenv("OPENAI_BACKEND", "online")
+OPENAI_BATCH_DIR = os.getenv("OPENAI_BATCH_DIR", "openai_batch")
+OPENAI_BATCH_POLL_SECONDS = float(os.getenv("OPENAI_BATCH_POLL_SECONDS", "60"))
+OPENAI_BATCH_TIMEOUT_SECONDS = float(os.getenv("OPENAI_BATCH_TIMEOUT_SECONDS", str(26 * 3600)))
+OPENAI_BATCH_COMPLETION_WINDOW = os.getenv("OPENAI_BATCH_COMPLETION_WINDOW", "24h")
+OPENAI_BATCH_MAX_REQUESTS = 50000  # Batch API limit per input file
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchesPending(JobWaiting):
+    """Submitted batches are not done yet; the run is to be repeated once they may be."""
+
+    def __init__(self, project_id, phase, batch_ids):
+        super().__init__(f"Waiting for OpenAI {phase} batches {', '.join(batch_ids)} of project {project_id}",
+                         OPENAI_BATCH_POLL_SECONDS)
+        self.batch_ids = batch_ids
+
+
+PHASES = ("instrument_type", "extraction")
+
+
+CREATE_BATCHES_TABLE_QUERY = """
+CREATE TABLE IF NOT EXISTS public.openai_batches (
+    project_id INTEGER NOT NULL,
+    phase TEXT NOT NULL,
+    batch_ids JSONB,
+    submitted JSONB,
+    results JSONB,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (project_id, phase)
+);
+"""
+
+_table_ready = False
+_table_lock = threading.Lock()
+
+
+def ensure_batches_table():
+    global _table_ready
+    with _table_lock:
+        if _table_ready:
+            return
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(CREATE_BATCHES_TABLE_QUERY)
+        _table_ready = True
+
+
+# State file of the earlier, local-disk version of BatchState, imported once into public.openai_batches.
+def legacy_state_path(project_id):
+    return os.path.join(OPENAI_BATCH_DIR, f"project_{project_id}.json")
+
+
+class BatchState:
+    """Batch ids submitted for one project, and the instrument types already decided, saved in
+    public.openai_batches (one row per phase) so that a restarted or polling run, on any host,
+    resumes those batches instead of redoing the work before them."""
+
+    def __init__(self, project_id):
+        ensure_batches_table()
+        self.project_id = project_id
+        self.phases = {}  # phase -> {"batch_ids": [...] or None, "submitted": [...] or None, "results": {...} or None}
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT phase, batch_ids, submitted, results FROM public.openai_batches WHERE project_id = %s",
+                            (project_id,))
+                for phase, batch_ids, submitted, results in cur.fetchall():
+                    self.phases[phase] = {"batch_ids": batch_ids, "submitted": submitted, "results": results}
+        if not self.phases:
+            self._import_legacy_state()
+        submitted = {phase: row["batch_ids"] for phase, row in self.phases.items() if row["batch_ids"]}
+        if submitted:
+            logging.info(f"Resuming OpenAI batches of project {project_id}: {submitted}")
+
+    def _import_legacy_state(self):
+        path = legacy_state_path(self.project_id)
+        if not os.path.exists(path):
+            return
+        with open(path, "r") as file:
+            data = json.load(file)
+        for phase in PHASES:
+            if phase in data or phase in data.get("results", {}):
+                self.phases[phase] = {"batch_ids": data.get(phase), "submitted": data.get("submitted", {}).get(phase),
+                                      "results": data.get("results", {}).get(phase)}
+                self.save(phase)
+        os.remove(path)
+        logging.info(f"Imported the OpenAI batch state file of project {self.project_id} into public.openai_batches")
+
+    def _row(self, phase):
+        return self.phases.setdefault(phase, {"batch_ids": None, "submitted": None, "results": None})
+
+    def batch_ids(self, phase):
+        return self.phases.get(phase, {}).get("batch_ids")
+
+    def set_batch_ids(self, phase, batch_ids, custom_ids):
+        row = self._row(phase)
+        row["batch_ids"] = batch_ids
+        row["submitted"] = sorted(custom_ids)
+        self.save(phase)
+
+    # custom_ids already in a batch of the phase, or None for a state saved before they were recorded
+    # (its batches are resumed as they are, without follow-up batches).
+    def submitted(self, phase):
+        row = self.phases.get(phase, {})
+        if row.get("batch_ids") and row.get("submitted") is None:
+            return None
+        return set(row.get("submitted") or ())
+
+    # Saved answers of a phase: {"answers": {file_id: answer}, "requested": [file_id], "collected": bool}.
+    def results(self, phase):
+        results = self.phases.get(phase, {}).get("results")
+        if results is not None:
+            results = {**results, "answers": {int(file_id): answer for file_id, answer in results["answers"].items()}}
+        return results
+
+    def set_results(self, phase, answers, requested, collected=False):
+        self._row(phase)["results"] = {"answers": answers, "requested": requested, "collected": collected}
+        self.save(phase)
+
+    def save(self, phase):
+        row = self.phases[phase]
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO public.openai_batches (project_id, phase, batch_ids, submitted, results)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (project_id, phase) DO UPDATE SET
+                        batch_ids = EXCLUDED.batch_ids,
+                        submitted = EXCLUDED.submitted,
+                        results = EXCLUDED.results,
+                        updated_at = now()
+                """, (self.project_id, phase, *(None if row[key] is None else json.dumps(row[key])
+                                                for key in ("batch_ids", "submitted", "results"))))
+
+    def clear(self):
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM public.openai_batches WHERE project_id = %s", (self.project_id,))
+        self.phases = {}
+
+
+# One line of a batch input file.
+def batch_line(custom_id, messages, response_format=None):
+    body = {"model": OPENAI_MODEL, "messages": messages}
+    if response_format is not None:
+        body["response_format"] = response_format
+    return {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}
+
+
+# Write the requests as JSONL, upload and submit them, OPENAI_BATCH_MAX_REQUESTS per batch. Returns the batch ids.
+# first_part numbers the input files after those of earlier batches of the phase.
+def submit_batches(client, project_id, phase, lines, first_part=0):
+    batch_ids = []
+    for part_number, start in enumerate(range(0, len(lines), OPENAI_BATCH_MAX_REQUESTS), start=first_part):
+        part = lines[start:start + OPENAI_BATCH_MAX_REQUESTS]
+        path = os.path.join(OPENAI_BATCH_DIR, f"project_{project_id}_{phase}_{part_number}.jsonl")
+        with open(path, "w", encoding="utf-8") as file:
+            for line in part:
+                file.write(json.dumps(line) + "\n")
+        with open(path, "rb") as file:
+            input_file = client.files.create(file=file, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=OPENAI_BATCH_COMPLETION_WINDOW,
+            metadata={"project_id": str(project_id), "phase": phase},
+        )
+        logging.info(f"Submitted OpenAI batch {batch.id} ({phase}, {len(part)} requests) for project {project_id}")
+        batch_ids.append(batch.id)
+    return batch_ids
+
+
+# Poll a batch until it reaches a terminal status.
+def wait_for_batch(client, batch_id, poll_seconds=None, timeout_seconds=None):
+    poll_seconds = OPENAI_BATCH_POLL_SECONDS if poll_seconds is None else poll_seconds
+    timeout_seconds = OPENAI_BATCH_TIMEOUT_SECONDS if timeout_seconds is None else timeout_seconds
+    started = time.monotonic()
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in TERMINAL_STATUSES:
+            break
+        if time.monotonic() - started > timeout_seconds:
+            raise TimeoutError(f"OpenAI batch {batch_id} did not finish in {timeout_seconds} seconds")
+        counts = batch.request_counts
+        if counts is not None:
+            logging.info(f"OpenAI batch {batch_id}: {batch.status}, {counts.completed + counts.failed}/{counts.total} requests done")
+        time.sleep(poll_seconds)
+    logging.info(f"OpenAI batch {batch_id} {batch.status} after {time.monotonic() - started:.0f}s of polling")
+    return batch
+
+
+# Completions of the given batches by custom_id, once they are done. Failed requests are logged and left out;
+# expired or cancelled batches still return the requests they finished.
+def collect_results(client, batch_ids):
+    completions = {}
+    for batch_id in batch_ids:
+        batch = wait_for_batch(client, batch_id)
+        if batch.status != "completed":
+            logging.error(f"OpenAI batch {batch_id} ended with status {batch.status}: {batch.errors}")
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                response = entry.get("response") or {}
+                if entry.get("error") or response.get("status_code") != 200:
+                    logging.error(f"OpenAI batch request {entry.get('custom_id')} failed: {entry.get('error') or response.get('body')}")
+                    metrics.errors_total.inc(stage="openai_batch")
+                    continue
+                completions[entry["custom_id"]] = ChatCompletion.model_validate(response["body"])
+    return completions
+
+
+# Batch ids among batch_ids that have not reached a terminal status yet.
+def unfinished_batches(client, batch_ids):
+    return [batch_id for batch_id in batch_ids if client.batches.retrieve(batch_id).status not in TERMINAL_STATUSES]
+
+
+# Submit the requests of a phase and collect the completions of all its batches. Requests already in a
+# saved batch are not sent again; the others (files that reached 'Extracting' after the phase was
+# submitted) go into a follow-up batch. Unless wait is set, raises BatchesPending while any of the
+# batches is still running; the state keeps their ids.
+def run_phase(client, project_id, state, phase, lines, wait=False):
+    batch_ids = state.batch_ids(phase) or []
+    submitted = state.submitted(phase)
+    missing = [line for line in lines if submitted is not None and line["custom_id"] not in submitted]
+    if missing:
+        if batch_ids:
+            logging.info(f"Submitting a follow-up {phase} batch of {len(missing)} requests for project {project_id}")
+        batch_ids = batch_ids + submit_batches(client, project_id, phase, missing, first_part=len(batch_ids))
+        state.set_batch_ids(phase, batch_ids, submitted | {line["custom_id"] for line in missing})
+    if not batch_ids:
+        return {}
+    if not wait:
+        pending = unfinished_batches(client, batch_ids)
+        if pending:
+            raise BatchesPending(project_id, phase, pending)
+    return collect_results(client, batch_ids)
+
+
+# JSON answer of a batch completion (None when it is not valid JSON), recording its prompt usage.
+def parse_completion(completion, prompt_name):
+    prompt_registry.record_usage(prompt_name, completion.usage)
+    try:
+        return json.loads(completion_content(completion))
+    except json.JSONDecodeError as e:
+        logging.error(f"Error parsing JSON from batch completion {completion.id}: {e}")
+        return None
+
+
+# Whether the project has batches from an earlier run, i.e. its extraction job is resuming them.
+def has_saved_batches(project_id):
+    ensure_batches_table()
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM public.openai_batches WHERE project_id = %s LIMIT 1", (project_id,))
+            return cur.fetchone() is not None or os.path.exists(legacy_state_path(project_id))
+
+
+# Load the OCR text of every 'Extracting' file of a project.
+# Returns ({file_id: (project_id, user_id, ocr_text)}, [(file_id, error)]).
+def load_documents(project_id):
+    documents = {}
+    errors = []
+    for rows in fetch_extracting_documents(project_id):
+        for file_id, file_project_id, user_id, ocr_row_id, ocr_format_version, ocr_text in rows:
+            if ocr_row_id is None:
+                errors.append((file_id, f"No OCR data found for file_id {file_id}"))
+                continue
+            try:
+                ocr_text = ocr_text_for_row(ocr_row_id, ocr_format_version, ocr_text)
+            except (json.JSONDecodeError, TypeError):
+                errors.append((file_id, "Invalid JSON format"))
+                continue
+            if ocr_text is None:
+                errors.append((file_id, f"Error processing file_id {file_id}. No OCR Data Returned."))
+                continue
+            documents[file_id] = (file_project_id, user_id, ocr_text)
+    return documents, errors
+
+
+# Instrument types of all documents: local classifier, then LLM cache, then one batch for the rest.
+# The decisions are saved in the state, so a resumed run only classifies documents it has not seen.
+def batch_instrument_types(client, project_id, state, documents, wait=False):
+    saved = state.results("instrument_type") or {"answers": {}, "requested": [], "collected": False}
+    instrument_types = saved["answers"]
+    requested = set(saved["requested"])
+    unseen = [file_id for file_id in documents if file_id not in instrument_types and file_id not in requested]
+    for file_id in unseen:
+        ocr_text = documents[file_id][2]
+        answer = local_instrument_type(ocr_text)
+        if answer is None:
+            metrics.instrument_classifications_total.inc(source="llm")  # Cache hits included, like the online path
+            answer = llm_cache.get(instrument_type_request(ocr_text)[2])
+            if answer is None:
+                requested.add(file_id)
+                continue
+        instrument_types[file_id] = answer.get("instrument_type")
+    # Documents that reached 'Extracting' after the batch was collected reopen the phase
+    collected = saved["collected"] and not any(file_id in documents and file_id not in instrument_types
+                                               for file_id in requested)
+    if unseen:
+        state.set_results("instrument_type", instrument_types, sorted(requested), collected)
+
+    if not collected:
+        lines = []
+        for file_id in sorted(requested):
+            if file_id in documents and file_id not in instrument_types:
+                compiled, document_message, _ = instrument_type_request(documents[file_id][2])
+                lines.append(batch_line(f"instrument_type:{file_id}", compiled.messages(document_message)))
+        completions = run_phase(client, project_id, state, "instrument_type", lines, wait)
+        for custom_id, completion in completions.items():
+            file_id = int(custom_id.split(":")[1])
+            answer = parse_completion(completion, prompt_registry.instrument_type_prompt.name)
+            if answer is None or file_id not in documents:
+                continue
+            llm_cache.put(instrument_type_request(documents[file_id][2])[2], answer)
+            instrument_types[file_id] = answer.get("instrument_type")
+        state.set_results("instrument_type", instrument_types, sorted(requested), collected=True)
+    return {file_id: instrument_type for file_id, instrument_type in instrument_types.items()
+            if instrument_type and file_id in documents}
+
+
+# Extraction answers of all documents: {file_id: extracted data or {"error": ...}}.
+def batch_extractions(client, project_id, state, documents, instrument_types, wait=False):
+    plans = {}  # file_id -> (instrument type, [answer or None per request], budget)
+    lines = []
+    cache_keys = {}
+    estimates = {}  # custom_id -> tokens reserved for the request
+    for file_id, instrument_type in instrument_types.items():
+        instrument_type = prompt_registry.resolve_instrument_type(instrument_type)
+        compiled = prompt_registry.extraction_prompts[instrument_type]
+        ocr_text = documents[file_id][2]
+        if is_long_document(ocr_text):
+            windows = split_windows(ocr_text)
+            document_messages = [window_message(number, len(windows), text) for number, text in enumerate(windows, start=1)]
+        else:
+            document_messages = [DOCUMENT_MESSAGE.format(ocr_text=ocr_text)]
+
+        budget = TokenBudget()
+        answers = [None] * len(document_messages)
+        for index, document_message in enumerate(document_messages):
+            cache_key = make_cache_key(OPENAI_MODEL, compiled.system, compiled.instructions, document_message)
+            answers[index] = llm_cache.get(cache_key)
+            if answers[index] is not None:
+                continue
+            messages = compiled.messages(document_message)
+            estimated_tokens = estimate_tokens(messages)
+            if not budget.reserve(estimated_tokens):
+                logging.warning(f"Token budget exhausted for file {file_id}, request {index + 1}/{len(document_messages)} is not sent")
+                continue
+            custom_id = f"extraction:{file_id}:{index}"
+            cache_keys[custom_id] = cache_key
+            estimates[custom_id] = estimated_tokens
+            lines.append(batch_line(custom_id, messages, EXTRACTION_RESPONSE_FORMAT))
+        plans[file_id] = (instrument_type, answers, budget)
+
+    completions = run_phase(client, project_id, state, "extraction", lines, wait)
+    for custom_id, completion in completions.items():
+        _, file_id, index = custom_id.split(":")
+        file_id, index = int(file_id), int(index)
+        if file_id not in plans or index >= len(plans[file_id][1]):
+            continue
+        instrument_type, answers, budget = plans[file_id]
+        answer = parse_completion(completion, prompt_registry.extraction_prompts[instrument_type].name)
+        if answer is None:
+            continue
+        if custom_id in cache_keys:
+            llm_cache.put(cache_keys[custom_id], answer)
+        answers[index] = answer
+        budget.settle(estimates.get(custom_id, 0), completion.usage.total_tokens if completion.usage else None)
+
+    extractions = {}
+    for file_id, (instrument_type, answers, budget) in plans.items():
+        if len(answers) == 1:
+            result = answers[0] if answers[0] is not None else {"error": "No answer in the batch output"}
+        else:
+            result = merge_windows([answer for answer in answers if answer is not None], instrument_type, len(answers))
+        extractions[file_id] = result if "error" in result else {**result, "token_usage": budget.report()}
+    return extractions
+
+
+# Run the batch backend for a project. Returns (file_id, result) pairs like process_documents_bulk.
+# Raises BatchesPending while a submitted batch is running, unless wait is set.
+def process_documents_batch(project_id, client=None, wait=False):
+    client = client or get_openai_client()
+    os.makedirs(OPENAI_BATCH_DIR, exist_ok=True)
+    state = BatchState(project_id)
+    if not wait:
+        for phase in PHASES:  # Follow-up batches can leave an earlier phase running
+            pending = unfinished_batches(client, state.batch_ids(phase) or [])
+            if pending:
+                raise BatchesPending(project_id, phase, pending)  # Before loading any OCR text
+
+    documents, results = load_documents(project_id)
+    logging.info(f"OpenAI batch run for project {project_id}: {len(documents)} documents")
+    instrument_types = batch_instrument_types(client, project_id, state, documents, wait)
+    extractions = batch_extractions(client, project_id, state, documents, instrument_types, wait)
+
+    pending = []
+    for file_id, (file_project_id, user_id, _) in documents.items():
+        extracted_data = extractions.get(file_id, {"error": "Instrument type could not be extracted."})
+        if "error" in extracted_data:
+            logging.error(f"Error processing document {file_id}: {extracted_data}")
+            metrics.errors_total.inc(stage="extraction")
+            results.append((file_id, f"Error processing document {file_id}: {extracted_data['error']}"))
+            continue
+        record = build_runsheet_record(user_id, file_id, file_project_id, extracted_data)
+        if record is None:
+            results.append((file_id, "Invalid JSON data"))
+            continue
+        pending.append(record)
+
+    for start in range(0, len(pending), BULK_BATCH_SIZE):
+        records = pending[start:start + BULK_BATCH_SIZE]
+        try:
+            store_extracted_data_bulk(records)
+            stored = "Data successfully stored/updated."
+        except Exception as e:
+            logging.error(f"Error storing runsheet batch for project {project_id}: {e}")
+            metrics.errors_total.inc(stage="extraction_store")
+            stored = f"Error storing data: {e}"
+        results.extend((record[0], stored) for record in records)
+
+    state.clear()
+    logging.info(f"OpenAI batch run for project {project_id} done: {len(pending)} runsheets applied")
+    logging.info(f"Prompt cache stats: {prompt_registry.stats()}")
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit("usage: python openai_batch.py <project_id>")
+    for file_id, result in process_documents_batch(int(sys.argv[1]), wait=True):
+        logging.info(f"Completed processing file ID {file_id}: {result}")
@@ -0,0 +1,184 @@
+"""
+Prompt registry compiled once from prompts.json.
+
+OpenAI caches prompts by exact prefix: when the beginning of a request is byte-identical to a recent
+one, those prompt tokens are billed at a discount and served faster. The old prompts put the document
+text in the middle of the message and re-serialized the prompts.json fields on every call, so almost
+nothing was ever shared between two requests.
+
+Every prompt is now compiled at startup into:
+
+    system message      identical for every request of the same kind
+    static instructions identical for every document of the same instrument type (fields block)
+    variable message    built per call and always last: window note, then the document text
+
+so all documents of one instrument type share the same prefix byte for byte.
+
+Instrument types returned by the model are normalized before the lookup ("Right of Way",
+"right-of-way" and "Easement" all resolve to "Easement or Right of Way"); unknown types fall back to "Other".
+
+Prompt and cached token counts (usage.prompt_tokens_details.cached_tokens) are recorded per prompt
+with record_usage and reported by stats().
+"""
+
+import re
+import json
+import logging
+import threading
+
+
+INSTRUMENT_TYPE_SYSTEM_PROMPT = """
+    You are a legal expert extraction algorithm specializing in property law and land transactions.
+    Extract the following details from the provided legal land document and provide output in valid JSON format.
+    """
+
+INSTRUMENT_TYPE_INSTRUCTIONS = """
+    Extract legal information from the document given in the next message.
+    Carefully analyze the first few lines of the document to determine the instrument type.
+    Instrument Type can be one of following: {instrument_types}.
+    If the type is an amendment, return what kind of instrument it is amending.
+    If the instrument type is not explicitly stated, return "Other".
+    Please return the result as a JSON object with a key named "instrument_type".
+    """
+
+EXTRACTION_SYSTEM_PROMPT = "You are a legal expert extraction algorithm specializing in property law and land transactions. Extract the following details from the provided legal land document and provide output in valid JSON format. The Text that you have to search this information from is in the last message."
+
+EXTRACTION_INSTRUCTIONS = """
+        Find the following parameters in the text data given in the last message.
+        Parameters:
+        {fields}
+        """
+
+WINDOW_NOTE = "This text data is part {window_number} of {window_count} of a longer document. Return an empty string for parameters that do not appear in this part.\n"
+
+DOCUMENT_MESSAGE = "Search in this text data:\n{ocr_text}"
+
+# Names the model uses for an instrument type, besides the prompts.json key itself
+INSTRUMENT_TYPE_ALIASES = {
+    "right of way": "Easement or Right of Way",
+    "row": "Easement or Right of Way",
+    "easement": "Easement or Right of Way",
+    "pipeline easement": "Easement or Right of Way",
+    "will": "Will and Testament",
+    "last will and testament": "Will and Testament",
+    "quit claim": "Quitclaim",
+    "quit claim deed": "Quitclaim",
+    "quitclaim deed": "Quitclaim",
+    "oil and gas lease": "Lease",
+    "mineral lease": "Lease",
+    "ratification of lease": "Ratification",
+    "affidavit of heirship": "Affidavit",
+    "death certificate": "Death Certificate",
+    "obituary notice": "Obituary",
+    "divorce decree": "Divorce",
+    "decree of divorce": "Divorce",
+    "court case": "Court Case",
+    "judgment": "Court Case",
+    "lawsuit": "Court Case",
+}
+
+
+def normalize_name(name):
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", str(name or "").lower()).split())
+
+
+class CompiledPrompt:
+    """Static prefix of one prompt. messages() appends the variable content as the last message."""
+
+    def __init__(self, name, system, instructions):
+        self.name = name
+        self.system = system
+        self.instructions = instructions
+        self._prefix = (
+            {"role": "system", "content": system},
+            {"role": "user", "content": instructions},
+        )
+
+    def messages(self, variable_content):
+        return [dict(message) for message in self._prefix] + [{"role": "user", "content": variable_content}]
+
+
+class PromptRegistry:
+    def __init__(self, prompts):
+        self.prompts = prompts
+        self.instrument_types = list(prompts)
+        self.instrument_type_prompt = CompiledPrompt(
+            "instrument_type",
+            INSTRUMENT_TYPE_SYSTEM_PROMPT,
+            INSTRUMENT_TYPE_INSTRUCTIONS.format(instrument_types=self._instrument_type_list()),
+        )
+        self.extraction_prompts = {
+            instrument_type: CompiledPrompt(
+                f"extraction:{instrument_type}",
+                EXTRACTION_SYSTEM_PROMPT,
+                EXTRACTION_INSTRUCTIONS.format(fields=json.dumps(entry.get("fields", {}), indent=4)),
+            )
+            for instrument_type, entry in prompts.items()
+        }
+        self.lookup = {normalize_name(instrument_type): instrument_type for instrument_type in self.instrument_types}
+        for alias, instrument_type in INSTRUMENT_TYPE_ALIASES.items():
+            if instrument_type in prompts:
+                self.lookup.setdefault(normalize_name(alias), instrument_type)
+        for instrument_type in self.instrument_types:
+            for part in re.split(r" or | and ", instrument_type):
+                self.lookup.setdefault(normalize_name(part), instrument_type)
+
+        self.usage = {}
+        self._lock = threading.Lock()
+
+    def _instrument_type_list(self):
+        names = [name for name in self.instrument_types if name != "Other"]
+        return ", ".join(names) + (" or Other" if "Other" in self.instrument_types else "")
+
+    # Map whatever the model answered to a prompts.json key: exact or alias match first,
+    # then the longest known name contained in the answer ("Special Warranty Deed" -> "Deed"), else "Other".
+    def resolve_instrument_type(self, instrument_type):
+        normalized = normalize_name(instrument_type)
+        resolved = self.lookup.get(normalized)
+        if resolved is None:
+            # "Assignment of Oil and Gas Lease" is an assignment: look at the words before "of" first
+            candidates = [normalized.split(" of ")[0], normalized] if " of " in normalized else [normalized]
+            for candidate in candidates:
+                padded = f" {candidate} "
+                matches = [name for name in self.lookup if name and f" {name} " in padded]
+                if matches:
+                    resolved = self.lookup[max(matches, key=len)]
+                    break
+            else:
+                resolved = "Other" if "Other" in self.prompts else None
+        if resolved != instrument_type:
+            logging.info(f"Instrument type '{instrument_type}' resolved to '{resolved}'")
+        return resolved
+
+    def extraction_prompt(self, instrument_type):
+        return self.extraction_prompts[self.resolve_instrument_type(instrument_type)]
+
+    # Record prompt and cached prompt tokens of one completion.
+    def record_usage(self, prompt_name, usage):
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (getattr(details, "cached_tokens", 0) or 0) if details is not None else 0
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        with self._lock:
+            entry = self.usage.setdefault(prompt_name, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0})
+            entry["calls"] += 1
+            entry["prompt_tokens"] += prompt_tokens
+            entry["cached_tokens"] += cached_tokens
+        logging.info(f"Prompt {prompt_name}: {cached_tokens}/{prompt_tokens} prompt tokens served from the provider cache")
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {**entry, "cached_ratio": round(entry["cached_tokens"] / entry["prompt_tokens"], 3) if entry["prompt_tokens"] else 0.0}
+                for name, entry in self.usage.items()
+            }
+
+
+def load_prompts(filepath="prompts.json"):
+    with open(filepath, "r") as f:
+        prompts = json.load(f)
+    return prompts
+
+
+prompt_registry = PromptRegistry(load_prompts())
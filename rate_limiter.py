@@ -0,0 +1,190 @@
+"""
+Adaptive rate limiter for OpenAI requests.
+
+The limiter keeps two budgets:
+  - in-flight requests (a concurrency window, like a TCP congestion window)
+  - tokens per minute (a sliding 60 second window of reserved/used tokens)
+
+Both budgets follow AIMD (additive increase, multiplicative decrease):
+every successful call grows them a little, every 429 cuts them by a factor.
+The x-ratelimit-* response headers sent by OpenAI are used to cap the token
+budget at the account quota and to pause new calls until the quota resets
+when it is about to run out, so we stay just below the limit instead of
+hitting the SDK back-off.
+
+The .env file may contain the following variables:
+
+OPENAI_MAX_CONCURRENCY=
+OPENAI_MIN_CONCURRENCY=
+OPENAI_INITIAL_CONCURRENCY=
+OPENAI_TOKENS_PER_MINUTE=
+OPENAI_AIMD_DECREASE_FACTOR=
+"""
+
+import os
+import re
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+
+
+# Parse an OpenAI reset duration such as "6m0s", "1.5s" or "20ms" into seconds.
+def parse_reset_duration(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total = 0.0
+    matched = False
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        matched = True
+        amount = float(amount)
+        total += {"ms": amount / 1000, "s": amount, "m": amount * 60, "h": amount * 3600}[unit]
+    return total if matched else None
+
+
+class AdaptiveRateLimiter:
+    """AIMD limiter on in-flight requests and tokens per minute."""
+
+    def __init__(self, max_concurrency=16, min_concurrency=1, initial_concurrency=4,
+                 tokens_per_minute=200000, min_tokens_per_minute=10000,
+                 decrease_factor=0.5, tokens_increase_step=2000):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency_limit = float(max(min_concurrency, min(initial_concurrency, max_concurrency)))
+        self.max_tokens_per_minute = tokens_per_minute
+        self.min_tokens_per_minute = min_tokens_per_minute
+        self.tokens_per_minute = float(tokens_per_minute)
+        self.decrease_factor = decrease_factor
+        self.tokens_increase_step = tokens_increase_step
+
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.rate_limited_count = 0
+        self._token_window = deque()  # (timestamp, tokens)
+        self._condition = threading.Condition()
+
+    def _tokens_in_window(self, now):
+        while self._token_window and now - self._token_window[0][0] >= 60:
+            self._token_window.popleft()
+        return sum(tokens for _, tokens in self._token_window)
+
+    # Reserve estimated_tokens if the request fits in both budgets (caller holds the condition).
+    # Returns None when reserved, else the seconds worth waiting before trying again.
+    def _try_reserve(self, estimated_tokens):
+        now = time.monotonic()
+        wait = self.blocked_until - now
+        if wait <= 0:
+            used = self._tokens_in_window(now)
+            fits_tokens = used == 0 or used + estimated_tokens <= self.tokens_per_minute
+            if self.in_flight < int(self.concurrency_limit) and fits_tokens:
+                self.in_flight += 1
+                self._token_window.append((now, estimated_tokens))
+                return None
+            wait = 60 - (now - self._token_window[0][0]) if not fits_tokens and self._token_window else 1.0
+        return wait
+
+    def acquire(self, estimated_tokens):
+        """Block until a request of estimated_tokens fits in both budgets, then reserve it."""
+        with self._condition:
+            while True:
+                wait = self._try_reserve(estimated_tokens)
+                if wait is None:
+                    return
+                self._condition.wait(timeout=max(0.05, min(wait, 5.0)))
+
+    async def acquire_async(self, estimated_tokens):
+        """Like acquire, for coroutines. Polls instead of waiting on the condition, so the event loop keeps running."""
+        while True:
+            with self._condition:
+                wait = self._try_reserve(estimated_tokens)
+            if wait is None:
+                return
+            await asyncio.sleep(max(0.05, min(wait, 0.25)))
+
+    def _release(self, reserved_tokens, used_tokens):
+        self.in_flight -= 1
+        # Replace the reservation with the tokens the call really used
+        for i in range(len(self._token_window) - 1, -1, -1):
+            timestamp, tokens = self._token_window[i]
+            if tokens == reserved_tokens:
+                self._token_window[i] = (timestamp, used_tokens)
+                break
+
+    def on_success(self, reserved_tokens, used_tokens=None, headers=None):
+        """Release a reservation after a successful call and grow the budgets additively."""
+        with self._condition:
+            self._release(reserved_tokens, reserved_tokens if used_tokens is None else used_tokens)
+            # +1 request per full window of successes, like TCP congestion avoidance
+            self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1.0 / self.concurrency_limit)
+            self.tokens_per_minute = min(self.max_tokens_per_minute, self.tokens_per_minute + self.tokens_increase_step)
+            if headers is not None:
+                self._apply_headers(headers)
+            self._condition.notify_all()
+
+    def on_rate_limited(self, reserved_tokens, headers=None):
+        """Release a reservation after a 429 and cut the budgets multiplicatively."""
+        with self._condition:
+            self._release(reserved_tokens, reserved_tokens)
+            self.rate_limited_count += 1
+            self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit * self.decrease_factor)
+            self.tokens_per_minute = max(self.min_tokens_per_minute, self.tokens_per_minute * self.decrease_factor)
+            retry_after = None
+            if headers is not None:
+                retry_after = parse_reset_duration(headers.get("retry-after-ms"))
+                retry_after = retry_after / 1000 if retry_after is not None else parse_reset_duration(headers.get("retry-after"))
+                self._apply_headers(headers)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + (retry_after if retry_after is not None else 1.0))
+            logging.warning(f"OpenAI rate limited: concurrency limit {self.concurrency_limit:.1f}, tokens per minute {self.tokens_per_minute:.0f}")
+            self._condition.notify_all()
+
+    def on_error(self, reserved_tokens):
+        """Release a reservation after a non rate-limit failure without touching the budgets."""
+        with self._condition:
+            self._release(reserved_tokens, 0)
+            self._condition.notify_all()
+
+    def _apply_headers(self, headers):
+        limit_tokens = headers.get("x-ratelimit-limit-tokens")
+        if limit_tokens:
+            try:
+                self.max_tokens_per_minute = min(self.max_tokens_per_minute, int(limit_tokens))
+                self.tokens_per_minute = min(self.tokens_per_minute, self.max_tokens_per_minute)
+            except ValueError:
+                pass
+
+        # Pause new calls until the quota resets when a budget is nearly exhausted
+        for kind, low_water_mark in (("tokens", self.tokens_per_minute * 0.05), ("requests", 1)):
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            reset = parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            try:
+                remaining = int(remaining) if remaining is not None else None
+            except ValueError:
+                remaining = None
+            if remaining is not None and reset is not None and remaining <= low_water_mark:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + reset)
+
+    def stats(self):
+        with self._condition:
+            return {
+                "in_flight": self.in_flight,
+                "concurrency_limit": round(self.concurrency_limit, 2),
+                "tokens_per_minute": int(self.tokens_per_minute),
+                "tokens_in_window": self._tokens_in_window(time.monotonic()),
+                "rate_limited_count": self.rate_limited_count,
+            }
+
+
+# Process wide limiter shared by every OpenAI call
+openai_limiter = AdaptiveRateLimiter(
+    max_concurrency=int(os.getenv("OPENAI_MAX_CONCURRENCY", "16")),
+    min_concurrency=int(os.getenv("OPENAI_MIN_CONCURRENCY", "1")),
+    initial_concurrency=int(os.getenv("OPENAI_INITIAL_CONCURRENCY", "4")),
+    tokens_per_minute=int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "200000")),
+    decrease_factor=float(os.getenv("OPENAI_AIMD_DECREASE_FACTOR", "0.5")),
+)
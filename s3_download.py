@@ -0,0 +1,307 @@
+"""
+Download engine for S3 (pre-signed URL) files.
+
+  - one shared requests.Session, so connections are kept alive and reused across files
+  - chunk size adapted to the file size (Content-Length / 64, between 64 KiB and 8 MiB)
+  - writes go to <file>.part and are renamed into place only when complete, so a file in
+    download_file/ is never half-written; concurrent downloads of the same file in one process
+    take turns on a per-path lock instead of writing the same .part file
+  - an interrupted transfer is resumed from the .part file with a Range request, with
+    exponential back-off between attempts; a .part file the server answers 416 for is only taken as
+    complete when its size matches the object size in Content-Range, otherwise it is downloaded again
+  - DownloadCache keeps the download folder under DOWNLOAD_CACHE_MAX_MB by removing the least
+    recently used files (reused files are touched); files younger than DOWNLOAD_CACHE_MIN_AGE_SECONDS
+    are never removed so a running project keeps its inputs
+  - every download returns its size, time and throughput so per file and per project MB/s can be logged
+  - download_to_file_async is the same engine on an aiohttp session, for the async execution mode
+
+Configuration (.env):
+
+DOWNLOAD_CHUNK_SIZE_KB=        # fixed chunk size, overrides the adaptive one
+DOWNLOAD_MAX_RETRIES=
+DOWNLOAD_TIMEOUT_SECONDS=
+DOWNLOAD_POOL_SIZE=
+DOWNLOAD_CACHE_MAX_MB=
+DOWNLOAD_CACHE_MIN_AGE_SECONDS=
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from scheduler import scheduler
+import metrics
+
+
+KB = 1024
+MB = 1024 * 1024
+
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE_KB", "0")) * KB
+DOWNLOAD_MAX_RETRIES = int(os.getenv("DOWNLOAD_MAX_RETRIES", "4"))
+DOWNLOAD_TIMEOUT_SECONDS = float(os.getenv("DOWNLOAD_TIMEOUT_SECONDS", "60"))
+DOWNLOAD_POOL_SIZE = int(os.getenv("DOWNLOAD_POOL_SIZE", "16"))
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class DownloadError(Exception):
+    """Raised when a file could not be downloaded after all retries."""
+
+
+class DownloadResult:
+    def __init__(self, file_path, size_bytes, seconds, resumed_bytes=0):
+        self.file_path = file_path
+        self.size_bytes = size_bytes
+        self.seconds = seconds
+        self.resumed_bytes = resumed_bytes
+
+    @property
+    def mb_per_second(self):
+        transferred = self.size_bytes - self.resumed_bytes
+        return transferred / MB / self.seconds if self.seconds > 0 else 0.0
+
+
+_session = None
+_session_lock = threading.Lock()
+
+# Shared keep-alive session sized for the download pool
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=DOWNLOAD_POOL_SIZE, pool_maxsize=DOWNLOAD_POOL_SIZE)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def adaptive_chunk_size(content_length):
+    if DOWNLOAD_CHUNK_SIZE:
+        return DOWNLOAD_CHUNK_SIZE
+    if not content_length:
+        return MB
+    return max(64 * KB, min(8 * MB, int(content_length) // 64))
+
+
+# Whether a 416 answer to a resume request means the .part file is complete: its Content-Range
+# ("bytes */<size>") must give the object size, and the .part file must have exactly that size.
+# Otherwise the .part file is from another version of the object (or was never checked) and is discarded.
+def part_file_complete(part_path, existing, content_range):
+    total = (content_range or "").rpartition("/")[2]
+    if total.isdigit() and int(total) == existing:
+        return True
+    logging.warning(f"Discarding {part_path}: {existing} bytes, but the object is {total or 'of unknown size'}")
+    os.remove(part_path)
+    return False
+
+
+# Lock per .part path, shared by the sync and async engines, so two downloads of the same file in this
+# process take turns instead of writing the same .part file. Entries are dropped when no download uses them.
+_part_locks = {}  # part path -> [lock, number of downloads using it]
+_part_locks_guard = threading.Lock()
+
+
+def _part_lock(part_path):
+    with _part_locks_guard:
+        entry = _part_locks.setdefault(part_path, [threading.Lock(), 0])
+        entry[1] += 1
+        return entry[0]
+
+
+def _drop_part_lock(part_path):
+    with _part_locks_guard:
+        entry = _part_locks[part_path]
+        entry[1] -= 1
+        if not entry[1]:
+            del _part_locks[part_path]
+
+
+# Download url to file_path atomically, resuming from file_path + ".part" when a previous attempt was cut off.
+def download_to_file(url, file_path, max_retries=None, timeout=None):
+    part_path = file_path + ".part"
+    lock = _part_lock(part_path)
+    try:
+        with lock:
+            return _download_to_file(url, file_path, max_retries, timeout)
+    finally:
+        _drop_part_lock(part_path)
+
+
+def _download_to_file(url, file_path, max_retries=None, timeout=None):
+    max_retries = DOWNLOAD_MAX_RETRIES if max_retries is None else max_retries
+    timeout = timeout or DOWNLOAD_TIMEOUT_SECONDS
+    part_path = file_path + ".part"
+    started = time.monotonic()
+    resumed_bytes = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    last_error = None
+
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(min(30, 2 ** (attempt - 1)))
+        existing = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={existing}-"} if existing else {}
+        try:
+            scheduler.throttle("s3")
+            with get_session().get(url, stream=True, headers=headers, timeout=timeout) as response:
+                if response.status_code == 416 and existing:
+                    if part_file_complete(part_path, existing, response.headers.get("Content-Range")):
+                        break  # The .part file already holds everything the server has
+                    resumed_bytes = 0
+                    last_error = "stale .part file"
+                    continue
+                if response.status_code in RETRY_STATUS_CODES:
+                    last_error = f"HTTP {response.status_code}"
+                    if response.status_code == 429:
+                        metrics.rate_limited_total.inc(provider="s3")
+                    continue
+                if response.status_code not in (200, 206):
+                    raise DownloadError(f"HTTP {response.status_code} for {url}")
+
+                mode = "ab" if response.status_code == 206 and existing else "wb"  # 200 means the server ignored Range
+                if mode == "wb":
+                    resumed_bytes = 0
+                expected = response.headers.get("Content-Length")
+                written = 0
+                with open(part_path, mode) as file:
+                    for chunk in response.iter_content(adaptive_chunk_size(expected)):
+                        file.write(chunk)
+                        written += len(chunk)
+                if expected is not None and written < int(expected):
+                    last_error = f"short read: {written} of {expected} bytes"
+                    continue
+                break
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            last_error = str(e)
+            logging.warning(f"Download interrupted (attempt {attempt + 1}), will resume: {e}")
+    else:
+        raise DownloadError(f"Failed to download {url} after {max_retries + 1} attempts: {last_error}")
+
+    os.replace(part_path, file_path)
+    return DownloadResult(file_path, os.path.getsize(file_path), time.monotonic() - started, resumed_bytes)
+
+
+# aiohttp session for the async execution mode, with the same connection limit as the requests session.
+# Create it inside the event loop that uses it.
+def create_async_session():
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=DOWNLOAD_POOL_SIZE),
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=DOWNLOAD_TIMEOUT_SECONDS, sock_read=DOWNLOAD_TIMEOUT_SECONDS),
+    )
+
+
+# download_to_file for coroutines: same .part file, lock, Range resume and retry policy, streamed through an aiohttp session.
+async def download_to_file_async(session, url, file_path, max_retries=None):
+    part_path = file_path + ".part"
+    lock = _part_lock(part_path)
+    try:
+        while not lock.acquire(blocking=False):  # Polled, so a cancelled download never ends up holding the lock
+            await asyncio.sleep(0.05)
+        try:
+            return await _download_to_file_async(session, url, file_path, max_retries)
+        finally:
+            lock.release()
+    finally:
+        _drop_part_lock(part_path)
+
+
+async def _download_to_file_async(session, url, file_path, max_retries=None):
+    max_retries = DOWNLOAD_MAX_RETRIES if max_retries is None else max_retries
+    part_path = file_path + ".part"
+    started = time.monotonic()
+    resumed_bytes = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    last_error = None
+
+    for attempt in range(max_retries + 1):
+        if attempt:
+            await asyncio.sleep(min(30, 2 ** (attempt - 1)))
+        existing = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={existing}-"} if existing else {}
+        try:
+            await scheduler.throttle_async("s3")
+            async with session.get(url, headers=headers) as response:
+                if response.status == 416 and existing:
+                    if part_file_complete(part_path, existing, response.headers.get("Content-Range")):
+                        break
+                    resumed_bytes = 0
+                    last_error = "stale .part file"
+                    continue
+                if response.status in RETRY_STATUS_CODES:
+                    last_error = f"HTTP {response.status}"
+                    if response.status == 429:
+                        metrics.rate_limited_total.inc(provider="s3")
+                    continue
+                if response.status not in (200, 206):
+                    raise DownloadError(f"HTTP {response.status} for {url}")
+
+                mode = "ab" if response.status == 206 and existing else "wb"
+                if mode == "wb":
+                    resumed_bytes = 0
+                expected = response.headers.get("Content-Length")
+                written = 0
+                with open(part_path, mode) as file:
+                    async for chunk in response.content.iter_chunked(adaptive_chunk_size(expected)):
+                        file.write(chunk)
+                        written += len(chunk)
+                if expected is not None and written < int(expected):
+                    last_error = f"short read: {written} of {expected} bytes"
+                    continue
+                break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            last_error = str(e) or type(e).__name__
+            logging.warning(f"Download interrupted (attempt {attempt + 1}), will resume: {last_error}")
+    else:
+        raise DownloadError(f"Failed to download {url} after {max_retries + 1} attempts: {last_error}")
+
+    os.replace(part_path, file_path)
+    return DownloadResult(file_path, os.path.getsize(file_path), time.monotonic() - started, resumed_bytes)
+
+
+class DownloadCache:
+    """Size capped LRU over the files in a download folder."""
+
+    def __init__(self, folder, max_bytes, min_age_seconds):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.min_age_seconds = min_age_seconds
+        self.evicted_files = 0
+        self._lock = threading.Lock()
+
+    def touch(self, file_path):
+        try:
+            os.utime(file_path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.folder):
+                path = os.path.join(self.folder, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if os.path.isfile(path):
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            now = time.time()
+            for mtime, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if now - mtime < self.min_age_seconds:
+                    continue  # Still in use by a recent run (this includes .part files being written)
+                try:
+                    os.remove(path)
+                    total -= size
+                    self.evicted_files += 1
+                except FileNotFoundError:
+                    pass
+            return total
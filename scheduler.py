@@ -0,0 +1,212 @@
+"""
+Process-wide bounded scheduler for network work.
+
+Every request used to create its own ThreadPoolExecutor() with no worker limit, so two concurrent
+/api/v1/batch_ocr calls and a /start-extraction thread each hit S3 and Document AI at full width.
+All work now goes through one set of shared pools:
+
+  download   S3 downloads
+  ocr        per-file OCR orchestration (reading, planning, splitting, merging)
+  docai      individual Document AI calls (whole files or chunks)
+  ocr_hedge  primary and backup attempts of hedged OCR requests (ocr_providers.py)
+  openai     per-document OpenAI extraction
+  llm_windows  OpenAI calls for the page windows of long documents (long_document.py)
+
+Tasks on one pool never wait for tasks on the same pool, so the pools cannot deadlock each
+other (ocr tasks wait on docai tasks only, docai tasks on ocr_hedge tasks, openai tasks on llm_windows tasks only).
+
+On top of the worker limits, each provider has a token bucket quota (requests per minute);
+call scheduler.throttle("s3" | "docai" | "openai") right before a network request
+(await scheduler.throttle_async(...) in the async execution mode, which shares the same quotas).
+
+Queue depth, running and completed counters per pool and the bucket state are available
+from scheduler.stats().
+
+Configuration (.env):
+
+SCHEDULER_DOWNLOAD_WORKERS=
+SCHEDULER_OCR_WORKERS=
+SCHEDULER_DOCAI_WORKERS=
+SCHEDULER_OCR_HEDGE_WORKERS=
+SCHEDULER_OPENAI_WORKERS=
+SCHEDULER_LLM_WINDOW_WORKERS=
+S3_REQUESTS_PER_MINUTE=
+DOCAI_REQUESTS_PER_MINUTE=
+OPENAI_REQUESTS_PER_MINUTE=
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TokenBucket:
+    """Classic token bucket: refills at rate_per_second up to capacity, acquire() blocks until enough tokens."""
+
+    def __init__(self, rate_per_second, capacity):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.waiting = 0
+        self.total_wait_seconds = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate_per_second)
+        self._updated = now
+
+    # Take tokens if they are available. Returns 0 on success, else the seconds until they will be.
+    def _take(self, tokens, started):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                self.total_wait_seconds += now - started
+                return 0
+            return (tokens - self.tokens) / self.rate_per_second
+
+    def acquire(self, tokens=1):
+        started = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+        try:
+            while True:
+                wait = self._take(tokens, started)
+                if not wait:
+                    return
+                time.sleep(min(wait, 1.0))
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    # Same as acquire for coroutines: waits on the event loop instead of blocking the thread.
+    async def acquire_async(self, tokens=1):
+        started = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+        try:
+            while True:
+                wait = self._take(tokens, started)
+                if not wait:
+                    return
+                await asyncio.sleep(min(wait, 1.0))
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def stats(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                "rate_per_minute": round(self.rate_per_second * 60, 2),
+                "available_tokens": round(self.tokens, 2),
+                "waiting": self.waiting,
+                "total_wait_seconds": round(self.total_wait_seconds, 3),
+            }
+
+
+class WorkPool:
+    """Bounded thread pool that keeps queue depth counters."""
+
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-pool")
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    # The task runs in a copy of the caller's context, so context variables (jobs.current_job_id) follow it.
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            self.queued += 1
+        context = contextvars.copy_context()
+
+        def run():
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                return context.run(fn, *args, **kwargs)
+            except Exception:
+                with self._lock:
+                    self.failed += 1
+                raise
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        return self.executor.submit(run)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "failed": self.failed,
+            }
+
+
+class Scheduler:
+    """Named work pools plus per-provider token buckets, shared by the whole process."""
+
+    def __init__(self, pool_sizes, requests_per_minute):
+        self.pools = {name: WorkPool(name, size) for name, size in pool_sizes.items()}
+        self.buckets = {
+            provider: TokenBucket(rate / 60.0, capacity=max(1.0, rate / 60.0 * 5))  # ~5 seconds of burst
+            for provider, rate in requests_per_minute.items() if rate > 0
+        }
+
+    def submit(self, pool_name, fn, *args, **kwargs):
+        return self.pools[pool_name].submit(fn, *args, **kwargs)
+
+    # Like executor.map: runs fn over items on the named pool and returns the results in order.
+    def map(self, pool_name, fn, items):
+        futures = [self.submit(pool_name, fn, item) for item in items]
+        return [future.result() for future in futures]
+
+    # Wait for the provider's quota before a network request. Providers without a quota never wait.
+    def throttle(self, provider, tokens=1):
+        bucket = self.buckets.get(provider)
+        if bucket is not None:
+            bucket.acquire(tokens)
+
+    async def throttle_async(self, provider, tokens=1):
+        bucket = self.buckets.get(provider)
+        if bucket is not None:
+            await bucket.acquire_async(tokens)
+
+    def stats(self):
+        return {
+            "pools": {name: pool.stats() for name, pool in self.pools.items()},
+            "quotas": {provider: bucket.stats() for provider, bucket in self.buckets.items()},
+        }
+
+
+scheduler = Scheduler(
+    pool_sizes={
+        "download": int(os.getenv("SCHEDULER_DOWNLOAD_WORKERS", "8")),
+        "ocr": int(os.getenv("SCHEDULER_OCR_WORKERS", "8")),
+        "docai": int(os.getenv("SCHEDULER_DOCAI_WORKERS", "8")),
+        "ocr_hedge": int(os.getenv("SCHEDULER_OCR_HEDGE_WORKERS", "16")),  # up to two attempts per docai worker
+        "openai": int(os.getenv("SCHEDULER_OPENAI_WORKERS", os.getenv("EXTRACTION_WORKERS", "8"))),
+        "llm_windows": int(os.getenv("SCHEDULER_LLM_WINDOW_WORKERS", "8")),
+    },
+    requests_per_minute={
+        "s3": float(os.getenv("S3_REQUESTS_PER_MINUTE", "0")),  # 0 = no quota
+        "docai": float(os.getenv("DOCAI_REQUESTS_PER_MINUTE", "120")),
+        "openai": float(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500")),
+    },
+)
+logging.debug(f"Scheduler started: {scheduler.stats()}")
@@ -0,0 +1,128 @@
+"""
+Embedded text-layer fast path.
+
+Born-digital PDFs (recent recorded instruments, court filings) already carry a good text layer,
+so sending them to Document AI only costs latency and quota. Before OCR every page's text layer
+is read with PyPDF2 and scored:
+
+    coverage   how much text the page has, up to TEXT_LAYER_MIN_CHARS characters
+    quality    printable characters x word-like tokens x enough letters, minus extraction garbage
+               such as "(cid:12)" glyph references and U+FFFD replacement characters
+
+A page scoring at least TEXT_LAYER_MIN_SCORE is read locally; the others still go to Document AI.
+Mixed documents are routed page by page, and every decision is logged
+("Page routing: file_id ... page ... text_layer|ocr score ...") so the savings can be measured.
+
+The fast path is off by default. Recorder-scanned deeds often carry the county's own low-quality
+OCR layer, which can pass the score while reading worse than Document AI, and nothing downstream
+would notice the drop in extraction quality. Turn it on only for sources whose text layers have
+been checked, with a TEXT_LAYER_MIN_SCORE validated on those scans.
+
+Locally read pages produce the same {"text", "confidence_scores"} structure as Document AI,
+with one confidence entry per line and the page score as its confidence.
+
+Configuration (.env):
+
+TEXT_LAYER_FAST_PATH=      # false (default) or true
+TEXT_LAYER_MIN_SCORE=
+TEXT_LAYER_MIN_CHARS=
+"""
+
+import os
+import re
+import logging
+
+
+TEXT_LAYER_FAST_PATH = os.getenv("TEXT_LAYER_FAST_PATH", "false").lower() in ("1", "true", "yes")
+TEXT_LAYER_MIN_SCORE = float(os.getenv("TEXT_LAYER_MIN_SCORE", "0.8"))
+TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", "200"))
+
+WORD_PATTERN = re.compile(r"^[\"'(\[]*([A-Za-z][A-Za-z'\-]*|[\d$#%/.,\-]+)[\"')\].,;:!?]*$")
+
+
+class PageRoute:
+    def __init__(self, page_num, text, score, use_text_layer):
+        self.page_num = page_num
+        self.text = text
+        self.score = score
+        self.use_text_layer = use_text_layer
+
+
+# Score a page's extracted text between 0 (useless, needs OCR) and 1 (clean and complete).
+def score_page_text(text, min_chars=None):
+    min_chars = min_chars or TEXT_LAYER_MIN_CHARS
+    stripped = (text or "").strip()
+    if not stripped:
+        return 0.0
+
+    chars = len(stripped)
+    coverage = min(1.0, chars / min_chars)
+    printable = sum(1 for ch in stripped if ch.isprintable() or ch in "\n\t") / chars
+    letters = sum(1 for ch in stripped if ch.isalpha()) / chars
+    tokens = stripped.split()
+    word_like = sum(1 for token in tokens if WORD_PATTERN.match(token)) / len(tokens)
+    garbage = (stripped.count("\ufffd") + 5 * stripped.count("(cid:")) / chars
+
+    quality = printable * word_like * min(1.0, letters / 0.5) * max(0.0, 1.0 - 10 * garbage)
+    return round(coverage * quality, 4)
+
+
+# Read and score the text layer of every page. Returns one PageRoute per page, in page order.
+def route_pages(reader, file_id=None, min_score=None):
+    min_score = TEXT_LAYER_MIN_SCORE if min_score is None else min_score
+    routes = []
+    for page_num, page in enumerate(reader.pages):
+        try:
+            text = page.extract_text() or ""
+        except Exception as e:
+            logging.warning(f"Text layer unreadable: file_id {file_id} page {page_num + 1}: {e}")
+            text = ""
+        score = score_page_text(text)
+        route = PageRoute(page_num, text, score, score >= min_score)
+        routes.append(route)
+        logging.info(f"Page routing: file_id {file_id} page {page_num + 1} "
+                     f"{'text_layer' if route.use_text_layer else 'ocr'} score {score:.2f}")
+
+    local_pages = sum(1 for route in routes if route.use_text_layer)
+    logging.info(f"Page routing summary: file_id {file_id} {local_pages}/{len(routes)} pages from the text layer, "
+                 f"{len(routes) - local_pages} pages to OCR")
+    return routes
+
+
+# Build the {"text", "confidence_scores"} structure for pages read from the text layer.
+def text_layer_result(routes):
+    extracted_data = {"text": "", "confidence_scores": []}
+    text_parts = []
+    offset = 0
+    for route in routes:
+        page_text = route.text if route.text.endswith("\n") else route.text + "\n"
+        line_start = 0
+        for line in page_text.splitlines(keepends=True):
+            if line.strip():
+                extracted_data["confidence_scores"].append({
+                    "text": line,
+                    "confidence": route.score,
+                    "start_index": offset + line_start,
+                    "end_index": offset + line_start + len(line),
+                })
+            line_start += len(line)
+        text_parts.append(page_text)
+        offset += len(page_text)
+    extracted_data["text"] = "".join(text_parts)
+    return extracted_data
+
+
+# Contiguous (start_page, end_page) runs of the pages that still need OCR.
+def ocr_page_runs(page_count, text_layer_pages):
+    runs = []
+    start_page = None
+    for page_num in range(page_count):
+        if page_num in text_layer_pages:
+            if start_page is not None:
+                runs.append((start_page, page_num))
+                start_page = None
+        elif start_page is None:
+            start_page = page_num
+    if start_page is not None:
+        runs.append((start_page, page_count))
+    return runs